@@ -1,93 +1,200 @@
-from fastapi import FastAPI, Depends, HTTPException
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from database import SessionLocal, engine
-from models import Plan, User, PlanPermission, Permission, Subscription
-from schemas import PlanResponse, UserCreate, UserResponse, PlanUpdateResponse, PermissionRes, PermissionResponse, PlanDetails, SubscriptionCreate, SubscriptionResponse, UsageResponse, AccessControlResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.future import select
+from sqlalchemy.orm import selectinload
+from pydantic import TypeAdapter
+from database import AsyncSessionLocal, async_engine, replica_async_engine, pool_stats, REPLICA_ENABLED
+from models import Plan, User, PlanPermission, Permission, Subscription, PlanRateLimit, UsageRollup
+from schemas import PlanResponse, UserCreate, UserResponse, PlanUpdateResponse, PermissionRes, PermissionResponse, PlanDetails, UserRes, SubscriptionCreate, SubscriptionResponse, UsageResponse, AccessControlResponse, RateLimitCreate, RateLimitRes, UsageHistoryEntry, UsageHistoryResponse
 from typing import Any, Annotated, List
-from passlib.context import CryptContext
+from contextlib import asynccontextmanager
 from cloud_services import router as cloud_services_router
-from database import get_db
+from bulk_admin import router as bulk_admin_router
+from database import get_async_db
+from plan_cache import plan_cache
+from usage_buffer import usage_buffer
+from quota_store import QUOTA_STORE, create_quota_store
+from rate_limit import rate_limiter
+from usage_events import usage_events, bucket_start, USAGE_EVENTS_ENABLED
+from metrics import request_metrics, instrument_engine, MetricsMiddleware, METRICS_ENABLED
+from log_pipeline import log_pipeline
+from metering import metering_table
+from entitlements import entitlement_claims, entitlement_versions, AUTH_ENTITLEMENT_CLAIMS
+from pagination import PageParams, page_params, list_response
+from read_routing import read_router, get_read_db, track_writes, ReadRoutingMiddleware
+from billing_periods import billing_sweeper, period_start, plan_period, previous_usage, stored_billing_period, BILLING_SWEEP_ENABLED
+from usage_counters import usage_counters, USAGE_COUNTER_SLOTS
+from idempotency import idempotency_cache, IDEMPOTENCY_ENABLED
 from auth import (
     create_access_token,
-    hash_password,
-    verify_password,
+    password_hasher,
     get_current_user,
     # admin_required,
     oauth2_scheme,
     get_admin_user
 )
 
-
-app = FastAPI()
+log_pipeline.setup()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Route -> permission table for the metered services; retried on the first metered request if this fails
+    try:
+        async with AsyncSessionLocal() as db:
+            await metering_table.load(db)
+    except Exception:
+        logger.exception("Could not load the metering table at startup")
+    # Any store but the subscription row itself means buffered accounting
+    if QUOTA_STORE != "sql":
+        usage_buffer.start(AsyncSessionLocal, create_quota_store(QUOTA_STORE))
+    if USAGE_EVENTS_ENABLED:
+        usage_events.start(AsyncSessionLocal)
+    read_router.start()
+    if BILLING_SWEEP_ENABLED:
+        billing_sweeper.start(AsyncSessionLocal)
+    if USAGE_COUNTER_SLOTS > 1:
+        usage_counters.start(AsyncSessionLocal)
+    if IDEMPOTENCY_ENABLED:
+        idempotency_cache.start(AsyncSessionLocal)
+    yield
+    if idempotency_cache.enabled:
+        await idempotency_cache.stop()
+    if usage_counters.enabled:
+        await usage_counters.stop()
+    if billing_sweeper.enabled:
+        await billing_sweeper.stop()
+    if read_router.enabled:
+        await read_router.stop()
+    if usage_buffer.enabled:
+        await usage_buffer.stop()
+    if usage_events.enabled:
+        await usage_events.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+_plan_details_adapter = TypeAdapter(List[PlanDetails])
 app.include_router(cloud_services_router)
+app.include_router(bulk_admin_router)
+if REPLICA_ENABLED:
+    track_writes(async_engine.sync_engine)
+    app.add_middleware(ReadRoutingMiddleware)
+if METRICS_ENABLED:
+    instrument_engine(async_engine.sync_engine)
+    if replica_async_engine is not None:
+        instrument_engine(replica_async_engine.sync_engine)
+    app.add_middleware(MetricsMiddleware)
+
+# Prometheus scrape endpoint, per worker process
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    pool = pool_stats()["async"]
+    gauges = {
+        "db_pool_size": pool["size"],
+        "db_pool_checked_out": pool["checked_out"],
+        "db_pool_overflow": pool["overflow"],
+    }
+    return Response(request_metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
 @app.post("/register", response_model=UserResponse) 
-async def register_user(newUser: UserCreate, db: Session = Depends(get_db)) -> Any:
+async def register_user(newUser: UserCreate, db: AsyncSession = Depends(get_async_db)) -> Any:
     # Check if the username already exists
-    existing_user = db.query(User).filter(User.username == newUser.username).first()
+    existing_user = await db.scalar(select(User).filter(User.username == newUser.username))
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already exists")
 
     # Hash the password
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-    
-    hashed_password = pwd_context.hash(newUser.password)
+    hashed_password = await password_hasher.hash(newUser.password)
     user = User(username=newUser.username, password=hashed_password, role=newUser.role)
     
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent registration: ux_users_username rejected the insert
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Username already exists")
+    await db.refresh(user)
     return UserResponse(message="User created successfully", username=newUser.username, role=newUser.role)
 
 @app.post("/token")
-def login(formdata: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)):
-    print("formdata:" + str(formdata.username) + " " + str(formdata.password))  # Add logging
-    user = db.query(User).filter(User.username == formdata.username).first()
-    if not user or not verify_password(formdata.password, user.password):
+async def login(formdata: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_async_db)):
+    logger.debug("Login attempt", extra={"username": formdata.username})
+    user = await db.scalar(select(User).filter(User.username == formdata.username))
+    if not user or not await password_hasher.verify(formdata.password, user.password):
+        logger.info("Login failed", extra={"username": formdata.username})
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    # Include role in the token payload
-    access_token = create_access_token({"username": user.username, "role": user.role})
-    print("Access token:", access_token)  # Add logging
+    # Include role (and, when enabled, the entitlement claims) in the token payload
+    claims = await entitlement_claims(user.id, db) if AUTH_ENTITLEMENT_CLAIMS else {}
+    access_token = create_access_token({"username": user.username, "role": user.role, **claims})
     return {"access_token": access_token, "token_type": "bearer"}   
 
+def _plan_details(plan: Plan) -> PlanDetails:
+    return PlanDetails(id=plan.id, name=plan.name, description=plan.description, usage_limit=plan.usage_limit,
+                       endpoints=[permission.api_endpoint for permission in plan.permissions], billing_period=plan.billing_period)
+
 @app.get("/plans", response_model=List[PlanDetails])
-async def get_plans(db: Session = Depends(get_db)) -> Any:
-    plans = db.query(Plan).all()
-    plan_details = []
-    for plan in plans:
-        plan_permission = db.query(PlanPermission).filter(PlanPermission.plan_id == plan.id).all()
-        permission_list = []
-        for permission in plan_permission:
-            permission_list.append(db.query(Permission).filter(Permission.id == permission.api_id).first().api_endpoint)
-        plan_details.append(PlanDetails(id=plan.id, name=plan.name, description=plan.description, usage_limit=plan.usage_limit, endpoints=permission_list))
-    return plan_details
+async def get_plans(request: Request, page: PageParams = Depends(page_params), db: AsyncSession = Depends(get_read_db)) -> Any:
+    if not page.unpaged:
+        return await list_response(request, db, select(Plan).options(selectinload(Plan.permissions)),
+                                   Plan.id, page, _plan_details)
+
+    catalog = plan_cache.get_catalog()
+    if catalog is None:
+        version = plan_cache.version
+        # Plans and their endpoints in two queries
+        plans = (await db.scalars(select(Plan).options(selectinload(Plan.permissions)).order_by(Plan.id))).all()
+        body = _plan_details_adapter.dump_json([_plan_details(plan) for plan in plans])
+        # Content hash, so every worker hands out the same ETag for the same catalogue
+        catalog = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+        plan_cache.set_catalog(version, *catalog)
+
+    body, etag = catalog
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 @app.post("/create-plan", response_model=PlanResponse, dependencies=[Depends(get_admin_user)])
-async def create_plan(planres: PlanResponse, db: Session = Depends(get_db)) -> Any:
-    plan = Plan(name=planres.name, description=planres.description, usage_limit=planres.usage_limit)
+async def create_plan(planres: PlanResponse, db: AsyncSession = Depends(get_async_db)) -> Any:
+    plan = Plan(name=planres.name, description=planres.description, usage_limit=planres.usage_limit,
+                billing_period=stored_billing_period(planres.billing_period))
     db.add(plan)
-    db.commit()
-    db.refresh(plan)
+    await db.commit()
+    await db.refresh(plan)
+    plan_cache.invalidate(plan.id)
     return plan
 
 @app.post("/map-permission", dependencies=[Depends(get_admin_user)])
-async def map_permission(plan_id: int, permission_id: int, db: Session = Depends(get_db)) -> Any:
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+async def map_permission(plan_id: int, permission_id: int, db: AsyncSession = Depends(get_async_db)) -> Any:
+    plan = await db.scalar(select(Plan).filter(Plan.id == plan_id))
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
-    permission = db.query(Permission).filter(Permission.id == permission_id).first()
+    permission = await db.scalar(select(Permission).filter(Permission.id == permission_id))
     if not permission:
         raise HTTPException(status_code=404, detail="Permission not found")
     plan_permission = PlanPermission(plan_id=plan_id, api_id=permission_id)
     db.add(plan_permission)
-    db.commit()
-    db.refresh(plan_permission)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Permission already mapped to plan")
+    await db.refresh(plan_permission)
+    plan_cache.invalidate(plan_id)
+    entitlement_versions.bump_plan(plan_id)
     return {"message": "Permission mapped to plan successfully"}
 
 @app.put("/update-plan/{plan_id}", response_model=PlanUpdateResponse, dependencies=[Depends(get_admin_user)])
-async def update_plan(plan_id: int, planres: PlanResponse, db: Session = Depends(get_db)) -> Any:
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+async def update_plan(plan_id: int, planres: PlanResponse, db: AsyncSession = Depends(get_async_db)) -> Any:
+    plan = await db.scalar(select(Plan).filter(Plan.id == plan_id))
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
     if planres.name != "string" and planres.name != plan.name:
@@ -96,40 +203,101 @@ async def update_plan(plan_id: int, planres: PlanResponse, db: Session = Depends
         plan.description = planres.description
     if planres.usage_limit != 0 and planres.usage_limit != plan.usage_limit:
         plan.usage_limit = planres.usage_limit
-    db.commit()
-    db.refresh(plan)
+    # Subscriptions move to the new period length lazily, as when a period ends
+    if planres.billing_period is not None:
+        plan.billing_period = stored_billing_period(planres.billing_period)
+    await db.commit()
+    await db.refresh(plan)
+    plan_cache.invalidate(plan_id)
+    entitlement_versions.bump_plan(plan_id)
     return PlanUpdateResponse(message="Plan updated successfully", plan=plan)
 
 @app.delete("/delete-plan/{plan_id}", dependencies=[Depends(get_admin_user)])
-async def delete_plan(plan_id: int, db: Session = Depends(get_db)) -> Any:
-    plan_permission = db.query(PlanPermission).filter(PlanPermission.plan_id == plan_id).all()
-    if plan_permission:
-        for permission in plan_permission:
-            print("Permission:", permission.id)  # Add logging
-            db.delete(permission)
-        db.commit()
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+async def delete_plan(plan_id: int, db: AsyncSession = Depends(get_async_db)) -> Any:
+    plan = await db.scalar(select(Plan).filter(Plan.id == plan_id))
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
-    db.delete(plan)
-    db.commit()
+    # Remove the plan's mappings and rate limits in one statement each, in the same transaction as the plan
+    await db.execute(delete(PlanPermission).where(PlanPermission.plan_id == plan_id))
+    await db.execute(delete(PlanRateLimit).where(PlanRateLimit.plan_id == plan_id))
+    await db.delete(plan)
+    await db.commit()
+    plan_cache.invalidate(plan_id)
+    entitlement_versions.bump_plan(plan_id)
     return {"message": "Plan deleted successfully"}
 
+@app.get("/plan-cache/stats", dependencies=[Depends(get_admin_user)])
+async def get_plan_cache_stats() -> Any:
+    return plan_cache.stats()
+
+@app.get("/usage-buffer/stats", dependencies=[Depends(get_admin_user)])
+async def get_usage_buffer_stats() -> Any:
+    return usage_buffer.stats()
+
+@app.get("/rate-limit/stats", dependencies=[Depends(get_admin_user)])
+async def get_rate_limit_stats() -> Any:
+    return rate_limiter.stats()
+
+@app.get("/usage-events/stats", dependencies=[Depends(get_admin_user)])
+async def get_usage_events_stats() -> Any:
+    return usage_events.stats()
+
+@app.get("/password-hash/stats", dependencies=[Depends(get_admin_user)])
+async def get_password_hash_stats() -> Any:
+    return password_hasher.stats()
+
+@app.get("/db-pool/stats", dependencies=[Depends(get_admin_user)])
+async def get_db_pool_stats() -> Any:
+    return pool_stats()
+
+@app.get("/logging/stats", dependencies=[Depends(get_admin_user)])
+async def get_logging_stats() -> Any:
+    return log_pipeline.stats()
+
+@app.get("/entitlements/stats", dependencies=[Depends(get_admin_user)])
+async def get_entitlements_stats() -> Any:
+    return entitlement_versions.stats()
+
+@app.get("/metering/stats", dependencies=[Depends(get_admin_user)])
+async def get_metering_stats() -> Any:
+    return metering_table.stats()
+
+@app.get("/billing-periods/stats", dependencies=[Depends(get_admin_user)])
+async def get_billing_periods_stats() -> Any:
+    return billing_sweeper.stats()
+
+@app.get("/usage-counters/stats", dependencies=[Depends(get_admin_user)])
+async def get_usage_counters_stats() -> Any:
+    return usage_counters.stats()
+
+@app.get("/idempotency/stats", dependencies=[Depends(get_admin_user)])
+async def get_idempotency_stats() -> Any:
+    return idempotency_cache.stats()
+
+@app.get("/read-routing/stats", dependencies=[Depends(get_admin_user)])
+async def get_read_routing_stats() -> Any:
+    return read_router.stats()
+
 @app.get("/permissions", response_model=List[PermissionRes], dependencies=[Depends(get_admin_user)])
-async def get_permissions(db: Session = Depends(get_db)) -> Any:
-    return db.query(Permission).all()
+async def get_permissions(request: Request, page: PageParams = Depends(page_params), db: AsyncSession = Depends(get_read_db)) -> Any:
+    return await list_response(request, db, select(Permission), Permission.id, page, PermissionRes.model_validate)
+
+@app.get("/users", response_model=List[UserRes], dependencies=[Depends(get_admin_user)])
+async def get_users(request: Request, page: PageParams = Depends(page_params), db: AsyncSession = Depends(get_read_db)) -> Any:
+    return await list_response(request, db, select(User), User.id, page, UserRes.model_validate)
 
 @app.post("/create-permission", response_model=PermissionResponse, dependencies=[Depends(get_admin_user)])
-async def create_permission(permission: PermissionRes, db: Session = Depends(get_db)) -> Any:
+async def create_permission(permission: PermissionRes, db: AsyncSession = Depends(get_async_db)) -> Any:
     permission = Permission(name=permission.name, api_endpoint=permission.api_endpoint, description=permission.description)
     db.add(permission)
-    db.commit()
-    db.refresh(permission)
+    await db.commit()
+    await db.refresh(permission)
+    plan_cache.invalidate()
     return PermissionResponse(message="Permission created successfully", permission=permission)
 
 @app.put("/update-permission/{permission_id}", response_model=PermissionResponse, dependencies=[Depends(get_admin_user)])
-async def update_permission(permission_id: int, permission: PermissionRes, db: Session = Depends(get_db)) -> Any:
-    permissiondb = db.query(Permission).filter(Permission.id == permission_id).first()
+async def update_permission(permission_id: int, permission: PermissionRes, db: AsyncSession = Depends(get_async_db)) -> Any:
+    permissiondb = await db.scalar(select(Permission).filter(Permission.id == permission_id))
     if not permission:
         raise HTTPException(status_code=404, detail="Permission not found")
     if permission.name != "string" and permission.name != permissiondb.name:
@@ -138,51 +306,88 @@ async def update_permission(permission_id: int, permission: PermissionRes, db: S
         permissiondb.api_endpoint = permission.api_endpoint
     if permission.description != "string" and permission.description != permissiondb.description:
         permissiondb.description = permission.description
-    db.commit()
-    db.refresh(permissiondb)
+    await db.commit()
+    await db.refresh(permissiondb)
+    plan_cache.invalidate()
+    entitlement_versions.bump_plan()
     return PermissionResponse(message="Permission updated successfully", permission=permissiondb)
 
 @app.delete("/delete-permission/{permission_id}", dependencies=[Depends(get_admin_user)])
-async def delete_permission(permission_id: int, db: Session = Depends(get_db)) -> Any:
-    plan_permission = db.query(PlanPermission).filter(PlanPermission.api_id == permission_id).all()
-    if plan_permission:
-        for permission in plan_permission:
-            print("Permission:", permission.id)
-            db.delete(permission)
-        db.commit()
-    permission = db.query(Permission).filter(Permission.id == permission_id).first()
+async def delete_permission(permission_id: int, db: AsyncSession = Depends(get_async_db)) -> Any:
+    permission = await db.scalar(select(Permission).filter(Permission.id == permission_id))
     if not permission:
         raise HTTPException(status_code=404, detail="Permission not found")
-    db.delete(permission)
-    db.commit()
+    # Remove the permission's mappings and rate limits in one statement each, in the same transaction as the permission
+    await db.execute(delete(PlanPermission).where(PlanPermission.api_id == permission_id))
+    await db.execute(delete(PlanRateLimit).where(PlanRateLimit.api_id == permission_id))
+    await db.delete(permission)
+    await db.commit()
+    plan_cache.invalidate()
+    entitlement_versions.bump_plan()
     return {"message": "Permission deleted successfully"}
 
 
+# Rate-limit a plan, or one endpoint of it. Replaces any existing limit for the same plan/endpoint.
+@app.post("/set-rate-limit", response_model=RateLimitRes, dependencies=[Depends(get_admin_user)])
+async def set_rate_limit(rate_limit: RateLimitCreate, db: AsyncSession = Depends(get_async_db)) -> Any:
+    plan = await db.scalar(select(Plan).filter(Plan.id == rate_limit.plan_id))
+    if not plan:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    if rate_limit.permission_id is not None:
+        permission = await db.scalar(select(Permission).filter(Permission.id == rate_limit.permission_id))
+        if not permission:
+            raise HTTPException(status_code=404, detail="Permission not found")
+    if rate_limit.permission_id is None:
+        endpoint_filter = PlanRateLimit.api_id.is_(None)
+    else:
+        endpoint_filter = PlanRateLimit.api_id == rate_limit.permission_id
+    plan_rate_limit = await db.scalar(select(PlanRateLimit).filter(PlanRateLimit.plan_id == rate_limit.plan_id, endpoint_filter))
+    if not plan_rate_limit:
+        plan_rate_limit = PlanRateLimit(plan_id=rate_limit.plan_id, api_id=rate_limit.permission_id)
+        db.add(plan_rate_limit)
+    plan_rate_limit.requests_per_second = rate_limit.requests_per_second
+    plan_rate_limit.requests_per_minute = rate_limit.requests_per_minute
+    await db.commit()
+    await db.refresh(plan_rate_limit)
+    plan_cache.invalidate(rate_limit.plan_id)
+    return plan_rate_limit
+
+@app.delete("/delete-rate-limit/{rate_limit_id}", dependencies=[Depends(get_admin_user)])
+async def delete_rate_limit(rate_limit_id: int, db: AsyncSession = Depends(get_async_db)) -> Any:
+    plan_rate_limit = await db.scalar(select(PlanRateLimit).filter(PlanRateLimit.id == rate_limit_id))
+    if not plan_rate_limit:
+        raise HTTPException(status_code=404, detail="Rate limit not found")
+    await db.delete(plan_rate_limit)
+    await db.commit()
+    plan_cache.invalidate(plan_rate_limit.plan_id)
+    return {"message": "Rate limit deleted successfully"}
+
+
 # --------User Subscription Handling-----!!
 
 # POST /subscriptions (Create a Subscription)
 @app.post("/subscriptions", response_model=SubscriptionResponse, dependencies=[Depends(get_current_user)])
-async def create_subscription(subscription_data: SubscriptionCreate, db: Session = Depends(get_db)):
+async def create_subscription(subscription_data: SubscriptionCreate, db: AsyncSession = Depends(get_async_db)):
     # Validate user existence
-    user = db.query(User).filter(User.id == subscription_data.user_id).first()
+    user = await db.scalar(select(User).filter(User.id == subscription_data.user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
     # Validate plan existence
-    plan = db.query(Plan).filter(Plan.id == subscription_data.plan_id).first()
+    plan = await db.scalar(select(Plan).filter(Plan.id == subscription_data.plan_id))
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
 
-    # Check if user already has a subscription
-    existing_subscription = db.query(Subscription).filter(Subscription.user_id == subscription_data.user_id).first()
-    if existing_subscription:
-        raise HTTPException(status_code=400, detail="User already subscribed to a plan")
-
-    # Create new subscription
-    new_subscription = Subscription(user_id=subscription_data.user_id, plan_id=subscription_data.plan_id, usage=0)
+    # Create new subscription in the plan's current billing period; ux_subscription_user_id rejects a second one for the same user
+    new_subscription = Subscription(user_id=subscription_data.user_id, plan_id=subscription_data.plan_id, usage=0,
+                                    period_id=plan_period(plan) or 0)
     db.add(new_subscription)
-    db.commit()
-    db.refresh(new_subscription)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="User already subscribed to a plan")
+    await db.refresh(new_subscription)
 
     return SubscriptionResponse(
         user_id=new_subscription.user_id,
@@ -190,48 +395,61 @@ async def create_subscription(subscription_data: SubscriptionCreate, db: Session
         usage=new_subscription.usage
     )
 
+# List subscriptions, paged by user_id
+@app.get("/subscriptions", response_model=List[SubscriptionResponse], dependencies=[Depends(get_admin_user)])
+async def get_subscriptions(request: Request, page: PageParams = Depends(page_params), db: AsyncSession = Depends(get_read_db)) -> Any:
+    return await list_response(request, db, select(Subscription), Subscription.user_id, page,
+                               SubscriptionResponse.model_validate)
+
 # View User Subscription Details
 @app.get("/subscriptions/{user_id}", response_model=SubscriptionResponse, dependencies=[Depends(get_current_user)])
-def get_subscription(user_id: int, db: Session = Depends(get_db)):
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+async def get_subscription(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    subscription = await db.scalar(select(Subscription).filter(Subscription.user_id == user_id))
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found")
+    plan = await plan_cache.get(subscription.plan_id, db)
 
     return SubscriptionResponse(
         user_id=subscription.user_id,
         plan_id=subscription.plan_id,
-        usage=subscription.usage
+        usage=await usage_counters.usage(subscription, plan, db)
     )
 
 # View User Usage Statistics
 @app.get("/subscriptions/{user_id}/usage", response_model=UsageResponse, dependencies=[Depends(get_current_user)])
-def get_subscription_usage(user_id: int, db: Session = Depends(get_db)):
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+async def get_subscription_usage(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    subscription = await db.scalar(select(Subscription).filter(Subscription.user_id == user_id))
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found")
+    plan = await plan_cache.get(subscription.plan_id, db)
 
     return UsageResponse(
         user_id=subscription.user_id,
-        usage=subscription.usage
+        usage=await usage_counters.usage(subscription, plan, db)
     )
 
 # Assign/Modify User Plan
 @app.put("/subscriptions/{user_id}/{plan_id}", response_model=SubscriptionResponse, dependencies=[Depends(get_admin_user)])
-def update_subscription(user_id: int, plan_id: int, db: Session = Depends(get_db)):
+async def update_subscription(user_id: int, plan_id: int, db: AsyncSession = Depends(get_async_db)):
     # Fetch the user's subscription
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+    subscription = await db.scalar(select(Subscription).filter(Subscription.user_id == user_id))
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found")
 
     # Validate new plan existence
-    plan = db.query(Plan).filter(Plan.id == plan_id).first()
+    plan = await db.scalar(select(Plan).filter(Plan.id == plan_id))
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
 
     # Update the subscription
     subscription.plan_id = plan_id
-    db.commit()
-    db.refresh(subscription)
+    await db.commit()
+    await db.refresh(subscription)
+    usage_buffer.refresh(user_id)
+    rate_limiter.forget_user(user_id)
+    entitlement_versions.bump_user(user_id)
+    # The new plan's limit is checked against the row alone
+    await usage_counters.fold_user(user_id)
 
     return SubscriptionResponse(
         user_id=subscription.user_id,
@@ -243,23 +461,19 @@ def update_subscription(user_id: int, plan_id: int, db: Session = Depends(get_db
 
 # Return the number of api requests made by the user by including the plan details. 
 @app.get("/access/{user_id}/{api_request}", response_model=AccessControlResponse, dependencies=[Depends(get_current_user)])
-def check_access_permission(user_id: int, api_request: str, db: Session = Depends(get_db)):
+async def check_access_permission(user_id: int, api_request: str, db: AsyncSession = Depends(get_read_db)):
     # Fetch the user's subscription
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+    subscription = await db.scalar(select(Subscription).filter(Subscription.user_id == user_id))
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found for the user")
 
-    # Fetch the plan details
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    # Fetch the plan details and its compiled endpoint matcher
+    plan = await plan_cache.get(subscription.plan_id, db)
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found for the subscription")
 
-    # Fetch the allowed endpoints for the plan
-    allowed_endpoints = db.query(Permission).join(PlanPermission, Permission.id == PlanPermission.api_id) \
-                        .filter(PlanPermission.plan_id == subscription.plan_id).all()
-    
     # Check if the requested API is within the allowed endpoints
-    endpoint_match = next((ep for ep in allowed_endpoints if ep.api_endpoint.strip("/") in api_request), None)
+    endpoint_match = plan.matcher.match(api_request)
 
     # Determine access status
     access_status = "You have access to this endpoint" if endpoint_match else "You don't have access to this endpoint"
@@ -269,7 +483,7 @@ def check_access_permission(user_id: int, api_request: str, db: Session = Depend
         access_status=access_status,
         plan_name=plan.name,
         plan_description=plan.description,
-        accessible_endpoints=[{"name": ep.name, "endpoint": ep.api_endpoint} for ep in allowed_endpoints]
+        accessible_endpoints=[{"name": name, "endpoint": endpoint} for name, endpoint in plan.endpoints]
     )
     return response
 
@@ -277,33 +491,67 @@ def check_access_permission(user_id: int, api_request: str, db: Session = Depend
 
 # Return the plan limit subscribed by the user along with how many attempts left for the user.
 @app.get("/usage/{user_id}", dependencies=[Depends(get_current_user)])
-def track_api_request(user_id: int, db: Session = Depends(get_db)):
+async def track_api_request(user_id: int, db: AsyncSession = Depends(get_read_db)):
     # Fetch the user's subscription
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
+    subscription = await db.scalar(select(Subscription).filter(Subscription.user_id == user_id))
     if not subscription:
         raise HTTPException(status_code=404, detail="Subscription not found for the user")
 
     # Fetch the plan details
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
+    plan = await db.scalar(select(Plan).filter(Plan.id == subscription.plan_id))
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found for the subscription")
     
-    # Calculate remaining attempts (if usage limit is not unlimited)
+    # Calculate remaining attempts (if usage limit is not unlimited) in the current billing period
+    usage = await usage_counters.usage(subscription, plan, db)
     if plan.usage_limit != 0:
-        remaining_attempts = plan.usage_limit - subscription.usage
+        remaining_attempts = plan.usage_limit - usage
     else:
         remaining_attempts = "Unlimited"  # If the plan has unlimited usage
 
     # Return the number of API requests made by the user and the plan details
     response = {
         "user_id": user_id,
-        "api_request_count": subscription.usage, 
+        "api_request_count": usage, 
         "plan_name": plan.name,
         "plan_description": plan.description,
         "usage_limit": plan.usage_limit,
         "remaining_attempts": remaining_attempts
     }
+    if plan.billing_period:
+        previous = previous_usage(subscription, plan)
+        response["billing_period"] = plan.billing_period
+        response["period_start"] = period_start(plan_period(plan))
+        response["previous_period"] = {"period_start": period_start(previous[0]), "api_request_count": previous[1]} if previous else None
     
     return response
 
-
+# Calls per endpoint per hour or day for the user, read from the rollups only.
+# Defaults to the last 24 hours (hour) or 30 days (day).
+@app.get("/usage/{user_id}/history", response_model=UsageHistoryResponse, dependencies=[Depends(get_current_user)])
+async def get_usage_history(
+    user_id: int,
+    from_: datetime = Query(None, alias="from"),
+    to: datetime = Query(None),
+    granularity: str = Query("hour", pattern="^(hour|day)$"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    # Rollups are stored as naive UTC
+    to = to.astimezone(timezone.utc).replace(tzinfo=None) if to and to.tzinfo else (to or datetime.utcnow())
+    if from_ is None:
+        from_ = to - (timedelta(hours=24) if granularity == "hour" else timedelta(days=30))
+    elif from_.tzinfo:
+        from_ = from_.astimezone(timezone.utc).replace(tzinfo=None)
+
+    rows = await db.execute(
+        select(UsageRollup.bucket_start, Permission.api_endpoint, UsageRollup.count)
+        .outerjoin(Permission, Permission.id == UsageRollup.api_id)
+        .where(UsageRollup.user_id == user_id, UsageRollup.granularity == granularity,
+               UsageRollup.bucket_start >= bucket_start(from_, granularity), UsageRollup.bucket_start < to)
+        .order_by(UsageRollup.bucket_start, UsageRollup.api_id)
+    )
+    return UsageHistoryResponse(
+        user_id=user_id,
+        granularity=granularity,
+        usage=[UsageHistoryEntry(bucket_start=row.bucket_start, endpoint=row.api_endpoint, count=row.count) for row in rows]
+    )
@@ -1,26 +1,114 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
 from fastapi import Depends, HTTPException, APIRouter
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
 from models import User  
-from database import get_db  
+from database import get_async_db  
 from passlib.context import CryptContext
-from typing import Any, Annotated
+from typing import Any, Annotated, Dict, Optional, Set
 from schemas import UserCreate
+from entitlements import Entitlements, AUTH_ENTITLEMENT_CLAIMS
+
+logger = logging.getLogger(__name__)
 
 # Constants for JWT
 SECRET_KEY = "123456789101112"  
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified-principal cache settings
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+# Build the principal from the signed username/role claims without looking the user up
+AUTH_TRUST_ROLE_CLAIM = os.getenv("AUTH_TRUST_ROLE_CLAIM", "false").lower() == "true"
+
+# Password hashing settings. bcrypt releases the GIL, so a small thread pool keeps it off the event loop.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Hash/verify calls allowed in the pool (running plus queued) before new ones are rejected
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+
 # Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # OAuth2 Bearer Token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+# Authenticated caller as seen by the routes. id is None when built from token claims alone;
+# entitlements are set when the token carries entitlement claims (see entitlements.py).
+class Principal:
+    __slots__ = ("id", "username", "role", "entitlements")
+
+    def __init__(self, id: Optional[int], username: str, role: str, entitlements: Optional[Entitlements] = None):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.entitlements = entitlements
+
+
+# Bounded LRU of verified principals keyed by token. Entries never outlive the token's exp.
+class PrincipalCache:
+    def __init__(self, max_size: int = PRINCIPAL_CACHE_SIZE, ttl: float = PRINCIPAL_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+
+    def get(self, token: str) -> Optional[Principal]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        principal, expires_at = entry
+        if expires_at <= time.time():
+            self._remove(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return principal
+
+    def put(self, token: str, principal: Principal, token_exp: float) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[token] = (principal, min(time.time() + self.ttl, token_exp))
+        self._entries.move_to_end(token)
+        self._tokens_by_user.setdefault(principal.username, set()).add(token)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    # Drop every cached token of a user, e.g. after the user is deleted or their role changes
+    def invalidate_user(self, username: str) -> None:
+        for token in self._tokens_by_user.pop(username, ()):
+            self._entries.pop(token, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _remove(self, token: str) -> None:
+        principal, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(principal.username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[principal.username]
+
+
+principal_cache = PrincipalCache()
+
+
 # Hashing the password
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -29,32 +117,90 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# Bounded executor for password hashing and verification, with per-operation latency stats
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        # operation -> [count, total_seconds, max_seconds]
+        self.timings: Dict[str, list] = {"hash": [0, 0.0, 0.0], "verify": [0, 0.0, 0.0]}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+
+    async def _run(self, operation: str, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many concurrent authentication requests", headers={"Retry-After": "1"})
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+            elapsed = time.perf_counter() - started
+            timing = self.timings[operation]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "bcrypt_rounds": BCRYPT_ROUNDS,
+            **{
+                operation: {"count": count, "avg_seconds": total / count if count else 0.0, "max_seconds": maximum}
+                for operation, (count, total, maximum) in self.timings.items()
+            },
+        }
+
+
+password_hasher = PasswordHasher()
+
 # Create access token
 def create_access_token(data: dict, expires_delta: timedelta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + expires_delta
     to_encode.update({"exp": expire})
     token = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    print("Token created:", token)  # Add logging
+    logger.debug("Token issued", extra={"username": data.get("username"), "role": data.get("role"), "expires_at": expire.isoformat()})
     return token
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)) -> User:
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)) -> Principal:
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        print("Payload:", payload)  # Add logging
+        logger.debug("Token decoded", extra={"username": payload.get("username"), "role": payload.get("role")})
         username = payload.get("username")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = db.query(User).filter(User.username == username).first()
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        entitlements = Entitlements.from_claims(payload) if AUTH_ENTITLEMENT_CLAIMS else None
+        if AUTH_TRUST_ROLE_CLAIM and payload.get("role") is not None:
+            principal = Principal(None, username, payload["role"], entitlements)
+        else:
+            user = await db.scalar(select(User).filter(User.username == username))
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            principal = Principal(user.id, user.username, user.role, entitlements)
+        principal_cache.put(token, principal, payload.get("exp", 0))
+        return principal
     except JWTError as e:
-        print("JWTError:", e)  # Add logging
+        logger.debug("Token rejected: %s", str(e))
         raise HTTPException(status_code=401, detail="Invalid token")
     
-def get_admin_user(current_user: Annotated[UserCreate, Depends(get_current_user)]):
+def get_admin_user(current_user: Annotated[Principal, Depends(get_current_user)]):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import case, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models import BillingSweepProgress, Plan, Subscription
+from plan_cache import plan_cache
+
+logger = logging.getLogger(__name__)
+
+# ----Billing Periods----!!
+# A plan may reset usage every day, week or month (Plan.billing_period, NULL = never).
+# Periods are calendar-aligned in UTC and identified by the day number (days since
+# 1970-01-01) of their first day, so a later period always has a larger id, whatever
+# the plan's period length.
+#
+# subscription.period_id is the period its usage counts. Nothing has to reset a row
+# when a period ends: the metered debit rolls a row whose period_id is behind its
+# plan's current one in the same conditional UPDATE (previous_period_id and
+# previous_usage keep the closed period, usage restarts from the units debited), and
+# the reads report 0 for such a row. Buffered accounting keys its counters by user and
+# period, so a new period starts a fresh counter.
+#
+# The sweeper below rolls the remaining rows over in the background, plan by plan, in
+# small chunks ordered by subscription id, each its own short transaction, pausing
+# between chunks. Progress per plan is kept in billing_sweep_progress, so a restart
+# resumes where it stopped and concurrent workers claim distinct chunks.
+
+BILLING_PERIODS = ("day", "week", "month")
+BILLING_SWEEP_ENABLED = os.getenv("BILLING_SWEEP_ENABLED", "true").lower() == "true"
+BILLING_SWEEP_INTERVAL_SECONDS = float(os.getenv("BILLING_SWEEP_INTERVAL_SECONDS", "60"))
+# Subscriptions per chunk transaction
+BILLING_SWEEP_CHUNK_SIZE = int(os.getenv("BILLING_SWEEP_CHUNK_SIZE", "500"))
+# Pause between chunks, which leaves the rows to the metered calls
+BILLING_SWEEP_PAUSE_SECONDS = float(os.getenv("BILLING_SWEEP_PAUSE_SECONDS", "0.05"))
+
+_EPOCH = date(1970, 1, 1)
+
+
+def _first_day(billing_period: str, day: date) -> date:
+    if billing_period == "month":
+        return day.replace(day=1)
+    if billing_period == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+# Id of the period of the given length that contains now (UTC)
+def period_of(billing_period: str, now: Optional[datetime] = None) -> int:
+    return (_first_day(billing_period, (now or datetime.utcnow()).date()) - _EPOCH).days
+
+
+def period_start(period_id: int) -> date:
+    return _EPOCH + timedelta(days=period_id)
+
+
+# Current period id of a plan (Plan or PlanEntry), None when its usage never resets
+def plan_period(plan) -> Optional[int]:
+    return period_of(plan.billing_period) if plan.billing_period else None
+
+
+# "none" (or nothing) clears the billing period
+def stored_billing_period(billing_period: Optional[str]) -> Optional[str]:
+    return None if billing_period in (None, "none") else billing_period
+
+
+# Usage the row counts in its plan's current period
+def current_usage(subscription: Subscription, plan) -> int:
+    period = plan_period(plan) if plan else None
+    if period is not None and subscription.period_id < period:
+        return 0
+    return subscription.usage
+
+
+# (period id, usage) of the last closed period of the row, if any
+def previous_usage(subscription: Subscription, plan) -> Optional[Tuple[int, int]]:
+    period = plan_period(plan) if plan else None
+    if period is not None and subscription.period_id < period:
+        # Not rolled over yet: the stored usage is the closed period's
+        return (subscription.period_id, subscription.usage) if subscription.period_id else None
+    if subscription.previous_period_id:
+        return subscription.previous_period_id, subscription.previous_usage
+    return None
+
+
+# ----Period-aware Debit----!!
+
+# Current period of each of the plans that has a billing period
+async def current_periods(plan_ids: Iterable[int], db: AsyncSession) -> Dict[int, int]:
+    periods = {}
+    for plan_id in plan_ids:
+        plan = await plan_cache.get(plan_id, db)
+        if plan is not None and plan.billing_period:
+            periods[plan_id] = period_of(plan.billing_period)
+    return periods
+
+
+# The current period of a subscription row on one of plan_ids: a plain value when they
+# all share one, else by plan_id. Rows of plans without a billing period keep their own.
+def period_expression(periods: Dict[int, int], plan_ids: Iterable[int]):
+    values = set(periods.values())
+    if len(values) == 1 and set(plan_ids) <= set(periods):
+        return values.pop()
+    return case(periods, value=Subscription.plan_id, else_=Subscription.period_id)
+
+
+# Usage of the row in the given period (0 while the row is behind it)
+def usage_expression(current):
+    return case((Subscription.period_id < current, 0), else_=Subscription.usage)
+
+
+# SET clauses debiting units in the given period, closing the row's period first when it
+# is behind. For Update.ordered_values: MySQL evaluates the assignments left to right and
+# later ones see the earlier results, so each column is assigned after its last use.
+def debit_values(current, units) -> List[tuple]:
+    behind = Subscription.period_id < current
+    return [
+        (Subscription.previous_usage, case((behind, Subscription.usage), else_=Subscription.previous_usage)),
+        (Subscription.previous_period_id, case((behind, Subscription.period_id), else_=Subscription.previous_period_id)),
+        (Subscription.usage, case((behind, units), else_=Subscription.usage + units)),
+        (Subscription.period_id, case((behind, current), else_=Subscription.period_id)),
+    ]
+
+
+# ----Background Sweep----!!
+
+class BillingPeriodSweeper:
+    def __init__(self, interval: float = BILLING_SWEEP_INTERVAL_SECONDS, chunk_size: int = BILLING_SWEEP_CHUNK_SIZE,
+                 pause: float = BILLING_SWEEP_PAUSE_SECONDS):
+        self.enabled = False
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.sweeps = 0
+        self.chunks = 0
+        self.rows_reset = 0
+        self.errors = 0
+        self.last_sweep_rows = 0
+        self.last_sweep_seconds = 0.0
+        # Time in the chunk UPDATEs, which includes waiting for row locks held by metered calls
+        self.update_seconds_total = 0.0
+        self.update_seconds_max = 0.0
+        # Longest a chunk kept its rows locked (UPDATE to commit), i.e. the longest a metered call can wait on it
+        self.lock_hold_seconds_max = 0.0
+        self._session_factory = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, session_factory) -> None:
+        self.enabled = True
+        self._session_factory = session_factory
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.enabled = False
+
+    async def _run(self) -> None:
+        while True:
+            await self.sweep()
+            await asyncio.sleep(self.interval)
+
+    # Roll every subscription behind its plan's current period over. Returns the rows reset.
+    async def sweep(self) -> int:
+        started = time.perf_counter()
+        rows = 0
+        try:
+            async with self._session_factory() as session:
+                plans = (await session.execute(
+                    select(Plan.id, Plan.billing_period).where(Plan.billing_period.in_(BILLING_PERIODS)).order_by(Plan.id)
+                )).all()
+            for plan in plans:
+                current = period_of(plan.billing_period)
+                while True:
+                    reset = await self._sweep_chunk(plan.id, current)
+                    if reset is None:
+                        break
+                    rows += reset
+                    await asyncio.sleep(self.pause)
+        except Exception:
+            self.errors += 1
+            logger.exception("Billing period sweep failed")
+        self.sweeps += 1
+        self.last_sweep_rows = rows
+        self.last_sweep_seconds = time.perf_counter() - started
+        return rows
+
+    # Reset the plan's next chunk of subscriptions for the period. Returns the rows reset,
+    # None once the plan has been swept for the period.
+    async def _sweep_chunk(self, plan_id: int, current: int) -> Optional[int]:
+        async with self._session_factory() as session:
+            progress = (await session.execute(
+                select(BillingSweepProgress.period_id, BillingSweepProgress.last_subscription_id)
+                .where(BillingSweepProgress.plan_id == plan_id)
+            )).first()
+            if progress is None:
+                session.add(BillingSweepProgress(plan_id=plan_id, period_id=current, last_subscription_id=0))
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Another worker started the plan's sweep first
+                    await session.rollback()
+                return 0
+            if progress.period_id != current:
+                # A new period: start the plan over, unless another worker already did
+                await session.execute(
+                    update(BillingSweepProgress)
+                    .where(BillingSweepProgress.plan_id == plan_id, BillingSweepProgress.period_id == progress.period_id)
+                    .values(period_id=current, last_subscription_id=0)
+                )
+                await session.commit()
+                return 0
+
+            last_id = progress.last_subscription_id
+            ids = (await session.scalars(
+                select(Subscription.id).where(Subscription.plan_id == plan_id, Subscription.id > last_id)
+                .order_by(Subscription.id).limit(self.chunk_size)
+            )).all()
+            if not ids:
+                return None
+
+            # Claim the chunk: the conditional UPDATE locks the progress row, and another
+            # worker that already took the chunk leaves nothing to match
+            claimed = await session.execute(
+                update(BillingSweepProgress)
+                .where(BillingSweepProgress.plan_id == plan_id, BillingSweepProgress.period_id == current,
+                       BillingSweepProgress.last_subscription_id == last_id)
+                .values(last_subscription_id=ids[-1])
+            )
+            if not claimed.rowcount:
+                await session.rollback()
+                return 0
+
+            started = time.perf_counter()
+            result = await session.execute(
+                update(Subscription)
+                .where(Subscription.plan_id == plan_id, Subscription.id > last_id, Subscription.id <= ids[-1],
+                       Subscription.period_id < current)
+                .ordered_values(*debit_values(current, 0))
+                .execution_options(synchronize_session=False)
+            )
+            updated = time.perf_counter()
+            await session.commit()
+            committed = time.perf_counter()
+
+        self.chunks += 1
+        self.rows_reset += result.rowcount
+        self.update_seconds_total += updated - started
+        self.update_seconds_max = max(self.update_seconds_max, updated - started)
+        self.lock_hold_seconds_max = max(self.lock_hold_seconds_max, committed - started)
+        return result.rowcount
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "interval_seconds": self.interval,
+            "chunk_size": self.chunk_size,
+            "pause_seconds": self.pause,
+            "sweeps": self.sweeps,
+            "chunks": self.chunks,
+            "rows_reset": self.rows_reset,
+            "errors": self.errors,
+            "last_sweep_rows": self.last_sweep_rows,
+            "last_sweep_seconds": self.last_sweep_seconds,
+            "last_sweep_rows_per_second": self.last_sweep_rows / self.last_sweep_seconds if self.last_sweep_seconds else 0.0,
+            "update_seconds_total": self.update_seconds_total,
+            "update_seconds_max": self.update_seconds_max,
+            "lock_hold_seconds_max": self.lock_hold_seconds_max,
+        }
+
+
+billing_sweeper = BillingPeriodSweeper()
@@ -0,0 +1,172 @@
+import json
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Type
+from auth import get_admin_user
+from database import get_async_db
+from models import Plan, Permission, PlanPermission, Subscription, User
+from plan_cache import plan_cache
+from entitlements import entitlement_versions
+from billing_periods import period_of, stored_billing_period
+from schemas import PlanCreate, PermissionCreate, PlanPermissionCreate, SubscriptionCreate, BulkError, BulkResult
+
+# ----Bulk Admin APIs----!!
+# Catalogue onboarding in one request per table: the body is a JSON array or NDJSON
+# (one object per line), references are validated with set-based queries, valid rows
+# are written with multi-row INSERTs in a single transaction and invalid ones are
+# reported per item. The reference checks run before the INSERT, so a concurrent request
+# can still commit a conflicting row in between; the unique indexes and foreign keys then
+# reject the transaction, and the items are checked again against the committed rows.
+
+router = APIRouter(prefix="/bulk", dependencies=[Depends(get_admin_user)])
+
+# Rows per INSERT statement
+BULK_INSERT_CHUNK_SIZE = 1000
+
+
+# Parse and validate the request body, returning the valid items with their index and the item errors
+async def _read_items(request: Request, model: Type[BaseModel]) -> Tuple[List[Tuple[int, Any]], List[BulkError]]:
+    body = await request.body()
+    errors = []
+    if request.headers.get("content-type", "").startswith("application/x-ndjson") or not body.lstrip().startswith(b"["):
+        raw_items = []
+        for index, line in enumerate(line for line in body.splitlines() if line.strip()):
+            try:
+                raw_items.append((index, json.loads(line)))
+            except ValueError as e:
+                errors.append(BulkError(index=index, detail=f"Invalid JSON: {e}"))
+    else:
+        try:
+            raw_items = list(enumerate(json.loads(body)))
+        except ValueError as e:
+            return [], [BulkError(index=0, detail=f"Invalid JSON: {e}")]
+
+    items = []
+    for index, raw in raw_items:
+        try:
+            items.append((index, model.model_validate(raw)))
+        except ValidationError as e:
+            errors.append(BulkError(index=index, detail="; ".join(
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+            )))
+    return items, errors
+
+
+# Insert the rows and commit; False (rolled back) when a constraint rejected them
+async def _insert_rows(db: AsyncSession, model, rows: List[Dict[str, Any]]) -> bool:
+    try:
+        for i in range(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+            await db.execute(insert(model), rows[i:i + BULK_INSERT_CHUNK_SIZE])
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return False
+    return True
+
+
+# Check the items and insert the valid rows. When a row committed since the check rejects
+# the INSERT, check again so the conflicting items are reported as item errors
+async def _check_and_insert(db: AsyncSession, model, items: List[Tuple[int, Any]],
+                            check: Callable[[AsyncSession, List[Tuple[int, Any]]], Awaitable[Tuple[List[Dict[str, Any]], List[BulkError]]]],
+                            ) -> Tuple[List[Dict[str, Any]], List[BulkError]]:
+    for _ in range(2):
+        rows, errors = await check(db, items)
+        if not rows or await _insert_rows(db, model, rows):
+            return rows, errors
+    raise HTTPException(status_code=409, detail="Conflicting concurrent changes, retry the request")
+
+
+def _result(created: int, errors: List[BulkError]) -> BulkResult:
+    return BulkResult(created=created, errors=sorted(errors, key=lambda error: error.index))
+
+
+@router.post("/plans", response_model=BulkResult)
+async def bulk_create_plans(request: Request, db: AsyncSession = Depends(get_async_db)) -> Any:
+    items, errors = await _read_items(request, PlanCreate)
+    rows = [{**item.model_dump(), "billing_period": stored_billing_period(item.billing_period)} for _, item in items]
+    if rows:
+        if not await _insert_rows(db, Plan, rows):
+            raise HTTPException(status_code=409, detail="Conflicting concurrent changes, retry the request")
+        plan_cache.invalidate()
+    return _result(len(rows), errors)
+
+
+@router.post("/permissions", response_model=BulkResult)
+async def bulk_create_permissions(request: Request, db: AsyncSession = Depends(get_async_db)) -> Any:
+    items, errors = await _read_items(request, PermissionCreate)
+    rows = [item.model_dump() for _, item in items]
+    if rows:
+        if not await _insert_rows(db, Permission, rows):
+            raise HTTPException(status_code=409, detail="Conflicting concurrent changes, retry the request")
+        plan_cache.invalidate()
+    return _result(len(rows), errors)
+
+
+async def _check_mappings(db: AsyncSession, items: List[Tuple[int, PlanPermissionCreate]]) -> Tuple[List[Dict[str, Any]], List[BulkError]]:
+    errors = []
+    plan_ids = {item.plan_id for _, item in items}
+    permission_ids = {item.permission_id for _, item in items}
+    existing_plans = set((await db.scalars(select(Plan.id).where(Plan.id.in_(plan_ids)))).all()) if plan_ids else set()
+    existing_permissions = set((await db.scalars(select(Permission.id).where(Permission.id.in_(permission_ids)))).all()) if permission_ids else set()
+    mapped = set((await db.execute(
+        select(PlanPermission.plan_id, PlanPermission.api_id).where(PlanPermission.plan_id.in_(existing_plans))
+    )).tuples().all()) if existing_plans else set()
+
+    rows = []
+    for index, item in items:
+        if item.plan_id not in existing_plans:
+            errors.append(BulkError(index=index, detail="Plan not found"))
+        elif item.permission_id not in existing_permissions:
+            errors.append(BulkError(index=index, detail="Permission not found"))
+        elif (item.plan_id, item.permission_id) in mapped:
+            errors.append(BulkError(index=index, detail="Permission already mapped to plan"))
+        else:
+            mapped.add((item.plan_id, item.permission_id))
+            rows.append({"plan_id": item.plan_id, "api_id": item.permission_id})
+    return rows, errors
+
+
+@router.post("/mappings", response_model=BulkResult)
+async def bulk_map_permissions(request: Request, db: AsyncSession = Depends(get_async_db)) -> Any:
+    items, errors = await _read_items(request, PlanPermissionCreate)
+    rows, item_errors = await _check_and_insert(db, PlanPermission, items, _check_mappings)
+    for plan_id in {row["plan_id"] for row in rows}:
+        plan_cache.invalidate(plan_id)
+        entitlement_versions.bump_plan(plan_id)
+    return _result(len(rows), errors + item_errors)
+
+
+async def _check_subscriptions(db: AsyncSession, items: List[Tuple[int, SubscriptionCreate]]) -> Tuple[List[Dict[str, Any]], List[BulkError]]:
+    errors = []
+    user_ids = {item.user_id for _, item in items}
+    plan_ids = {item.plan_id for _, item in items}
+    existing_users = set((await db.scalars(select(User.id).where(User.id.in_(user_ids)))).all()) if user_ids else set()
+    # Plan id -> billing period, so new subscriptions start in their plan's current period
+    existing_plans = dict((await db.execute(select(Plan.id, Plan.billing_period).where(Plan.id.in_(plan_ids)))).all()) if plan_ids else {}
+    subscribed = set((await db.scalars(select(Subscription.user_id).where(Subscription.user_id.in_(existing_users)))).all()) if existing_users else set()
+
+    rows = []
+    for index, item in items:
+        if item.user_id not in existing_users:
+            errors.append(BulkError(index=index, detail="User not found"))
+        elif item.plan_id not in existing_plans:
+            errors.append(BulkError(index=index, detail="Plan not found"))
+        elif item.user_id in subscribed:
+            errors.append(BulkError(index=index, detail="User already subscribed to a plan"))
+        else:
+            subscribed.add(item.user_id)
+            billing_period = existing_plans[item.plan_id]
+            rows.append({"user_id": item.user_id, "plan_id": item.plan_id, "usage": 0,
+                         "period_id": period_of(billing_period) if billing_period else 0})
+    return rows, errors
+
+
+@router.post("/subscriptions", response_model=BulkResult)
+async def bulk_create_subscriptions(request: Request, db: AsyncSession = Depends(get_async_db)) -> Any:
+    items, errors = await _read_items(request, SubscriptionCreate)
+    rows, item_errors = await _check_and_insert(db, Subscription, items, _check_subscriptions)
+    return _result(len(rows), errors + item_errors)
@@ -1,81 +1,106 @@
-from fastapi import APIRouter, Depends
-from utility import check_access_and_usage, increment_usage
-from sqlalchemy.orm import Session
-from database import get_db, get_async_db
-from auth import get_current_user
+import os
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.concurrency import run_in_threadpool
+from auth import Principal, get_current_user
+from database import get_async_db
+from endpoint_matcher import normalize_path
+from entitlements import authorize_from_claims
+from idempotency import abandon_call, begin_call, idempotency_cache, respond, IDEMPOTENCY_KEY_MAX_LENGTH
+from metering import meter, metering_table
+from quota import QuotaResult
+from schemas import BatchRequest, BatchResponse, BatchOperationResult
+from utility import meter_calls, denied_endpoints, QUOTA_ERRORS
 
 router = APIRouter(prefix="/cloud-services")
 
-# 1. Storage Bucket: Create a new storage bucket
-@router.post("/create-bucket", dependencies=[Depends(get_current_user)])
-async def create_bucket(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/create-bucket", db)
-    # Simulate bucket creation logic here (e.g., adding to database, etc.)
-    await increment_usage(user_id, async_db)
-    return {"message": "Bucket created successfully"}
+# Metered services: (method, path, response message). Each path is also the api_endpoint
+# the plans grant, and every route is charged through the same meter() dependency.
+CLOUD_SERVICES = [
+    # Storage Bucket: create, view and delete a storage bucket
+    ("POST", "/create-bucket", "Bucket created successfully"),
+    ("GET", "/get-bucket", "Bucket details fetched successfully"),
+    ("DELETE", "/delete-bucket", "Bucket deleted successfully"),
+    # Virtual Machine: create, view and delete a virtual machine
+    ("POST", "/create-vm", "Virtual machine created successfully"),
+    ("GET", "/get-vm", "Details of virtual machine fetched successfully"),
+    ("DELETE", "/delete-vm", "Virtual machine deleted successfully."),
+    # Logs: create, view and delete a log file
+    ("POST", "/create-logs", "Log file created successfully."),
+    ("GET", "/get-logs", "Details of log file fetched successfully"),
+    ("DELETE", "/delete-logs", "Log file deleted successfully."),
+]
 
-# 2. Storage Bucket: View an existing storage bucket
-@router.get("/get-bucket", dependencies=[Depends(get_current_user)])
-async def get_bucket(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/get-bucket", db)
-    # Simulate bucket retrieval logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Bucket details fetched successfully"}
 
-# 3. Storage Bucket: Delete a storage bucket
-@router.delete("/delete-bucket", dependencies=[Depends(get_current_user)])
-async def delete_bucket(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/delete-bucket", db)
-    # Simulate bucket deletion logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Bucket deleted successfully"}
+def _service(message: str):
+    # Simulate the service logic here (e.g. provisioning the resource); the request is
+    # already authorized and charged, see request.state.metering. A replayed
+    # Idempotency-Key gets the first response back instead.
+    async def service(request: Request, response: Response, db: AsyncSession = Depends(get_async_db)):
+        return await respond(request, {"message": message}, db, response)
+    return service
 
-# 4. Virtual Machine: Create a new virtual machine
-@router.post("/create-vm", dependencies=[Depends(get_current_user)])
-async def create_vm(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/create-vm", db)
-    # Simulate VM creation logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Virtual machine created successfully"}
 
-# 5. Virtual Machine: View details of an existing virtual machine
-@router.get("/get-vm", dependencies=[Depends(get_current_user)])
-async def get_vm(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/get-vm", db)
-    # Simulate VM retrieval logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Details of virtual machine fetched successfully"}
+for method, path, message in CLOUD_SERVICES:
+    router.add_api_route(
+        path, _service(message), methods=[method],
+        name=path.strip("/").replace("-", "_"),
+        dependencies=[Depends(meter(path))],
+    )
 
-# 6. Virtual Machine: Delete an existing virtual machine
-@router.delete("/delete-vm", dependencies=[Depends(get_current_user)])
-async def delete_vm(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/delete-vm", db)
-    # Simulate VM deletion logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Virtual machine deleted successfully."}
 
-# 7. Logs: Create a new log file
-@router.post("/create-logs", dependencies=[Depends(get_current_user)])
-async def create_logs(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/create-logs", db)
-    # Simulate log creation logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Log file created successfully."}
+# ----Batch Operations----!!
+# Many operations in one request: authenticated once, authorized against the plan in one
+# pass and charged one unit each with a single conditional UPDATE. Either every operation
+# is accepted or the whole batch is rejected and nothing is debited. An Idempotency-Key
+# covers the whole batch: reusing it with a different body is a 422.
 
-# 8. Logs: View an existing log file
-@router.get("/get-logs", dependencies=[Depends(get_current_user)])
-async def get_logs(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/get-logs", db)
-    # Simulate log retrieval logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Details of log file fetched successfully"}
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "1000"))
+_services = {normalize_path(path): (path, message) for _, path, message in CLOUD_SERVICES}
 
-# 9. Logs: Delete an existing log file
-@router.delete("/delete-logs", dependencies=[Depends(get_current_user)])
-async def delete_logs(user_id: int, db: Session = Depends(get_db), async_db: AsyncSession = Depends(get_async_db)):
-    await run_in_threadpool(check_access_and_usage, user_id, "/delete-logs", db)
-    # Simulate log deletion logic
-    await increment_usage(user_id, async_db)
-    return {"message": "Log file deleted successfully."}
+
+@router.post("/batch", response_model=BatchResponse)
+async def batch_operations(batch: BatchRequest, request: Request, response: Response,
+                           principal: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_async_db),
+                           idempotency_key: Optional[str] = Header(None, min_length=1, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)):
+    if len(batch.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"A batch can hold at most {BATCH_MAX_OPERATIONS} operations")
+    services = [_services.get(normalize_path(operation.operation)) for operation in batch.operations]
+    unknown = [index for index, service in enumerate(services) if service is None]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown operation at index {', '.join(map(str, unknown))}")
+
+    if idempotency_key is not None and idempotency_cache.enabled:
+        call = await begin_call(request, batch.user_id, idempotency_key, db, batch.model_dump_json().encode())
+        if call.replay is not None:
+            return call.replay.response()
+
+    api_endpoints = [path for path, _ in services]
+    # Any failure from here on, a stale token's 401 included, gives the key's claim up
+    try:
+        if not metering_table.is_current():
+            await metering_table.load(db)
+        plan_id = authorize_from_claims(principal.entitlements, batch.user_id, metering_table.permission_ids(api_endpoints))
+        result = await meter_calls(batch.user_id, api_endpoints, db, response, plan_id)
+    except BaseException:
+        await abandon_call(request, db)
+        raise
+    if result != QuotaResult.ALLOWED:
+        await abandon_call(request, db)
+        status_code, detail = QUOTA_ERRORS[result]
+        denied = await denied_endpoints(batch.user_id, api_endpoints, db) if result == QuotaResult.DENIED else set()
+        results = [
+            BatchOperationResult(index=index, operation=path, status=status_code, message=detail) if path in denied
+            else BatchOperationResult(index=index, operation=path, status=424, message="Not executed: the batch was rejected")
+            for index, (path, _) in enumerate(services)
+        ]
+        raise HTTPException(status_code=status_code, detail={"message": detail, "results": [r.model_dump() for r in results]})
+
+    return await respond(request, BatchResponse(
+        user_id=batch.user_id,
+        units=len(services),
+        results=[
+            BatchOperationResult(index=index, operation=path, status=200, message=message)
+            for index, (path, message) in enumerate(services)
+        ],
+    ), db, response)
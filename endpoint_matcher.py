@@ -0,0 +1,82 @@
+from typing import Dict, Iterable, List, Optional
+
+# ----Endpoint Matching----!!
+# A plan's endpoints are compiled once into a matcher: plain endpoints go into a hashed
+# set of normalized paths, and patterns go into a path-segment trie. Matching is a set
+# lookup plus a walk bounded by the path depth, however many endpoints the plan has.
+#
+# Pattern segments:
+#   "*" or "{name}"  matches exactly one segment, e.g. "/get-bucket/{bucket_id}"
+#   "**"             as the last segment, matches the rest of the path, e.g. "/logs/**"
+
+SEGMENT_WILDCARDS = ("*",)
+REST_WILDCARD = "**"
+
+
+# Strip leading/trailing slashes and collapse repeated ones: "/create-vm/" -> "create-vm"
+def normalize_path(path: str) -> str:
+    return "/".join(segment for segment in path.split("/") if segment)
+
+
+def _is_segment_wildcard(segment: str) -> bool:
+    return segment in SEGMENT_WILDCARDS or (segment.startswith("{") and segment.endswith("}"))
+
+
+class _Node:
+    __slots__ = ("children", "wildcard", "terminal", "rest")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.wildcard: Optional["_Node"] = None
+        self.terminal = False
+        # A "**" pattern ends here, so any remainder matches
+        self.rest = False
+
+
+class EndpointMatcher:
+    __slots__ = ("_exact", "_root", "_has_patterns")
+
+    def __init__(self, endpoints: Iterable[str] = ()):
+        self._exact = set()
+        self._root = _Node()
+        self._has_patterns = False
+        for endpoint in endpoints:
+            self.add(endpoint)
+
+    def add(self, endpoint: str) -> None:
+        segments = normalize_path(endpoint).split("/")
+        if not any(_is_segment_wildcard(segment) or segment == REST_WILDCARD for segment in segments):
+            self._exact.add("/".join(segments))
+            return
+
+        self._has_patterns = True
+        node = self._root
+        for i, segment in enumerate(segments):
+            if segment == REST_WILDCARD and i == len(segments) - 1:
+                node.rest = True
+                return
+            if _is_segment_wildcard(segment):
+                if node.wildcard is None:
+                    node.wildcard = _Node()
+                node = node.wildcard
+            else:
+                node = node.children.setdefault(segment, _Node())
+        node.terminal = True
+
+    def match(self, path: str) -> bool:
+        path = normalize_path(path)
+        if path in self._exact:
+            return True
+        if not self._has_patterns:
+            return False
+        return self._match_node(self._root, path.split("/") if path else [], 0)
+
+    def _match_node(self, node: _Node, segments: List[str], i: int) -> bool:
+        if node.rest and i < len(segments):
+            return True
+        if i == len(segments):
+            return node.terminal
+        child = node.children.get(segments[i])
+        if child is not None and self._match_node(child, segments, i + 1):
+            return True
+        return node.wildcard is not None and self._match_node(node.wildcard, segments, i + 1)
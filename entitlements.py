@@ -0,0 +1,139 @@
+import base64
+import os
+import time
+from typing import Dict, Iterable, Optional, Sequence
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models import PlanPermission, Subscription
+
+# ----Entitlement Claims----!!
+# With AUTH_ENTITLEMENT_CLAIMS=true, /token also signs the user's entitlements into the
+# JWT: uid (user id), pid (plan id), pv (plan version) and ent, a bitmask over endpoints
+# table ids (bit i set = endpoint i granted), little-endian base64url. A metered call for
+# the token's own user is then authorized with a bit test, and only the usage debit goes
+# to the database.
+#
+# Plan versions are millisecond timestamps: a token's pv is taken when it is issued, and
+# the admin plan / permission routes and update_subscription stamp what they changed in
+# the table below. A token whose pv is older than a change this worker knows about for
+# its plan or user is rejected with 401 so the client fetches a new one. Other workers
+# only learn of changes made through them, so claims older than
+# AUTH_ENTITLEMENT_MAX_AGE_SECONDS are not trusted and the usual database checks run.
+# Claims never deny on their own: anything the mask does not grant takes the database
+# path too, which also produces the usual error.
+
+AUTH_ENTITLEMENT_CLAIMS = os.getenv("AUTH_ENTITLEMENT_CLAIMS", "false").lower() == "true"
+AUTH_ENTITLEMENT_MAX_AGE_SECONDS = float(os.getenv("AUTH_ENTITLEMENT_MAX_AGE_SECONDS", "300"))
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def encode_mask(ids: Iterable[int]) -> str:
+    mask = 0
+    for id in ids:
+        mask |= 1 << id
+    raw = mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_mask(encoded: str) -> int:
+    return int.from_bytes(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)), "little")
+
+
+# Entitlements read from a verified token
+class Entitlements:
+    __slots__ = ("user_id", "plan_id", "version", "mask")
+
+    def __init__(self, user_id: int, plan_id: int, version: int, mask: int):
+        self.user_id = user_id
+        self.plan_id = plan_id
+        self.version = version
+        self.mask = mask
+
+    # None unless the payload carries a complete, well-formed set of claims
+    @classmethod
+    def from_claims(cls, payload: dict) -> Optional["Entitlements"]:
+        try:
+            return cls(int(payload["uid"]), int(payload["pid"]), int(payload["pv"]), decode_mask(payload["ent"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def grants(self, permission_ids: Sequence[Optional[int]]) -> bool:
+        return all(permission_id is not None and self.mask >> permission_id & 1 for permission_id in permission_ids)
+
+
+class EntitlementVersions:
+    def __init__(self):
+        # Last change this worker made, per plan / per user / to every plan (ms timestamps)
+        self._plans: Dict[int, int] = {}
+        self._users: Dict[int, int] = {}
+        self._all = 0
+        self.authorized = 0
+        self.stale = 0
+        self.expired = 0
+
+    # Record a change to one plan's entitlements, or to every plan's (a permission changed)
+    def bump_plan(self, plan_id: Optional[int] = None) -> None:
+        if plan_id is None:
+            self._all = _now_ms()
+            self._plans.clear()
+        else:
+            self._plans[plan_id] = _now_ms()
+
+    # Record a change to a user's subscription
+    def bump_user(self, user_id: int) -> None:
+        self._users[user_id] = _now_ms()
+
+    def is_current(self, entitlements: Entitlements) -> bool:
+        changed = max(self._all, self._plans.get(entitlements.plan_id, 0), self._users.get(entitlements.user_id, 0))
+        return entitlements.version > changed
+
+    def stats(self) -> dict:
+        return {
+            "enabled": AUTH_ENTITLEMENT_CLAIMS,
+            "authorized": self.authorized,
+            "stale": self.stale,
+            "expired": self.expired,
+            "changed_plans": len(self._plans),
+            "changed_users": len(self._users),
+        }
+
+
+entitlement_versions = EntitlementVersions()
+
+
+# Claims for a new token of the user; empty without a subscription
+async def entitlement_claims(user_id: int, db: AsyncSession) -> dict:
+    # Taken before the reads, so a change committed while they run makes the token stale
+    version = _now_ms()
+    plan_id = await db.scalar(select(Subscription.plan_id).filter(Subscription.user_id == user_id))
+    if plan_id is None:
+        return {}
+    permission_ids = (await db.scalars(select(PlanPermission.api_id).filter(PlanPermission.plan_id == plan_id))).all()
+    return {"uid": user_id, "pid": plan_id, "pv": version, "ent": encode_mask(permission_ids)}
+
+
+# Plan id the token's claims entitle user_id to call every given endpoint with, or None
+# when the claims cannot decide and the database checks must run. Raises 401 for claims
+# made stale by a known change.
+def authorize_from_claims(entitlements: Optional[Entitlements], user_id: int,
+                          permission_ids: Sequence[Optional[int]]) -> Optional[int]:
+    if not AUTH_ENTITLEMENT_CLAIMS or entitlements is None or entitlements.user_id != user_id:
+        return None
+    if entitlements.version < _now_ms() - AUTH_ENTITLEMENT_MAX_AGE_SECONDS * 1000:
+        entitlement_versions.expired += 1
+        return None
+    if not entitlement_versions.is_current(entitlements):
+        entitlement_versions.stale += 1
+        raise HTTPException(
+            status_code=401,
+            detail="Your plan changed since this token was issued. Request a new token.",
+            headers={"WWW-Authenticate": 'Bearer error="invalid_token", error_description="stale entitlements"'},
+        )
+    if not entitlements.grants(permission_ids):
+        return None
+    entitlement_versions.authorized += 1
+    return entitlements.plan_id
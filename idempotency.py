@@ -0,0 +1,357 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+# ----Idempotency Keys----!!
+# A metered call sent with an Idempotency-Key header runs once per (user, key): a retry
+# gets the first response back, marked Idempotent-Replayed: true, without being
+# authorized or charged again. Only successful (2xx) responses are kept; after a
+# rejection nothing was debited, so a retry with the same key runs normally. Reusing a
+# key for a different request (another route or batch body) is a 422.
+#
+# The first request claims the key by inserting its row in idempotency_keys, unique on
+# (user_id, key_hash); the response is written into that row and cached in a bounded
+# per-worker LRU. A duplicate that arrives while the first one is running waits for it:
+# on its future in the same worker, else by polling the row, and gets a 409 after
+# IDEMPOTENCY_WAIT_SECONDS. A claim left unanswered for IDEMPOTENCY_CLAIM_SECONDS (its
+# worker died) can be taken over. Rows expire after IDEMPOTENCY_TTL_SECONDS and a
+# background task deletes them.
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+IDEMPOTENCY_CLAIM_SECONDS = float(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "30"))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "60"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Row polling interval while another worker runs the first request
+IDEMPOTENCY_POLL_SECONDS = 0.05
+# Expired rows deleted per statement
+IDEMPOTENCY_PURGE_CHUNK_SIZE = 1000
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _sha1(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+# A response kept for replays
+class StoredResponse:
+    __slots__ = ("fingerprint", "status_code", "body", "expires_at")
+
+    def __init__(self, fingerprint: str, status_code: int, body: bytes, expires_at: int):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.body = body
+        self.expires_at = expires_at
+
+    def response(self) -> Response:
+        return Response(self.body, status_code=self.status_code, media_type="application/json",
+                        headers={REPLAYED_HEADER: "true"})
+
+
+# A request carrying an Idempotency-Key: either a replay or the claim holder
+class IdempotentCall:
+    __slots__ = ("user_id", "key_hash", "fingerprint", "replay")
+
+    def __init__(self, user_id: int, key_hash: str, fingerprint: str, replay: Optional[StoredResponse] = None):
+        self.user_id = user_id
+        self.key_hash = key_hash
+        self.fingerprint = fingerprint
+        self.replay = replay
+
+
+class IdempotencyCache:
+    def __init__(self, max_size: int = IDEMPOTENCY_CACHE_SIZE, ttl: float = IDEMPOTENCY_TTL_SECONDS,
+                 wait: float = IDEMPOTENCY_WAIT_SECONDS, claim_timeout: float = IDEMPOTENCY_CLAIM_SECONDS,
+                 purge_interval: float = IDEMPOTENCY_PURGE_INTERVAL_SECONDS):
+        self.enabled = False
+        self.max_size = max_size
+        self.ttl = ttl
+        self.wait = wait
+        self.claim_timeout = claim_timeout
+        self.purge_interval = purge_interval
+        self._responses: "OrderedDict[Tuple[int, str], StoredResponse]" = OrderedDict()
+        # Claims held by this worker: (user_id, key_hash) -> (done future, claimed at)
+        self._inflight: Dict[Tuple[int, str], Tuple[asyncio.Future, float]] = {}
+        self.executed = 0
+        self.cache_replays = 0
+        self.db_replays = 0
+        self.waits = 0
+        self.takeovers = 0
+        self.conflicts = 0
+        self.mismatches = 0
+        self.purged = 0
+        self.purge_errors = 0
+        self._session_factory = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, session_factory) -> None:
+        self.enabled = True
+        self._session_factory = session_factory
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.enabled = False
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            await self.purge()
+
+    def _cached(self, ident: Tuple[int, str]) -> Optional[StoredResponse]:
+        stored = self._responses.get(ident)
+        if stored is None:
+            return None
+        if stored.expires_at <= _now_ms():
+            del self._responses[ident]
+            return None
+        self._responses.move_to_end(ident)
+        return stored
+
+    def _remember(self, ident: Tuple[int, str], stored: StoredResponse) -> None:
+        self._responses[ident] = stored
+        self._responses.move_to_end(ident)
+        while len(self._responses) > self.max_size:
+            self._responses.popitem(last=False)
+
+    def _check_fingerprint(self, call: IdempotentCall, fingerprint: str) -> None:
+        if fingerprint != call.fingerprint:
+            self.mismatches += 1
+            raise HTTPException(status_code=422, detail="This Idempotency-Key was already used for a different request")
+
+    def _replay(self, call: IdempotentCall, stored: StoredResponse) -> IdempotentCall:
+        self._check_fingerprint(call, stored.fingerprint)
+        call.replay = stored
+        return call
+
+    # Claim the key for this request, or get the response to replay. Waits while another
+    # request with the key is running; a claim must end with complete() or abandon().
+    async def begin(self, user_id: int, key: str, fingerprint: str, db: AsyncSession) -> IdempotentCall:
+        call = IdempotentCall(user_id, _sha1(key.encode()), fingerprint)
+        ident = (user_id, call.key_hash)
+        deadline = time.monotonic() + self.wait
+        while True:
+            stored = self._cached(ident)
+            if stored is not None:
+                self.cache_replays += 1
+                return self._replay(call, stored)
+
+            inflight = self._inflight.get(ident)
+            if inflight is not None and time.monotonic() - inflight[1] < self.claim_timeout:
+                self.waits += 1
+                try:
+                    await asyncio.wait_for(asyncio.shield(inflight[0]), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self._conflict()
+                continue
+
+            now = _now_ms()
+            try:
+                await db.execute(insert(IdempotencyKey).values(
+                    user_id=user_id, key_hash=call.key_hash, fingerprint=fingerprint, claimed_at=now,
+                    expires_at=now + int(self.ttl * 1000),
+                ))
+                await db.commit()
+            except IntegrityError:
+                await db.rollback()
+            else:
+                self._claimed(ident)
+                return call
+
+            row = (await db.execute(
+                select(IdempotencyKey.id, IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.body,
+                       IdempotencyKey.claimed_at, IdempotencyKey.expires_at)
+                .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key_hash == call.key_hash)
+            )).first()
+            # End the read, so the next poll sees what other workers committed since
+            await db.rollback()
+            if row is None:
+                continue
+            if row.expires_at <= now:
+                await self._delete(db, row.id, IdempotencyKey.expires_at == row.expires_at)
+                continue
+            if row.status_code is not None:
+                stored = StoredResponse(row.fingerprint, row.status_code, row.body.encode(), row.expires_at)
+                self._remember(ident, stored)
+                self.db_replays += 1
+                return self._replay(call, stored)
+            self._check_fingerprint(call, row.fingerprint)
+            if now - row.claimed_at >= self.claim_timeout * 1000:
+                # The claim holder stopped answering: take the claim over
+                taken = await db.execute(
+                    update(IdempotencyKey)
+                    .where(IdempotencyKey.id == row.id, IdempotencyKey.claimed_at == row.claimed_at,
+                           IdempotencyKey.status_code.is_(None))
+                    .values(claimed_at=now)
+                )
+                await db.commit()
+                if taken.rowcount:
+                    self.takeovers += 1
+                    self._claimed(ident)
+                    return call
+                continue
+            if time.monotonic() >= deadline:
+                self._conflict()
+            self.waits += 1
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+    def _claimed(self, ident: Tuple[int, str]) -> None:
+        self._inflight[ident] = (asyncio.get_running_loop().create_future(), time.monotonic())
+        self.executed += 1
+
+    def _conflict(self) -> None:
+        self.conflicts += 1
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress. Retry later.")
+
+    def _release(self, ident: Tuple[int, str]) -> None:
+        inflight = self._inflight.pop(ident, None)
+        if inflight is not None and not inflight[0].done():
+            inflight[0].set_result(None)
+
+    async def _delete(self, db: AsyncSession, row_id: int, condition) -> None:
+        await db.execute(delete(IdempotencyKey).where(IdempotencyKey.id == row_id, condition))
+        await db.commit()
+
+    # Keep the claim holder's response for the retries
+    async def complete(self, call: IdempotentCall, status_code: int, body: bytes, db: AsyncSession) -> None:
+        ident = (call.user_id, call.key_hash)
+        try:
+            if 200 <= status_code < 300:
+                await db.execute(
+                    update(IdempotencyKey)
+                    .where(IdempotencyKey.user_id == call.user_id, IdempotencyKey.key_hash == call.key_hash)
+                    .values(status_code=status_code, body=body.decode())
+                )
+                await db.commit()
+                self._remember(ident, StoredResponse(call.fingerprint, status_code, body, _now_ms() + int(self.ttl * 1000)))
+            else:
+                await self._abandon(call, db)
+        finally:
+            self._release(ident)
+
+    # Give the claim up (the request failed), so a retry runs it again
+    async def abandon(self, call: IdempotentCall, db: AsyncSession) -> None:
+        try:
+            await db.rollback()
+            await self._abandon(call, db)
+        except Exception:
+            # The claim times out after IDEMPOTENCY_CLAIM_SECONDS instead
+            logger.exception("Could not release an idempotency key claim")
+        finally:
+            self._release((call.user_id, call.key_hash))
+
+    async def _abandon(self, call: IdempotentCall, db: AsyncSession) -> None:
+        await db.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.user_id == call.user_id, IdempotencyKey.key_hash == call.key_hash,
+                   IdempotencyKey.status_code.is_(None))
+        )
+        await db.commit()
+
+    # Delete the expired rows. Returns the rows deleted.
+    async def purge(self) -> int:
+        purged = 0
+        try:
+            while True:
+                async with self._session_factory() as session:
+                    ids = (await session.scalars(
+                        select(IdempotencyKey.id).where(IdempotencyKey.expires_at <= _now_ms())
+                        .limit(IDEMPOTENCY_PURGE_CHUNK_SIZE)
+                    )).all()
+                    if not ids:
+                        break
+                    await session.execute(delete(IdempotencyKey).where(IdempotencyKey.id.in_(ids)))
+                    await session.commit()
+                purged += len(ids)
+        except Exception:
+            self.purge_errors += 1
+            logger.exception("Idempotency key purge failed")
+        self.purged += purged
+        return purged
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "cached_responses": len(self._responses),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "inflight": len(self._inflight),
+            "executed": self.executed,
+            "cache_replays": self.cache_replays,
+            "db_replays": self.db_replays,
+            "waits": self.waits,
+            "takeovers": self.takeovers,
+            "conflicts": self.conflicts,
+            "mismatches": self.mismatches,
+            "purged": self.purged,
+            "purge_errors": self.purge_errors,
+        }
+
+
+idempotency_cache = IdempotencyCache()
+
+
+# ----Route Helpers----!!
+
+# What makes two requests with one key the same request: method, path and body
+def request_fingerprint(request: Request, body: bytes = b"") -> str:
+    return _sha1(f"{request.method} {request.url.path}\n".encode() + body)
+
+
+# Start an idempotent call for the request; the route answers with respond()
+async def begin_call(request: Request, user_id: int, key: str, db: AsyncSession, body: bytes = b"") -> IdempotentCall:
+    call = await idempotency_cache.begin(user_id, key, request_fingerprint(request, body), db)
+    request.state.idempotency = call
+    return call
+
+
+# The route's answer: the stored response for a replay, else the payload, kept for the
+# retries first when the request carried an Idempotency-Key. response is the route's
+# injected Response: FastAPI drops its headers (RateLimit-* and the like) when the route
+# returns a Response of its own, so they are copied over.
+async def respond(request: Request, payload, db: AsyncSession, response: Optional[Response] = None, status_code: int = 200):
+    call = getattr(request.state, "idempotency", None)
+    if call is None:
+        return payload
+    if call.replay is not None:
+        return call.replay.response()
+    body = json.dumps(jsonable_encoder(payload), separators=(",", ":")).encode()
+    await idempotency_cache.complete(call, status_code, body, db)
+    result = Response(body, status_code=status_code, media_type="application/json")
+    if response is not None:
+        result.raw_headers.extend((name, value) for name, value in response.raw_headers
+                                  if name not in (b"content-length", b"content-type"))
+    return result
+
+
+# Give up the request's claim after a failure
+async def abandon_call(request: Request, db: AsyncSession) -> None:
+    call = getattr(request.state, "idempotency", None)
+    if call is not None and call.replay is None:
+        await idempotency_cache.abandon(call, db)
@@ -0,0 +1,182 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+# ----Logging Pipeline----!!
+# Request handlers only build a LogRecord and drop it on a bounded queue; a background
+# thread does the formatting, redaction and stdout writes. Records that would block
+# (queue full) are dropped and counted rather than stalling the event loop.
+#
+#   LOG_LEVEL=INFO                       root level
+#   LOG_LEVELS=auth=DEBUG,app=WARNING    per-logger levels
+#   LOG_SAMPLE_RATES=auth=0.01           keep this fraction of DEBUG/INFO records of a logger
+#   LOG_FORMAT=json|text
+#
+# Messages are formatted on the background thread, so pass immutable values as arguments.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+REDACTED = "[REDACTED]"
+# Extra fields that never reach the output
+SECRET_FIELDS = {"password", "token", "access_token", "authorization", "secret", "secret_key"}
+_SECRET_PATTERNS = [
+    # JWTs (header.payload.signature, base64url)
+    re.compile(r"eyJ[\w-]+\.[\w-]+\.[\w-]+"),
+    # password=... / "password": "..." fragments
+    re.compile(r"(?i)(password[\"']?\s*[:=]\s*[\"']?)[^\s\"',}]+"),
+]
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+    mapping = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            mapping[name.strip()] = setting.strip()
+    return mapping
+
+
+LOG_LEVELS = _parse_mapping(os.getenv("LOG_LEVELS", ""))
+LOG_SAMPLE_RATES = {name: float(rate) for name, rate in _parse_mapping(os.getenv("LOG_SAMPLE_RATES", "")).items()}
+
+
+def redact_text(text: str) -> str:
+    text = _SECRET_PATTERNS[0].sub(REDACTED, text)
+    return _SECRET_PATTERNS[1].sub(lambda match: match.group(1) + REDACTED, text)
+
+
+def _extra_fields(record: logging.LogRecord) -> Dict[str, object]:
+    return {
+        key: REDACTED if key.lower() in SECRET_FIELDS else value
+        for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact_text(record.getMessage()),
+            **_extra_fields(record),
+        }
+        if record.exc_info:
+            entry["exc_info"] = redact_text(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = redact_text(super().format(record))
+        extra = _extra_fields(record)
+        if extra:
+            line += " " + " ".join(f"{key}={value}" for key, value in extra.items())
+        return line
+
+
+# Keeps a fraction of the DEBUG/INFO records of the sampled loggers (and their children);
+# warnings and errors always pass
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def _rate(self, name: str) -> Optional[float]:
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+
+    # Leave formatting to the listener thread; the stock prepare() formats here
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    def __init__(self):
+        self.handler: Optional[NonBlockingQueueHandler] = None
+        self.sampler: Optional[SamplingFilter] = None
+        self._listener: Optional[QueueListener] = None
+
+    # Route the root logger through the queue; safe to call more than once
+    def setup(self) -> None:
+        if self._listener is not None:
+            return
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.handler = NonBlockingQueueHandler(log_queue)
+        self.sampler = SamplingFilter(LOG_SAMPLE_RATES)
+        self.handler.addFilter(self.sampler)
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        self._listener = QueueListener(log_queue, output, respect_handler_level=True)
+        self._listener.start()
+        atexit.register(self.shutdown)
+
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in LOG_LEVELS.items():
+            logging.getLogger(name).setLevel(level.upper())
+
+    # Drain the queue and stop the writer thread
+    def shutdown(self) -> None:
+        if self._listener is None:
+            return
+        logging.getLogger().removeHandler(self.handler)
+        self._listener.stop()
+        self._listener = None
+
+    def stats(self) -> dict:
+        return {
+            "enqueued": self.handler.enqueued if self.handler else 0,
+            "dropped": self.handler.dropped if self.handler else 0,
+            "sampled_out": self.sampler.sampled_out if self.sampler else 0,
+            "pending": self.handler.queue.qsize() if self.handler else 0,
+            "queue_size": LOG_QUEUE_SIZE,
+        }
+
+
+log_pipeline = LogPipeline()
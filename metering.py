@@ -0,0 +1,141 @@
+import logging
+import time
+from typing import Dict, List, Optional, Sequence
+from fastapi import Depends, Header, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from auth import Principal, get_current_user
+from database import get_async_db
+from endpoint_matcher import normalize_path
+from entitlements import authorize_from_claims
+from idempotency import abandon_call, begin_call, idempotency_cache, IDEMPOTENCY_KEY_MAX_LENGTH
+from models import Permission
+from plan_cache import plan_cache
+from utility import enforce_usage
+
+logger = logging.getLogger(__name__)
+
+# ----Metering----!!
+# One dependency, built per metered route by meter(), resolves the principal, checks the
+# rate limit, entitlement and quota and debits one unit, then leaves the outcome on
+# request.state.metering. The route -> permission table is loaded from the endpoints
+# table at startup (and again after any catalogue change), and each route's entry is
+# bound to its dependency, so adding a metered service adds no per-request work.
+# Entitlement comes from the token's claims when it carries them (entitlements.py).
+# The timings in stats() cover rate limit, entitlement and quota; the principal is
+# resolved (and usually cached) by get_current_user before they start.
+# A request with an Idempotency-Key that was already answered is replayed by the route
+# (idempotency.respond) and skips all three.
+
+
+class MeteredRoute:
+    __slots__ = ("api_endpoint", "permission_id", "count")
+
+    def __init__(self, api_endpoint: str):
+        self.api_endpoint = api_endpoint
+        # id of the endpoints row for this route, None if the catalogue does not list it
+        self.permission_id: Optional[int] = None
+        self.count = 0
+
+
+# What a metered request was charged for
+class Metering:
+    __slots__ = ("principal", "user_id", "api_endpoint", "permission_id")
+
+    def __init__(self, principal: Principal, user_id: int, api_endpoint: str, permission_id: Optional[int]):
+        self.principal = principal
+        self.user_id = user_id
+        self.api_endpoint = api_endpoint
+        self.permission_id = permission_id
+
+
+class MeteringTable:
+    def __init__(self):
+        self._routes: Dict[str, MeteredRoute] = {}
+        # plan_cache version the table was loaded at; admin catalogue writes bump it
+        self._loaded_version: Optional[int] = None
+        self.allowed = 0
+        self.rejected: Dict[int, int] = {}
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def register(self, api_endpoint: str) -> MeteredRoute:
+        return self._routes.setdefault(normalize_path(api_endpoint), MeteredRoute(api_endpoint))
+
+    # Map every registered route to its endpoints row
+    async def load(self, db: AsyncSession) -> None:
+        version = plan_cache.version
+        rows = await db.execute(select(Permission.id, Permission.api_endpoint))
+        permission_ids = {normalize_path(api_endpoint): permission_id for permission_id, api_endpoint in rows if api_endpoint}
+        for path, route in self._routes.items():
+            route.permission_id = permission_ids.get(path)
+            if route.permission_id is None:
+                logger.warning("Metered route %s has no endpoints row; every plan will be denied", route.api_endpoint)
+        self._loaded_version = version
+
+    # endpoints row ids of registered routes, None for unknown or unlisted ones
+    def permission_ids(self, api_endpoints: Sequence[str]) -> List[Optional[int]]:
+        routes = [self._routes.get(normalize_path(api_endpoint)) for api_endpoint in api_endpoints]
+        return [route.permission_id if route is not None else None for route in routes]
+
+    def is_current(self) -> bool:
+        return self._loaded_version == plan_cache.version
+
+    def observe(self, seconds: float, status: Optional[int]) -> None:
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        if status is None:
+            self.allowed += 1
+        else:
+            self.rejected[status] = self.rejected.get(status, 0) + 1
+
+    def stats(self) -> dict:
+        metered = self.allowed + sum(self.rejected.values())
+        return {
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "avg_seconds": self.seconds / metered if metered else 0.0,
+            "max_seconds": self.max_seconds,
+            "routes": {route.api_endpoint: {"permission_id": route.permission_id, "count": route.count} for route in self._routes.values()},
+        }
+
+
+metering_table = MeteringTable()
+
+
+# Dependency factory: meter(api_endpoint) charges one unit of that endpoint to the user_id query parameter
+def meter(api_endpoint: str):
+    route = metering_table.register(api_endpoint)
+
+    async def metered(request: Request, response: Response, user_id: int,
+                      principal: Principal = Depends(get_current_user),
+                      db: AsyncSession = Depends(get_async_db),
+                      idempotency_key: Optional[str] = Header(None, min_length=1, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)) -> Metering:
+        if idempotency_key is not None and idempotency_cache.enabled:
+            call = await begin_call(request, user_id, idempotency_key, db)
+            if call.replay is not None:
+                return Metering(principal, user_id, route.api_endpoint, route.permission_id)
+        started = time.perf_counter()
+        status = None
+        try:
+            if not metering_table.is_current():
+                await metering_table.load(db)
+            # Token claims that grant the route settle entitlement without reading the plan
+            plan_id = authorize_from_claims(principal.entitlements, user_id, (route.permission_id,))
+            await enforce_usage(user_id, route.api_endpoint, db, response, plan_id)
+        except HTTPException as e:
+            status = e.status_code
+            await abandon_call(request, db)
+            raise
+        except BaseException:
+            await abandon_call(request, db)
+            raise
+        finally:
+            metering_table.observe(time.perf_counter() - started, status)
+        route.count += 1
+        metering = Metering(principal, user_id, route.api_endpoint, route.permission_id)
+        request.state.metering = metering
+        return metering
+
+    return metered
@@ -0,0 +1,146 @@
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event
+
+# ----Request Metrics----!!
+# Per route template: request count by status, a latency histogram, and the SQL
+# statements and database time the requests spent, exposed on GET /metrics in the
+# Prometheus text format. Everything is plain counters owned by the worker's event
+# loop, so recording needs no locks; each uvicorn worker exposes its own numbers.
+#
+# Statements are attributed to the request through a context variable that the
+# middleware sets; SQLAlchemy's async greenlets inherit it, and statements run
+# outside a request (background flushes, scripts) are not counted.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Label for requests that matched no route, so unknown paths cannot blow up the series count
+UNMATCHED_ROUTE = "unmatched"
+
+# [statements, seconds] of the current request
+_db_usage: ContextVar[Optional[List[float]]] = ContextVar("db_usage", default=None)
+
+
+class _RouteSeries:
+    __slots__ = ("statuses", "buckets", "count", "seconds", "db_statements", "db_seconds")
+
+    def __init__(self):
+        self.statuses: Dict[int, int] = {}
+        # Non-cumulative; the +Inf bucket is the last slot
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.db_statements = 0
+        self.db_seconds = 0.0
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._series: Dict[Tuple[str, str], _RouteSeries] = {}
+
+    def observe(self, method: str, route: str, status: int, seconds: float, db_usage: List[float]) -> None:
+        series = self._series.get((method, route))
+        if series is None:
+            series = self._series[(method, route)] = _RouteSeries()
+        series.statuses[status] = series.statuses.get(status, 0) + 1
+        series.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        series.count += 1
+        series.seconds += seconds
+        series.db_statements += int(db_usage[0])
+        series.db_seconds += db_usage[1]
+
+    # Prometheus text exposition format 0.0.4
+    def render(self, gauges: Dict[str, float] = None) -> str:
+        lines = [
+            "# HELP http_requests_total Requests by route template, method and status code.",
+            "# TYPE http_requests_total counter",
+        ]
+        series_items = sorted(self._series.items())
+        for (method, route), series in series_items:
+            for status, count in sorted(series.statuses.items()):
+                lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+        lines += [
+            "# HELP http_request_duration_seconds Request latency by route template.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        for (method, route), series in series_items:
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, series.buckets):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {series.count}')
+            lines.append(f"http_request_duration_seconds_sum{{{labels}}} {series.seconds}")
+            lines.append(f"http_request_duration_seconds_count{{{labels}}} {series.count}")
+
+        lines += [
+            "# HELP http_request_db_statements_total SQL statements executed while serving the route.",
+            "# TYPE http_request_db_statements_total counter",
+        ]
+        for (method, route), series in series_items:
+            lines.append(f'http_request_db_statements_total{{method="{method}",route="{route}"}} {series.db_statements}')
+        lines += [
+            "# HELP http_request_db_seconds_total Time spent executing SQL while serving the route.",
+            "# TYPE http_request_db_seconds_total counter",
+        ]
+        for (method, route), series in series_items:
+            lines.append(f'http_request_db_seconds_total{{method="{method}",route="{route}"}} {series.db_seconds}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+
+# Count statements and their duration into the current request, if any
+def instrument_engine(sync_engine) -> None:
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _db_usage.get() is not None:
+            conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_usage = _db_usage.get()
+        if db_usage is not None and conn.info.get("metrics_started"):
+            db_usage[0] += 1
+            db_usage[1] += time.perf_counter() - conn.info["metrics_started"].pop()
+
+
+# Pure ASGI middleware: times the request, captures the status code and reads the
+# matched route template from the scope once the router has filled it in
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        db_usage = [0, 0.0]
+        token = _db_usage.set(db_usage)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _db_usage.reset(token)
+            route = scope.get("route")
+            request_metrics.observe(scope["method"], route.path if route is not None else UNMATCHED_ROUTE, status, elapsed, db_usage)
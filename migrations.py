@@ -0,0 +1,304 @@
+import argparse
+import sys
+from datetime import datetime
+from typing import Callable, List, Sequence, Tuple
+from sqlalchemy import create_engine, exists, func, inspect, text, select, update, or_
+from sqlalchemy.engine import Connection
+from database import Base, DATABASE_URL
+from billing_periods import debit_values, usage_expression
+from models import User, Plan, Permission, Subscription, PlanPermission, PlanRateLimit, UsageEvent, UsageRollup, UsageRollupProgress, ReplicaHeartbeat, BillingSweepProgress, UsageCounterSlot, IdempotencyKey
+
+# ----Schema Migrations----!!
+# Versioned, idempotent upgrades that bring a database created from an older sqlfile.sql
+# (or an older models.py) up to the current schema. Applied versions are recorded in
+# schema_migrations; a fresh database is created from models.py and stamped directly.
+#
+#   python migrations.py upgrade      apply the pending migrations
+#   python migrations.py status       list applied and pending versions
+#   python migrations.py check        EXPLAIN the hot-path queries, exit 1 on a full table scan
+
+
+def _quote(conn: Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+# Column lists of the indexes and unique constraints already on a table, with their names
+def _indexes(conn: Connection, table: str) -> List[Tuple[str, Tuple[str, ...], bool]]:
+    inspector = inspect(conn)
+    found = [(index["name"], tuple(index["column_names"]), bool(index["unique"])) for index in inspector.get_indexes(table)]
+    found += [(constraint["name"], tuple(constraint["column_names"]), True) for constraint in inspector.get_unique_constraints(table)]
+    return found
+
+
+# Create an index unless one with the same name, or a matching one under another name, already exists
+def _ensure_index(conn: Connection, table: str, name: str, columns: Sequence[str], unique: bool = False) -> None:
+    for existing_name, existing_columns, existing_unique in _indexes(conn, table):
+        if existing_name == name or (existing_columns == tuple(columns) and (existing_unique or not unique)):
+            return
+    conn.execute(text(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {_quote(conn, table)} "
+        f"({', '.join(_quote(conn, column) for column in columns)})"
+    ))
+
+
+# Refuse to build a unique index over duplicate values; which row wins is a data decision
+def _require_unique(conn: Connection, table: str, columns: Sequence[str]) -> None:
+    column_list = ", ".join(_quote(conn, column) for column in columns)
+    duplicates = conn.execute(text(
+        f"SELECT {column_list}, COUNT(*) FROM {_quote(conn, table)} GROUP BY {column_list} HAVING COUNT(*) > 1"
+    )).all()
+    if duplicates:
+        raise RuntimeError(f"{table} has {len(duplicates)} duplicated ({column_list}) values, e.g. {tuple(duplicates[0])[:-1]}; resolve them first")
+
+
+# Replace the foreign key on table.column with one using the given ON DELETE rule (MySQL only:
+# SQLite cannot alter constraints, and only enforces them with PRAGMA foreign_keys anyway)
+def _ensure_foreign_key(conn: Connection, table: str, column: str, referred_table: str, ondelete: str = None) -> None:
+    if conn.dialect.name != "mysql":
+        return
+    for foreign_key in inspect(conn).get_foreign_keys(table):
+        if foreign_key["constrained_columns"] == [column]:
+            if (foreign_key["options"].get("ondelete") or "").upper() == (ondelete or "").upper():
+                return
+            conn.execute(text(f"ALTER TABLE {table} DROP FOREIGN KEY {foreign_key['name']}"))
+    orphans = conn.scalar(text(
+        f"SELECT COUNT(*) FROM {table} WHERE {column} IS NOT NULL AND {column} NOT IN (SELECT id FROM {referred_table})"
+    ))
+    if orphans:
+        raise RuntimeError(f"{table}.{column} has {orphans} rows without a matching {referred_table}.id; resolve them first")
+    conn.execute(text(
+        f"ALTER TABLE {table} ADD CONSTRAINT fk_{table}_{column} FOREIGN KEY ({column}) REFERENCES {referred_table}(id)"
+        + (f" ON DELETE {ondelete}" if ondelete else "")
+    ))
+
+
+# Add a column unless the table already has it
+def _ensure_column(conn: Connection, table: str, column: str, definition: str) -> None:
+    if column not in {existing["name"] for existing in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {_quote(conn, table)} ADD COLUMN {_quote(conn, column)} {definition}"))
+
+
+# ----Migrations----!!
+
+def _rename_api_usage(conn: Connection) -> None:
+    columns = {column["name"] for column in inspect(conn).get_columns("subscription")}
+    if "api_usage" in columns and "usage" not in columns:
+        conn.execute(text(f"ALTER TABLE subscription RENAME COLUMN api_usage TO {_quote(conn, 'usage')}"))
+
+
+def _create_missing_tables(conn: Connection) -> None:
+    tables = [model.__table__ for model in (PlanRateLimit, UsageEvent, UsageRollup, UsageRollupProgress)]
+    Base.metadata.create_all(conn, tables=tables, checkfirst=True)
+    if conn.scalar(select(UsageRollupProgress.id).where(UsageRollupProgress.id == 1)) is None:
+        conn.execute(UsageRollupProgress.__table__.insert().values(id=1, last_event_id=0))
+
+
+def _index_users(conn: Connection) -> None:
+    _require_unique(conn, "users", ["username"])
+    _ensure_index(conn, "users", "ux_users_username", ["username"], unique=True)
+
+
+def _index_subscription(conn: Connection) -> None:
+    _require_unique(conn, "subscription", ["user_id"])
+    _ensure_index(conn, "subscription", "ux_subscription_user_id", ["user_id"], unique=True)
+    _ensure_index(conn, "subscription", "ix_subscription_plan_id", ["plan_id"])
+    _ensure_foreign_key(conn, "subscription", "user_id", "users", "CASCADE")
+    _ensure_foreign_key(conn, "subscription", "plan_id", "plan")
+
+
+def _index_plan_endpoints(conn: Connection) -> None:
+    # A repeated mapping grants nothing extra, so duplicates are dropped rather than reported
+    conn.execute(text(
+        "DELETE FROM plan_endpoints WHERE id NOT IN "
+        "(SELECT id FROM (SELECT MIN(id) AS id FROM plan_endpoints GROUP BY plan_id, api_id) AS keep)"
+    ))
+    _ensure_index(conn, "plan_endpoints", "ux_plan_endpoints_plan_api", ["plan_id", "api_id"], unique=True)
+    _ensure_index(conn, "plan_endpoints", "ix_plan_endpoints_api_id", ["api_id"])
+    _ensure_foreign_key(conn, "plan_endpoints", "plan_id", "plan", "CASCADE")
+    _ensure_foreign_key(conn, "plan_endpoints", "api_id", "endpoints", "CASCADE")
+
+
+def _index_plan_rate_limits(conn: Connection) -> None:
+    _require_unique(conn, "plan_rate_limits", ["plan_id", "api_id"])
+    _ensure_index(conn, "plan_rate_limits", "ux_plan_rate_limits_plan_api", ["plan_id", "api_id"], unique=True)
+    _ensure_index(conn, "plan_rate_limits", "ix_plan_rate_limits_api_id", ["api_id"])
+    _ensure_foreign_key(conn, "plan_rate_limits", "plan_id", "plan", "CASCADE")
+    _ensure_foreign_key(conn, "plan_rate_limits", "api_id", "endpoints", "CASCADE")
+
+
+def _index_usage_rollups(conn: Connection) -> None:
+    _ensure_index(conn, "usage_rollups", "ux_usage_rollups_bucket", ["user_id", "granularity", "bucket_start", "api_id"], unique=True)
+
+
+def _create_replica_heartbeat(conn: Connection) -> None:
+    Base.metadata.create_all(conn, tables=[ReplicaHeartbeat.__table__], checkfirst=True)
+    if conn.scalar(select(ReplicaHeartbeat.id).where(ReplicaHeartbeat.id == 1)) is None:
+        conn.execute(ReplicaHeartbeat.__table__.insert().values(id=1, written_at=0))
+
+
+def _add_billing_periods(conn: Connection) -> None:
+    _ensure_column(conn, "plan", "billing_period", "VARCHAR(10) NULL")
+    _ensure_column(conn, "subscription", "period_id", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(conn, "subscription", "previous_period_id", "INTEGER NULL")
+    _ensure_column(conn, "subscription", "previous_usage", "INTEGER NULL")
+    Base.metadata.create_all(conn, tables=[BillingSweepProgress.__table__], checkfirst=True)
+
+
+def _create_usage_counter_slots(conn: Connection) -> None:
+    Base.metadata.create_all(conn, tables=[UsageCounterSlot.__table__], checkfirst=True)
+
+
+def _create_idempotency_keys(conn: Connection) -> None:
+    Base.metadata.create_all(conn, tables=[IdempotencyKey.__table__], checkfirst=True)
+
+
+# SQLite cannot add a column with a CURRENT_TIMESTAMP default; the event flush stamps it explicitly
+def _add_usage_event_inserted_at(conn: Connection) -> None:
+    default = "" if conn.dialect.name == "sqlite" else " DEFAULT CURRENT_TIMESTAMP"
+    _ensure_column(conn, "usage_events", "inserted_at", "DATETIME NULL" + default)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Rename subscription.api_usage to usage", _rename_api_usage),
+    (2, "Create plan_rate_limits and the usage event tables", _create_missing_tables),
+    (3, "Unique index on users.username", _index_users),
+    (4, "Unique index on subscription.user_id, index on plan_id, foreign keys", _index_subscription),
+    (5, "Unique (plan_id, api_id) and api_id index on plan_endpoints, cascading foreign keys", _index_plan_endpoints),
+    (6, "Unique (plan_id, api_id) on plan_rate_limits, cascading foreign keys", _index_plan_rate_limits),
+    (7, "Unique bucket index on usage_rollups", _index_usage_rollups),
+    (8, "Create replica_heartbeat", _create_replica_heartbeat),
+    (9, "Billing periods: plan.billing_period, subscription period columns, billing_sweep_progress", _add_billing_periods),
+    (10, "Create usage_counter_slots", _create_usage_counter_slots),
+    (11, "Create idempotency_keys", _create_idempotency_keys),
+    (12, "usage_events.inserted_at", _add_usage_event_inserted_at),
+]
+
+
+# ----Runner----!!
+
+def _applied_versions(conn: Connection) -> set:
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations "
+        "(version INTEGER PRIMARY KEY, description VARCHAR(255), applied_at DATETIME)"
+    ))
+    return set(conn.scalars(text("SELECT version FROM schema_migrations")).all())
+
+
+def _stamp(conn: Connection, version: int, description: str) -> None:
+    conn.execute(
+        text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:version, :description, :applied_at)"),
+        {"version": version, "description": description, "applied_at": datetime.utcnow()},
+    )
+
+
+# Apply every pending migration, each in its own transaction. Returns the versions applied.
+def upgrade(engine) -> List[int]:
+    with engine.begin() as conn:
+        applied = _applied_versions(conn)
+        if not inspect(conn).has_table("plan"):
+            # Fresh database: models.py already is the latest schema
+            Base.metadata.create_all(conn)
+            conn.execute(UsageRollupProgress.__table__.insert().values(id=1, last_event_id=0))
+            conn.execute(ReplicaHeartbeat.__table__.insert().values(id=1, written_at=0))
+            for version, description, _ in MIGRATIONS:
+                _stamp(conn, version, description)
+            return [version for version, _, _ in MIGRATIONS]
+
+    done = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            _stamp(conn, version, description)
+        done.append(version)
+    return done
+
+
+def status(engine) -> List[Tuple[int, str, bool]]:
+    with engine.begin() as conn:
+        applied = _applied_versions(conn)
+    return [(version, description, version in applied) for version, description, _ in MIGRATIONS]
+
+
+# ----Hot-Path Query Check----!!
+# The statements the request path runs on every call, built the same way the app builds them.
+
+def hot_queries() -> List[Tuple[str, object]]:
+    usage_limit = select(Plan.usage_limit).where(Plan.id == Subscription.plan_id).scalar_subquery()
+    now = datetime.utcnow()
+    return [
+        ("login / register: user by username", select(User).where(User.username == "alice")),
+        ("rate limit: plan of a user", select(Subscription.plan_id).where(Subscription.user_id == 1)),
+        ("quota: conditional usage debit", update(Subscription)
+            .where(Subscription.user_id == 1, Subscription.plan_id.in_([1, 2]), or_(usage_limit == 0, Subscription.usage < usage_limit))
+            .values(usage=Subscription.usage + 1)),
+        ("quota: usage debit rolling the billing period", update(Subscription)
+            .where(Subscription.user_id == 1, Subscription.plan_id.in_([1, 2]), or_(usage_limit == 0, usage_expression(20000) < usage_limit))
+            .ordered_values(*debit_values(20000, 1))),
+        ("sharded usage: add to a slot", update(UsageCounterSlot)
+            .where(UsageCounterSlot.user_id == 1, UsageCounterSlot.period_id == 0, UsageCounterSlot.slot == 3,
+                   exists().where(Subscription.user_id == 1, Subscription.plan_id == 1))
+            .values(count=UsageCounterSlot.count + 1)),
+        ("sharded usage: slots of a user", select(func.sum(UsageCounterSlot.count))
+            .where(UsageCounterSlot.user_id == 1, UsageCounterSlot.period_id == 0)),
+        ("idempotency: response of a key", select(IdempotencyKey.id, IdempotencyKey.status_code, IdempotencyKey.body)
+            .where(IdempotencyKey.user_id == 1, IdempotencyKey.key_hash == "0" * 40)),
+        ("idempotency: expired keys", select(IdempotencyKey.id).where(IdempotencyKey.expires_at <= 0).limit(1000)),
+        ("billing sweep: next chunk of a plan", select(Subscription.id)
+            .where(Subscription.plan_id == 1, Subscription.id > 0).order_by(Subscription.id).limit(500)),
+        ("billing sweep: reset a chunk", update(Subscription)
+            .where(Subscription.plan_id == 1, Subscription.id > 0, Subscription.id <= 500, Subscription.period_id < 20000)
+            .ordered_values(*debit_values(20000, 0))),
+        ("plan cache: plan by id", select(Plan).where(Plan.id == 1)),
+        ("plan cache: endpoints of plans", select(PlanPermission.plan_id, Permission)
+            .join(Permission, Permission.id == PlanPermission.api_id).where(PlanPermission.plan_id.in_([1, 2]))),
+        ("plan cache: rate limits of plans", select(PlanRateLimit).where(PlanRateLimit.plan_id.in_([1, 2]))),
+        ("delete-permission: mappings of an endpoint", select(PlanPermission.id).where(PlanPermission.api_id == 1)),
+        ("usage events: roll-up watermark", select(UsageEvent.id).where(UsageEvent.id > 0).order_by(UsageEvent.id).limit(5000)),
+        ("usage history: rollups of a user", select(UsageRollup)
+            .where(UsageRollup.user_id == 1, UsageRollup.granularity == "hour",
+                   UsageRollup.bucket_start >= now, UsageRollup.bucket_start < now)),
+    ]
+
+
+# Tables read by a full scan with no usable index, per the dialect's EXPLAIN output
+def _full_scans(conn: Connection, statement) -> List[str]:
+    sql = str(statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == "sqlite":
+        rows = conn.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+        return [row[3] for row in rows if row[3].startswith("SCAN ") and "INDEX" not in row[3]]
+    rows = conn.execute(text("EXPLAIN " + sql)).mappings().all()
+    # MySQL may still scan a handful of rows when an index exists, so only flag scans with no candidate key
+    return [f"SCAN {row['table']}" for row in rows if row.get("type") == "ALL" and not row.get("possible_keys")]
+
+
+def check(engine) -> List[Tuple[str, List[str]]]:
+    with engine.connect() as conn:
+        return [(name, _full_scans(conn, statement)) for name, statement in hot_queries()]
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Schema migrations for the stratosphere database")
+    parser.add_argument("command", choices=["upgrade", "status", "check"])
+    parser.add_argument("--url", default=DATABASE_URL, help="SQLAlchemy URL of a synchronous driver")
+    args = parser.parse_args(argv)
+    engine = create_engine(args.url)
+
+    if args.command == "upgrade":
+        done = upgrade(engine)
+        print(f"Applied {len(done)} migration(s)" + (f": {', '.join(map(str, done))}" if done else ""))
+    elif args.command == "status":
+        for version, description, applied in status(engine):
+            print(f"{version:>4}  {'applied' if applied else 'pending'}  {description}")
+    else:
+        failed = False
+        for name, scans in check(engine):
+            print(f"{'FAIL' if scans else 'ok  '}  {name}" + (f"  ({'; '.join(scans)})" if scans else ""))
+            failed = failed or bool(scans)
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,138 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, Text, DateTime, ForeignKey, UniqueConstraint, func
 from sqlalchemy.orm import relationship
 from database import Base
 
 #sqlalchemy models ORM
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (UniqueConstraint("username", name="ux_users_username"),)
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String)
-    password = Column(String)
-    role = Column(String)
+    username = Column(String(50))
+    password = Column(String(255))
+    role = Column(String(50))
 
 class Plan(Base):
     __tablename__ = "plan"
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String)
-    description = Column(String)
+    name = Column(String(50))
+    description = Column(String(255))
     usage_limit = Column(Integer)
+    # "day", "week" or "month" to reset usage every calendar period (UTC), NULL to never reset
+    billing_period = Column(String(10), nullable=True)
+    plan_permissions = relationship("PlanPermission", back_populates="plan", passive_deletes=True)
+    # Endpoints mapped to the plan, in mapping order (read-only shortcut over plan_endpoints)
+    permissions = relationship("Permission", secondary="plan_endpoints", order_by="PlanPermission.id", viewonly=True)
+    rate_limits = relationship("PlanRateLimit", back_populates="plan", passive_deletes=True)
 
 class Permission(Base):
     __tablename__ = "endpoints"
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String)
-    api_endpoint = Column(String)
-    description = Column(String)
+    name = Column(String(50))
+    api_endpoint = Column(String(50))
+    description = Column(String(255))
+    plan_permissions = relationship("PlanPermission", back_populates="permission", passive_deletes=True)
     
 class Subscription(Base):
     __tablename__ = "subscription"
+    __table_args__ = (UniqueConstraint("user_id", name="ux_subscription_user_id"),)
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    plan_id = Column(Integer, ForeignKey("plan.id"))
+    # One subscription per user, enforced by the database rather than a check-then-insert
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    plan_id = Column(Integer, ForeignKey("plan.id"), index=True)
     usage = Column(Integer)
+    # Billing period usage counts, as a day number (see billing_periods.py); 0 before any
+    period_id = Column(Integer, nullable=False, default=0)
+    # The last closed period and its usage
+    previous_period_id = Column(Integer, nullable=True)
+    previous_usage = Column(Integer, nullable=True)
     
 class PlanPermission(Base):
     __tablename__ = "plan_endpoints"
+    # (plan_id, api_id) also serves the plan_id lookups; api_id gets its own index for the reverse direction
+    __table_args__ = (UniqueConstraint("plan_id", "api_id", name="ux_plan_endpoints_plan_api"),)
     id = Column(Integer, primary_key=True, index=True)
-    plan_id = Column(Integer, ForeignKey("plan.id"))
-    api_id = Column(Integer, ForeignKey("endpoints.id"))
-    
+    plan_id = Column(Integer, ForeignKey("plan.id", ondelete="CASCADE"))
+    api_id = Column(Integer, ForeignKey("endpoints.id", ondelete="CASCADE"), index=True)
+    plan = relationship("Plan", back_populates="plan_permissions")
+    permission = relationship("Permission", back_populates="plan_permissions")
+
+class PlanRateLimit(Base):
+    __tablename__ = "plan_rate_limits"
+    __table_args__ = (UniqueConstraint("plan_id", "api_id", name="ux_plan_rate_limits_plan_api"),)
+    id = Column(Integer, primary_key=True, index=True)
+    plan_id = Column(Integer, ForeignKey("plan.id", ondelete="CASCADE"))
+    # Endpoint the limit applies to, NULL for every endpoint of the plan
+    api_id = Column(Integer, ForeignKey("endpoints.id", ondelete="CASCADE"), nullable=True, index=True)
+    # NULL leaves that window unlimited
+    requests_per_second = Column(Integer, nullable=True)
+    requests_per_minute = Column(Integer, nullable=True)
+    plan = relationship("Plan", back_populates="rate_limits")
+    permission = relationship("Permission")
+
+# Append-only log of metered calls, rolled up into usage_rollups in the background
+class UsageEvent(Base):
+    __tablename__ = "usage_events"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    user_id = Column(Integer)
+    api_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime)
+    # Database clock at INSERT, which the roll-up lag is measured against
+    inserted_at = Column(DateTime, nullable=True, server_default=func.now())
+
+class UsageRollup(Base):
+    __tablename__ = "usage_rollups"
+    __table_args__ = (UniqueConstraint("user_id", "granularity", "bucket_start", "api_id", name="ux_usage_rollups_bucket"),)
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer)
+    api_id = Column(Integer, nullable=True)
+    # "hour" or "day"
+    granularity = Column(String(5))
+    bucket_start = Column(DateTime)
+    count = Column(Integer)
+
+# Highest usage_events id already folded into usage_rollups
+class UsageRollupProgress(Base):
+    __tablename__ = "usage_rollup_progress"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    last_event_id = Column(BigInteger)
+
+# Written to the primary by every worker on a timer; how old it is on a replica is that replica's lag
+class ReplicaHeartbeat(Base):
+    __tablename__ = "replica_heartbeat"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    # Milliseconds since the epoch
+    written_at = Column(BigInteger)
+
+# How far the billing sweep got through each plan's subscriptions (by id) for its current period
+class BillingSweepProgress(Base):
+    __tablename__ = "billing_sweep_progress"
+    plan_id = Column(Integer, primary_key=True, autoincrement=False)
+    period_id = Column(Integer)
+    last_subscription_id = Column(Integer)
+
+# Usage of a subscription on an unlimited plan spread over slot rows, see usage_counters.py
+class UsageCounterSlot(Base):
+    __tablename__ = "usage_counter_slots"
+    __table_args__ = (UniqueConstraint("user_id", "period_id", "slot", name="ux_usage_counter_slots_slot"),)
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer)
+    # Billing period the count belongs to, 0 for plans without one
+    period_id = Column(Integer)
+    slot = Column(Integer)
+    count = Column(Integer)
+
+# First response of a metered call per (user, Idempotency-Key), see idempotency.py
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (UniqueConstraint("user_id", "key_hash", name="ux_idempotency_keys_user_key"),)
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer)
+    # sha1 hex of the key and of the request (method, path, body)
+    key_hash = Column(String(40))
+    fingerprint = Column(String(40))
+    # NULL while the first request is running
+    status_code = Column(SmallInteger, nullable=True)
+    body = Column(Text, nullable=True)
+    # Milliseconds since the epoch
+    claimed_at = Column(BigInteger)
+    expires_at = Column(BigInteger, index=True)
@@ -0,0 +1,86 @@
+import os
+from typing import Callable, Optional
+from fastapi import Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# ----List Pagination----!!
+# Every list endpoint pages by key: ?after_id=<last key seen>&limit=<rows>. Rows come
+# back ordered by the key, so each page is an index range scan whatever the offset.
+# A JSON page carries a Link: <...>; rel="next" header while more rows remain.
+#
+# With Accept: application/x-ndjson the rows are streamed instead, one JSON object per
+# line, straight from a server-side cursor in LIST_STREAM_BATCH_SIZE batches. limit is
+# optional there and memory stays flat however large the table is.
+
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "100"))
+LIST_PAGE_SIZE_MAX = int(os.getenv("LIST_PAGE_SIZE_MAX", "1000"))
+# Rows fetched per round trip while streaming
+LIST_STREAM_BATCH_SIZE = int(os.getenv("LIST_STREAM_BATCH_SIZE", "500"))
+NDJSON = "application/x-ndjson"
+
+
+class PageParams:
+    __slots__ = ("after_id", "limit", "stream")
+
+    def __init__(self, after_id: Optional[int], limit: Optional[int], stream: bool):
+        self.after_id = after_id
+        self.limit = limit
+        self.stream = stream
+
+    # No paging asked for at all (lets /plans keep serving its cached catalogue)
+    @property
+    def unpaged(self) -> bool:
+        return self.after_id is None and self.limit is None and not self.stream
+
+
+def page_params(request: Request,
+                after_id: Optional[int] = Query(None, ge=0, description="Return rows after this key"),
+                limit: Optional[int] = Query(None, ge=1, le=LIST_PAGE_SIZE_MAX)) -> PageParams:
+    return PageParams(after_id, limit, NDJSON in request.headers.get("accept", ""))
+
+
+def keyset(statement, key_column, after_id: Optional[int], limit: Optional[int]):
+    if after_id is not None:
+        statement = statement.where(key_column > after_id)
+    statement = statement.order_by(key_column)
+    return statement.limit(limit) if limit is not None else statement
+
+
+# One page as a JSON array
+async def page_response(request: Request, db: AsyncSession, statement, key_column, page: PageParams,
+                        to_model: Callable[[object], BaseModel]) -> Response:
+    limit = page.limit or LIST_PAGE_SIZE
+    # One extra row tells whether there is a next page
+    rows = (await db.scalars(keyset(statement, key_column, page.after_id, limit + 1))).all()
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_url = request.url.include_query_params(after_id=getattr(rows[-1], key_column.key), limit=limit)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    body = b"[" + b",".join(to_model(row).model_dump_json().encode() for row in rows) + b"]"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Every row after page.after_id (up to page.limit) as NDJSON. The stream runs after the
+# route returns, so it reads through its own session on the engine the route's session uses.
+def stream_response(db: AsyncSession, statement, key_column, page: PageParams,
+                    to_model: Callable[[object], BaseModel]) -> StreamingResponse:
+    statement = keyset(statement, key_column, page.after_id, page.limit).execution_options(yield_per=LIST_STREAM_BATCH_SIZE)
+
+    async def lines():
+        async with AsyncSession(bind=db.bind, expire_on_commit=False) as session:
+            result = await session.stream_scalars(statement)
+            async for rows in result.partitions():
+                yield b"".join(to_model(row).model_dump_json().encode() + b"\n" for row in rows)
+
+    return StreamingResponse(lines(), media_type=NDJSON)
+
+
+# JSON page or NDJSON stream, as the request asked
+async def list_response(request: Request, db: AsyncSession, statement, key_column,
+                        page: PageParams, to_model: Callable[[object], BaseModel]) -> Response:
+    if page.stream:
+        return stream_response(db, statement, key_column, page, to_model)
+    return await page_response(request, db, statement, key_column, page, to_model)
@@ -0,0 +1,165 @@
+import os
+import time
+from typing import Dict, FrozenSet, Optional, Tuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import selectinload
+from models import Plan, PlanRateLimit
+from endpoint_matcher import EndpointMatcher, normalize_path
+
+# ----Plan Entitlement Cache----!!
+# Plans and their endpoint mappings almost never change, so the metered hot path
+# keeps them in-process. Entries expire after a TTL and the admin routes that
+# mutate plans or permissions invalidate them explicitly.
+
+PLAN_CACHE_TTL_SECONDS = float(os.getenv("PLAN_CACHE_TTL_SECONDS", "300"))
+# Distinct request paths remembered by plans_allowing
+PLAN_CACHE_MAX_PATHS = 4096
+
+
+# One rate window of a plan: at most `limit` requests per `period` seconds, for the
+# endpoints accepted by `matcher` (every endpoint of the plan when matcher is None)
+class RateRule:
+    __slots__ = ("key", "limit", "period", "matcher")
+
+    def __init__(self, key: Tuple[int, int], limit: int, period: int, matcher: Optional[EndpointMatcher]):
+        self.key = key
+        self.limit = limit
+        self.period = period
+        self.matcher = matcher
+
+
+def _rate_rules(rate_limits) -> Tuple[RateRule, ...]:
+    rules = []
+    for rate_limit in rate_limits:
+        matcher = EndpointMatcher([rate_limit.permission.api_endpoint]) if rate_limit.permission else None
+        for limit, period in ((rate_limit.requests_per_second, 1), (rate_limit.requests_per_minute, 60)):
+            if limit:
+                rules.append(RateRule((rate_limit.id, period), limit, period, matcher))
+    return tuple(rules)
+
+
+_plan_options = (selectinload(Plan.permissions), selectinload(Plan.rate_limits).selectinload(PlanRateLimit.permission))
+
+
+class PlanEntry:
+    __slots__ = ("plan_id", "name", "description", "usage_limit", "billing_period", "endpoints", "matcher", "rate_rules",
+                 "expires_at")
+
+    # Built from a Plan loaded with _plan_options
+    def __init__(self, plan: Plan, expires_at: float):
+        self.plan_id = plan.id
+        self.name = plan.name
+        self.description = plan.description
+        self.usage_limit = plan.usage_limit
+        self.billing_period = plan.billing_period
+        # (name, api_endpoint) pairs, in mapping order
+        self.endpoints: Tuple[Tuple[str, str], ...] = tuple((ep.name, ep.api_endpoint) for ep in plan.permissions)
+        # Compiled once per plan version and shared by every access check
+        self.matcher = EndpointMatcher(endpoint for _, endpoint in self.endpoints)
+        self.rate_rules = _rate_rules(plan.rate_limits)
+        self.expires_at = expires_at
+
+
+class PlanCache:
+    def __init__(self, ttl: float = PLAN_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation so loads that raced an admin write are not stored
+        self.version = 0
+        self._entries: Dict[int, PlanEntry] = {}
+        # Set once every plan has been loaded together, so plans_allowing can scan _entries
+        self._all_expires_at = 0.0
+        # Normalized request path -> ids of the plans whose matcher accepts it
+        self._allowing: Dict[str, FrozenSet[int]] = {}
+        # Serialized GET /plans body and its ETag: (version, expires_at, body, etag)
+        self._catalog: Optional[Tuple[int, float, bytes, str]] = None
+
+    # Return the cached entitlements of a plan, loading them on a miss. None if the plan does not exist.
+    async def get(self, plan_id: int, db: AsyncSession) -> Optional[PlanEntry]:
+        entry = self._entries.get(plan_id)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        version = self.version
+        entry = await self._load(plan_id, db)
+        if entry is not None and version == self.version:
+            self._entries[plan_id] = entry
+        return entry
+
+    async def _load(self, plan_id: int, db: AsyncSession) -> Optional[PlanEntry]:
+        plan = await db.scalar(select(Plan).options(*_plan_options).filter(Plan.id == plan_id))
+        if not plan:
+            return None
+        return PlanEntry(plan, time.monotonic() + self.ttl)
+
+    # Ids of the plans that grant access to a request path. Lets the quota debit filter on
+    # subscription.plan_id without joining the endpoint tables.
+    async def plans_allowing(self, api_endpoint: str, db: AsyncSession) -> FrozenSet[int]:
+        path = normalize_path(api_endpoint)
+        if self._all_expires_at > time.monotonic():
+            allowed = self._allowing.get(path)
+            if allowed is not None:
+                self.hits += 1
+                return allowed
+            entries = self._entries
+        else:
+            self.misses += 1
+            entries = await self._load_all(db)
+        allowed = frozenset(plan_id for plan_id, entry in entries.items() if entry.matcher.match(path))
+        if entries is self._entries:
+            if len(self._allowing) >= PLAN_CACHE_MAX_PATHS:
+                self._allowing.clear()
+            self._allowing[path] = allowed
+        return allowed
+
+    # Load every plan in two queries, storing them unless an invalidation raced the load
+    async def _load_all(self, db: AsyncSession) -> Dict[int, PlanEntry]:
+        version = self.version
+        plans = (await db.scalars(select(Plan).options(*_plan_options))).all()
+        expires_at = time.monotonic() + self.ttl
+        entries = {plan.id: PlanEntry(plan, expires_at) for plan in plans}
+        if version == self.version:
+            self._entries = entries
+            self._allowing = {}
+            self._all_expires_at = expires_at
+        return entries
+
+    # Cached catalogue response for the current version, or None
+    def get_catalog(self) -> Optional[Tuple[bytes, str]]:
+        catalog = self._catalog
+        if catalog is not None and catalog[0] == self.version and catalog[1] > time.monotonic():
+            return catalog[2], catalog[3]
+        return None
+
+    # Store a catalogue response built from data read at the given version
+    def set_catalog(self, version: int, body: bytes, etag: str) -> None:
+        if version == self.version:
+            self._catalog = (version, time.monotonic() + self.ttl, body, etag)
+
+    # Drop one plan, or every plan when a permission shared across plans changed.
+    # Any call also bumps the version, which retires the cached catalogue.
+    def invalidate(self, plan_id: Optional[int] = None) -> None:
+        self.version += 1
+        self._catalog = None
+        self._all_expires_at = 0.0
+        self._allowing = {}
+        if plan_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(plan_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "version": self.version,
+            "ttl_seconds": self.ttl,
+        }
+
+
+plan_cache = PlanCache()
@@ -0,0 +1,345 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import sys
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+# ----Query Budget Check----!!
+# Runs the app in-process against an in-memory SQLite database seeded with the
+# benchmark fixtures and sends one request per case below. SQLAlchemy events count
+# each request's SQL statements, its round trips (statements plus COMMIT, ROLLBACK
+# and the pool's reset on checkin) and its connection checkouts. Every route of the
+# app (app.py, cloud_services.py, bulk_admin.py) declares a statement budget here; the
+# run exits 1 when a request goes over its budget, answers with an unexpected status,
+# or when a route has no case. The statements of every offending request are printed
+# (--verbose prints them all), with the ones repeated within a request marked.
+#
+#   python query_budget.py
+#   python query_budget.py --verbose --output budgets.json
+#
+# Budgets are for the default configuration (direct accounting, warm caches). A
+# request that legitimately needs another statement raises its budget in the same
+# change, so the reviewer sees it.
+
+DATABASE_NAME = "query_budget"
+# Seeded customers, all on the unlimited Prime plan (benchmark.SEED_PLANS)
+BUDGET_USERS = 20
+PRIME_PLAN_ID = 4
+# benchmark.seed puts its admin at id 1 and the customers after it
+CUSTOMER_ID = 2
+# Ids of the rows the cases create, in the order they run
+NEW_USER_ID = BUDGET_USERS + 2
+NEW_PLAN_ID = 5
+NEW_PERMISSION_ID = 10
+NEW_RATE_LIMIT_ID = 1
+
+
+# ----Statement Recording----!!
+# Only the statements run on behalf of the request being measured are recorded: the
+# recording is held in a ContextVar set around the request, so background tasks
+# (flushes, sweeps, purges) do not count.
+
+_recording: ContextVar[Optional["Recording"]] = ContextVar("query_budget_recording", default=None)
+
+
+class Recording:
+    def __init__(self):
+        self.statements: List[str] = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.resets = 0
+        self.checkouts = 0
+
+    @property
+    def round_trips(self) -> int:
+        return len(self.statements) + self.commits + self.rollbacks + self.resets
+
+    # Statements issued more than once by the request, a hint of a query in a loop
+    def repeated(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for statement in self.statements:
+            counts[statement] = counts.get(statement, 0) + 1
+        return {statement: count for statement, count in counts.items() if count > 1}
+
+
+def _current() -> Optional[Recording]:
+    return _recording.get()
+
+
+def _on_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    recording = _current()
+    if recording is not None:
+        text = re.sub(r"\s+", " ", statement).strip()
+        recording.statements.append(f"{text}  [executemany x{len(parameters)}]" if executemany else text)
+
+
+def _on_commit(conn) -> None:
+    recording = _current()
+    if recording is not None:
+        recording.commits += 1
+
+
+def _on_rollback(conn) -> None:
+    recording = _current()
+    if recording is not None:
+        recording.rollbacks += 1
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy) -> None:
+    recording = _current()
+    if recording is not None:
+        recording.checkouts += 1
+
+
+def _on_reset(dbapi_connection, connection_record, reset_state) -> None:
+    recording = _current()
+    if recording is not None:
+        recording.resets += 1
+
+
+def attach(engine) -> None:
+    from sqlalchemy import event
+    event.listen(engine, "before_cursor_execute", _on_execute)
+    event.listen(engine, "commit", _on_commit)
+    event.listen(engine, "rollback", _on_rollback)
+    event.listen(engine.pool, "checkout", _on_checkout)
+    event.listen(engine.pool, "reset", _on_reset)
+
+
+# ----Cases----!!
+# One request per case, run in this order against the same database, so later cases
+# use the rows earlier ones created. route is the route template the case covers and
+# budget the most SQL statements the request may run. warm sends the request once
+# before measuring, for reads whose caches (plan cache, user -> plan) fill on first
+# use; every token has already been authenticated once, so the principal cache is warm.
+
+class Case:
+    def __init__(self, method: str, route: str, budget: int, path: Optional[str] = None, as_user: Optional[str] = "admin",
+                 params: Optional[Dict[str, Any]] = None, json: Any = None, data: Optional[Dict[str, str]] = None,
+                 headers: Optional[Dict[str, str]] = None, status: int = 200, warm: bool = False, label: str = ""):
+        self.method = method
+        self.route = route
+        self.budget = budget
+        self.path = path or route
+        self.as_user = as_user
+        self.params = params
+        self.json = json
+        self.data = data
+        self.headers = headers or {}
+        self.status = status
+        self.warm = warm
+        self.label = label
+
+    @property
+    def key(self) -> str:
+        return f"{self.method} {self.route}"
+
+    @property
+    def name(self) -> str:
+        return f"{self.key} ({self.label})" if self.label else self.key
+
+
+def _cloud_service_cases() -> List[Case]:
+    from cloud_services import CLOUD_SERVICES
+    cases = [
+        Case(method, f"/cloud-services{path}", 1, as_user="customer", params={"user_id": CUSTOMER_ID}, warm=True)
+        for method, path, _ in CLOUD_SERVICES
+    ]
+    operations = [{"operation": path.strip("/")} for _, path, _ in CLOUD_SERVICES]
+    cases += [
+        # First use of a key claims it, then stores the response; the retry replays it from the worker's cache
+        Case("POST", "/cloud-services/create-vm", 3, as_user="customer", params={"user_id": CUSTOMER_ID},
+             headers={"Idempotency-Key": "query-budget-1"}, label="Idempotency-Key"),
+        Case("POST", "/cloud-services/create-vm", 0, as_user="customer", params={"user_id": CUSTOMER_ID},
+             headers={"Idempotency-Key": "query-budget-1"}, label="Idempotency-Key replay"),
+        Case("POST", "/cloud-services/batch", 1, as_user="customer", json={"user_id": CUSTOMER_ID, "operations": operations},
+             warm=True),
+    ]
+    return cases
+
+
+def build_cases() -> List[Case]:
+    from benchmark import BENCH_PASSWORD
+    customer = f"/subscriptions/{CUSTOMER_ID}"
+    plan = {"id": 0, "name": "Query Budget", "description": "Created by query_budget.py", "usage_limit": 10}
+    permission = {"id": 0, "name": "Query Budget", "api_endpoint": "/query-budget", "description": "Created by query_budget.py"}
+    return [
+        Case("GET", "/metrics", 0, as_user=None),
+        Case("POST", "/register", 3, as_user=None, json={"username": "query-budget-user", "password": BENCH_PASSWORD, "role": "customer"}),
+        Case("POST", "/token", 1, as_user=None, data={"username": "bench-user-0", "password": BENCH_PASSWORD}),
+        Case("GET", "/plans", 0, as_user=None, warm=True),
+        Case("GET", "/plans", 2, as_user=None, params={"limit": 2}, label="paged"),
+        Case("POST", "/create-plan", 2, json=plan),
+        Case("POST", "/map-permission", 4, params={"plan_id": NEW_PLAN_ID, "permission_id": 1}),
+        Case("PUT", "/update-plan/{plan_id}", 3, path=f"/update-plan/{NEW_PLAN_ID}", json={**plan, "usage_limit": 20}),
+        Case("GET", "/permissions", 1, warm=True),
+        Case("GET", "/users", 1, warm=True),
+        Case("POST", "/create-permission", 2, json=permission),
+        Case("PUT", "/update-permission/{permission_id}", 3, path=f"/update-permission/{NEW_PERMISSION_ID}",
+             json={**permission, "description": "Updated by query_budget.py"}),
+        Case("DELETE", "/delete-permission/{permission_id}", 4, path=f"/delete-permission/{NEW_PERMISSION_ID}"),
+        Case("POST", "/set-rate-limit", 4, json={"plan_id": NEW_PLAN_ID, "requests_per_second": 10}),
+        Case("DELETE", "/delete-rate-limit/{rate_limit_id}", 2, path=f"/delete-rate-limit/{NEW_RATE_LIMIT_ID}"),
+        Case("POST", "/subscriptions", 4, as_user="customer", json={"user_id": NEW_USER_ID, "plan_id": 1}),
+        Case("GET", "/subscriptions", 1, warm=True),
+        Case("GET", "/subscriptions/{user_id}", 1, path=customer, as_user="customer", warm=True),
+        Case("GET", "/subscriptions/{user_id}/usage", 1, path=f"{customer}/usage", as_user="customer", warm=True),
+        Case("PUT", "/subscriptions/{user_id}/{plan_id}", 4, path=f"/subscriptions/{NEW_USER_ID}/3"),
+        Case("GET", "/access/{user_id}/{api_request}", 1, path=f"/access/{CUSTOMER_ID}/create-vm", as_user="customer", warm=True),
+        Case("GET", "/usage/{user_id}", 2, path=f"/usage/{CUSTOMER_ID}", as_user="customer", warm=True),
+        Case("GET", "/usage/{user_id}/history", 1, path=f"/usage/{CUSTOMER_ID}/history", as_user="customer", warm=True),
+        *[Case("GET", f"/{name}/stats", 0, warm=True) for name in (
+            "plan-cache", "usage-buffer", "rate-limit", "usage-events", "password-hash", "db-pool", "logging",
+            "entitlements", "metering", "billing-periods", "usage-counters", "idempotency", "read-routing")],
+        *_cloud_service_cases(),
+        Case("POST", "/bulk/plans", 1, json=[{k: v for k, v in plan.items() if k != "id"} for _ in range(10)]),
+        Case("POST", "/bulk/permissions", 1, json=[{k: v for k, v in permission.items() if k != "id"} for _ in range(10)]),
+        Case("POST", "/bulk/mappings", 4, json=[{"plan_id": NEW_PLAN_ID, "permission_id": api_id} for api_id in range(2, 10)]),
+        Case("POST", "/bulk/subscriptions", 3, json=[{"user_id": CUSTOMER_ID, "plan_id": 1}], label="already subscribed"),
+        Case("DELETE", "/delete-plan/{plan_id}", 4, path=f"/delete-plan/{NEW_PLAN_ID}"),
+    ]
+
+
+# Route keys ("METHOD /path") of every API route of the app. Included routers are not
+# listed in app.routes, so their routes come from the OpenAPI schema.
+def app_routes(app) -> List[str]:
+    from fastapi.routing import APIRoute
+    routes = {f"{method} {route.path}" for route in app.routes if isinstance(route, APIRoute)
+              for method in route.methods if method != "HEAD"}
+    routes.update(f"{method.upper()} {path}" for path, operations in app.openapi()["paths"].items() for method in operations)
+    return sorted(routes)
+
+
+# ----Runner----!!
+
+async def _send(client: httpx.AsyncClient, case: Case, tokens: Dict[str, str]) -> httpx.Response:
+    headers = dict(case.headers)
+    if case.as_user:
+        headers["Authorization"] = f"Bearer {tokens[case.as_user]}"
+    return await client.request(case.method, case.path, params=case.params, json=case.json, data=case.data, headers=headers)
+
+
+async def measure(client: httpx.AsyncClient, case: Case, tokens: Dict[str, str]) -> Dict[str, Any]:
+    if case.warm:
+        await _send(client, case, tokens)
+    recording = Recording()
+    token = _recording.set(recording)
+    try:
+        response = await _send(client, case, tokens)
+    finally:
+        _recording.reset(token)
+    statements = len(recording.statements)
+    return {
+        "case": case.name,
+        "route": case.key,
+        "status": response.status_code,
+        "expected_status": case.status,
+        "budget": case.budget,
+        "statements": statements,
+        "round_trips": recording.round_trips,
+        "connections": recording.checkouts,
+        "over_budget": statements > case.budget,
+        "queries": recording.statements,
+        "repeated": recording.repeated(),
+    }
+
+
+async def run(verbose: bool) -> Dict[str, Any]:
+    import database
+    from app import app
+    from auth import create_access_token
+    from benchmark import seed
+
+    await seed(BUDGET_USERS, PRIME_PLAN_ID)
+    attach(database.async_engine.sync_engine)
+    cases = build_cases()
+    routes = app_routes(app)
+    covered = {case.key for case in cases}
+    tokens = {
+        "admin": create_access_token({"username": "bench-admin", "role": "admin"}),
+        "customer": create_access_token({"username": "bench-user-0", "role": "customer"}),
+    }
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://query-budget") as client:
+            # Authenticate every token once, so the cases measure the principal cache as in steady state
+            for role, token in tokens.items():
+                await client.get(f"/subscriptions/{CUSTOMER_ID}", headers={"Authorization": f"Bearer {token}"})
+            for case in cases:
+                results.append(await measure(client, case, tokens))
+                print(_format_row(results[-1], verbose), flush=True)
+    return {
+        "results": results,
+        "uncovered": [route for route in routes if route not in covered],
+        "unknown": sorted(covered - set(routes)),
+    }
+
+
+# ----Reporting----!!
+
+def _failed(result: Dict[str, Any]) -> bool:
+    return result["over_budget"] or result["status"] != result["expected_status"]
+
+
+def _format_row(result: Dict[str, Any], verbose: bool) -> str:
+    flags = []
+    if result["over_budget"]:
+        flags.append("OVER BUDGET")
+    if result["status"] != result["expected_status"]:
+        flags.append(f"STATUS {result['status']} (expected {result['expected_status']})")
+    row = (f"{result['case']:<58} {result['statements']:>3} / {result['budget']:<3} stmt  "
+           f"{result['round_trips']:>3} round trips  {result['connections']:>2} conn  {'  '.join(flags) or 'ok'}")
+    if verbose or _failed(result):
+        for query in result["queries"]:
+            marker = f"x{result['repeated'][query]} " if query in result["repeated"] else "   "
+            row += f"\n    {marker}{query}"
+    return row
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check the SQL statements each route runs against its budget")
+    parser.add_argument("--verbose", action="store_true", help="print the statements of every request")
+    parser.add_argument("--output", help="write the results, statements included, as JSON")
+    args = parser.parse_args(argv)
+
+    # A named in-memory database, shared by every pooled connection of this process. The
+    # app reads its DSNs and settings at import time, so set them first; the background
+    # sweep is left off, the cases measure the request path alone.
+    os.environ["DATABASE_BACKEND"] = "sqlite"
+    os.environ["DATABASE_URL"] = f"sqlite+pysqlite:///file:{DATABASE_NAME}?mode=memory&cache=shared&uri=true"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///file:{DATABASE_NAME}?mode=memory&cache=shared&uri=true"
+    os.environ.pop("ASYNC_REPLICA_DATABASE_URL", None)
+    os.environ["BILLING_SWEEP_ENABLED"] = "false"
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    report = asyncio.run(run(args.verbose))
+    failures = [result["case"] for result in report["results"] if _failed(result)]
+    for route in report["uncovered"]:
+        print(f"NO BUDGET  {route}")
+    for route in report["unknown"]:
+        print(f"UNKNOWN ROUTE  {route}")
+    print(f"{len(report['results'])} requests, {len(failures)} failed, {len(report['uncovered'])} routes without a budget")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "started_at": datetime.utcnow().isoformat(),
+                    "python": platform.python_version(),
+                },
+                **report,
+            }, f, indent=2)
+    return 1 if failures or report["uncovered"] or report["unknown"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
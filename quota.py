@@ -0,0 +1,8 @@
+from enum import Enum
+
+# Outcome of a single consume attempt
+class QuotaResult(str, Enum):
+    ALLOWED = "allowed"
+    DENIED = "denied"
+    OVER_LIMIT = "over_limit"
+    NOT_FOUND = "not_found"
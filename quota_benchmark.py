@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+# ----Quota Store Benchmark----!!
+# Drives each quota store backend from several processes at once (standing in for
+# uvicorn workers), every process hammering consume() on the same small set of users so
+# the counters are contended and run into their limit. Reports throughput and consume
+# latency per backend, and checks atomicity: the units admitted across all processes
+# must add up to the final counters, and no counter may end past the limit.
+#
+#   python quota_benchmark.py --processes 4 --ops 5000
+#   python quota_benchmark.py --backends mmap redis --redis-url redis://localhost:6379/0
+#
+# The memory backend is per process by design, so it runs in a single process. Without
+# --redis-url the redis backend runs against redis_standin.py on a free local port.
+# WARNING: the database behind --database-url is dropped and re-created for the sql backend.
+
+BACKENDS = ["memory", "mmap", "redis", "sql"]
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///./quota_benchmark.db"
+# Seeded users have ids 2.. (benchmark.seed puts its admin at id 1)
+FIRST_USER_ID = 2
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _create_store(backend: str, settings: Dict[str, Any]):
+    from quota_store import MemoryQuotaStore, MmapQuotaStore, RedisQuotaStore, SqlQuotaStore
+    if backend == "memory":
+        return MemoryQuotaStore()
+    if backend == "mmap":
+        return MmapQuotaStore(settings["mmap_path"], settings["mmap_slots"])
+    if backend == "redis":
+        return RedisQuotaStore(settings["redis_url"], settings["redis_prefix"])
+    from database import AsyncSessionLocal
+    return SqlQuotaStore(AsyncSessionLocal)
+
+
+# ----Worker Process----!!
+
+async def _drive(backend: str, settings: Dict[str, Any], start, worker: int) -> Dict[str, Any]:
+    store = _create_store(backend, settings)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + settings["users"]))
+    for user_id in users:
+        await store.seed(user_id, None, 0)
+    rng = random.Random(settings["seed"] * 1000 + worker)
+    latencies: List[float] = []
+    admitted = rejected = errors = 0
+    remaining = settings["ops"]
+
+    async def client() -> None:
+        nonlocal admitted, rejected, errors, remaining
+        while remaining > 0:
+            remaining -= 1
+            user_id = rng.choice(users)
+            started = time.perf_counter()
+            try:
+                consumed = await store.consume(user_id, None, 1, settings["limit"])
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            if consumed:
+                admitted += 1
+            else:
+                rejected += 1
+
+    # Every process seeds first, then they all start together
+    start.wait()
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(settings["concurrency"])))
+    elapsed = time.perf_counter() - started
+    final = {user_id: await store.get(user_id, None) for user_id in users} if backend == "memory" else None
+    await store.close()
+    return {"admitted": admitted, "rejected": rejected, "errors": errors, "elapsed": elapsed,
+            "latencies": latencies, "final": final}
+
+
+def _worker(backend: str, settings: Dict[str, Any], start, results, worker: int) -> None:
+    results.put(asyncio.run(_drive(backend, settings, start, worker)))
+
+
+# ----Runner----!!
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def _final_counters(backend: str, settings: Dict[str, Any]) -> Dict[int, int]:
+    store = _create_store(backend, settings)
+    try:
+        users = range(FIRST_USER_ID, FIRST_USER_ID + settings["users"])
+        return {user_id: await store.get(user_id, None) or 0 for user_id in users}
+    finally:
+        await store.close()
+
+
+def run_backend(backend: str, settings: Dict[str, Any], processes: int) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    start = context.Event()
+    results = context.Queue()
+    workers = [context.Process(target=_worker, args=(backend, settings, start, results, i)) for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    # Give every process time to import and seed before the start signal
+    time.sleep(1.0)
+    start.set()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    admitted = sum(outcome["admitted"] for outcome in outcomes)
+    if backend == "memory":
+        final = outcomes[0]["final"]
+    else:
+        final = asyncio.run(_final_counters(backend, settings))
+    latencies = sorted(latency for outcome in outcomes for latency in outcome["latencies"])
+    elapsed = max(outcome["elapsed"] for outcome in outcomes)
+    completed = len(latencies)
+    over_limit = [user_id for user_id, usage in final.items() if usage > settings["limit"]]
+    return {
+        "processes": processes,
+        "operations": completed,
+        "throughput_ops": round(completed / elapsed, 1) if elapsed else 0.0,
+        "p50_us": round(percentile(latencies, 0.50) * 1e6, 1),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+        "admitted": admitted,
+        "rejected": sum(outcome["rejected"] for outcome in outcomes),
+        "errors": sum(outcome["errors"] for outcome in outcomes),
+        "counted": sum(final.values()),
+        "consistent": sum(final.values()) == admitted and not over_limit,
+    }
+
+
+def _format_row(backend: str, result: Dict[str, Any]) -> str:
+    return (f"{backend:<8} x{result['processes']:<3} {result['throughput_ops']:>10} ops/s  p50 {result['p50_us']:>9} us  "
+            f"p99 {result['p99_us']:>9} us  admitted {result['admitted']:>7}  counted {result['counted']:>7}  "
+            f"rejected {result['rejected']:>7}  errors {result['errors']}  {'ok' if result['consistent'] else 'INCONSISTENT'}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare the quota store backends under multi-process load")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients per process")
+    parser.add_argument("--ops", type=int, default=5000, help="consume calls per process")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=500, help="usage limit per user; keep users * limit below the total ops")
+    parser.add_argument("--redis-url", help="Redis server to use instead of a redis_standin.py subprocess")
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="quota-benchmark-")
+    settings = {
+        "users": args.users,
+        "ops": args.ops,
+        "limit": args.limit,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "mmap_path": os.path.join(workdir, "quota.mmap"),
+        "mmap_slots": max(1024, args.users * 4),
+        "redis_url": args.redis_url,
+        "redis_prefix": f"quota-benchmark:{os.getpid()}:",
+    }
+
+    standin = None
+    if "redis" in args.backends and not args.redis_url:
+        port = _free_port()
+        settings["redis_url"] = f"redis://127.0.0.1:{port}/0"
+        standin = subprocess.Popen([sys.executable, "redis_standin.py", "--port", str(port)],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        time.sleep(1.0)
+    if "sql" in args.backends:
+        # Worker processes inherit the environment, and the app reads its DSNs at import time
+        os.environ["ASYNC_DATABASE_URL"] = args.database_url
+        from benchmark import seed
+        asyncio.run(seed(args.users, 4))
+
+    results = {}
+    try:
+        for backend in args.backends:
+            processes = 1 if backend == "memory" else args.processes
+            results[backend] = run_backend(backend, settings, processes)
+            print(_format_row(backend, results[backend]), flush=True)
+    finally:
+        if standin is not None:
+            standin.terminate()
+            standin.wait(timeout=10)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "started_at": datetime.utcnow().isoformat(),
+                    "processes": args.processes,
+                    "concurrency": args.concurrency,
+                    "ops": args.ops,
+                    "users": args.users,
+                    "limit": args.limit,
+                    "python": platform.python_version(),
+                },
+                "backends": results,
+            }, f, indent=2)
+    return 0 if all(result["consistent"] for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,442 @@
+import asyncio
+from abc import ABC, abstractmethod
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+from sqlalchemy import update
+from sqlalchemy.future import select
+from models import Subscription
+from billing_periods import debit_values, usage_expression
+
+# ----Quota Stores----!!
+# Where the per-user usage counters live in buffered accounting (usage_buffer). Every
+# backend offers the same atomic consume: add `units` to the counter only if the result
+# stays within `limit` (0 = unlimited), in one step no other worker can interleave with.
+#
+#   QUOTA_STORE=memory   a dict in the worker; single worker only
+#   QUOTA_STORE=mmap     a hash table in a memory-mapped file, shared by the workers of one host
+#   QUOTA_STORE=redis    a Redis (or Redis-protocol) server, shared by every worker and pod
+#   QUOTA_STORE=sql      the subscription row itself, one conditional UPDATE per consume
+#
+# Counters are seeded from subscription.usage on first use; the buffer writes the
+# increments back to the subscription table, so the database stays the record of usage.
+# A counter is identified by (user_id, period_id): the user's billing period
+# (billing_periods.py), None for a plan whose usage never resets. Each backend maps the
+# pair to its own key.
+
+# Unset: "memory" when USAGE_ACCOUNTING=buffered, else "sql" (direct accounting, no buffer)
+QUOTA_STORE = os.getenv("QUOTA_STORE", "memory" if os.getenv("USAGE_ACCOUNTING", "direct") == "buffered" else "sql")
+QUOTA_MMAP_PATH = os.getenv("QUOTA_MMAP_PATH", os.path.join(tempfile.gettempdir(), "stratosphere-quota.mmap"))
+QUOTA_MMAP_SLOTS = int(os.getenv("QUOTA_MMAP_SLOTS", "65536"))
+QUOTA_REDIS_URL = os.getenv("QUOTA_REDIS_URL", "redis://localhost:6379/0")
+QUOTA_REDIS_PREFIX = os.getenv("QUOTA_REDIS_PREFIX", "quota:")
+
+
+class QuotaStoreError(RuntimeError):
+    pass
+
+
+class QuotaStore(ABC):
+    name = "base"
+    # Whether every worker sees the same counters
+    shared = False
+    # Whether the counter is the subscription row itself, with nothing to write back
+    is_row = False
+
+    def __init__(self):
+        self.consumed = 0
+        self.rejected = 0
+        self.missing = 0
+
+    # Set the counter unless it already exists
+    @abstractmethod
+    async def seed(self, user_id: int, period_id: Optional[int], usage: int) -> None:
+        ...
+
+    # Atomically add units if the counter stays within limit (0 = unlimited).
+    # True if consumed, False if over the limit, None if the counter does not exist.
+    async def consume(self, user_id: int, period_id: Optional[int], units: int, limit: int) -> Optional[bool]:
+        consumed = await self._consume(user_id, period_id, units, limit)
+        if consumed:
+            self.consumed += units
+        elif consumed is None:
+            self.missing += 1
+        else:
+            self.rejected += 1
+        return consumed
+
+    @abstractmethod
+    async def _consume(self, user_id: int, period_id: Optional[int], units: int, limit: int) -> Optional[bool]:
+        ...
+
+    @abstractmethod
+    async def get(self, user_id: int, period_id: Optional[int]) -> Optional[int]:
+        ...
+
+    # Drop the counter so the next seed re-reads it
+    @abstractmethod
+    async def forget(self, user_id: int, period_id: Optional[int]) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "shared": self.shared,
+            "consumed": self.consumed,
+            "rejected": self.rejected,
+            "missing": self.missing,
+        }
+
+
+# ----In-process Store----!!
+# The event loop runs one coroutine at a time and nothing here awaits, so every
+# operation is atomic within the worker.
+
+class MemoryQuotaStore(QuotaStore):
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._usage: Dict[Tuple[int, Optional[int]], int] = {}
+
+    async def seed(self, user_id: int, period_id: Optional[int], usage: int) -> None:
+        self._usage.setdefault((user_id, period_id), usage)
+
+    async def _consume(self, user_id: int, period_id: Optional[int], units: int, limit: int) -> Optional[bool]:
+        usage = self._usage.get((user_id, period_id))
+        if usage is None:
+            return None
+        if limit and usage + units > limit:
+            return False
+        self._usage[(user_id, period_id)] = usage + units
+        return True
+
+    async def get(self, user_id: int, period_id: Optional[int]) -> Optional[int]:
+        return self._usage.get((user_id, period_id))
+
+    async def forget(self, user_id: int, period_id: Optional[int]) -> None:
+        self._usage.pop((user_id, period_id), None)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "counters": len(self._usage)}
+
+
+# ----Shared-memory Store----!!
+# An open-addressing hash table of (key, usage) int64 pairs in a memory-mapped
+# file. Every worker on the host maps the same file; an exclusive flock around each
+# operation makes the read-check-write atomic across processes. Removed entries become
+# tombstones so probe chains stay intact; the table is sized once (QUOTA_MMAP_SLOTS)
+# and seeding into a full table raises QuotaStoreError.
+
+_MMAP_MAGIC = 0x5154414D  # "QTAM"
+_MMAP_HEADER = struct.Struct("<qq")  # magic, slots
+_MMAP_SLOT = struct.Struct("<qq")  # key (0 empty, -1 tombstone), usage
+_EMPTY = 0
+_TOMBSTONE = -1
+
+
+# Slot key of a counter: the user id and the period id + 1 (0 for none; period ids are day
+# numbers, well under 2**20), plus 1 so it never reads as an empty slot
+def _mmap_key(user_id: int, period_id: Optional[int]) -> int:
+    return (user_id << 20 | (period_id + 1 if period_id is not None else 0)) + 1
+
+
+class MmapQuotaStore(QuotaStore):
+    name = "mmap"
+    shared = True
+
+    def __init__(self, path: str = QUOTA_MMAP_PATH, slots: int = QUOTA_MMAP_SLOTS):
+        super().__init__()
+        import fcntl
+        self._fcntl = fcntl
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = _MMAP_HEADER.size + slots * _MMAP_SLOT.size
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, _MMAP_HEADER.pack(_MMAP_MAGIC, slots), 0)
+            magic, self.slots = _MMAP_HEADER.unpack(os.pread(self._fd, _MMAP_HEADER.size, 0))
+            if magic != _MMAP_MAGIC:
+                raise QuotaStoreError(f"{path} is not a quota table")
+            self._map = mmap.mmap(self._fd, _MMAP_HEADER.size + self.slots * _MMAP_SLOT.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _lock(self) -> None:
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+
+    def _unlock(self) -> None:
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+    def _offset(self, slot: int) -> int:
+        return _MMAP_HEADER.size + slot * _MMAP_SLOT.size
+
+    # Offset of the key's slot, or of the slot a new key would take (None if the table is full)
+    def _find(self, key: int):
+        slot = (key * 2654435761) % self.slots
+        free = None
+        for _ in range(self.slots):
+            offset = self._offset(slot)
+            stored, _ = _MMAP_SLOT.unpack_from(self._map, offset)
+            if stored == key:
+                return offset, True
+            if stored == _EMPTY:
+                return (free if free is not None else offset), False
+            if stored == _TOMBSTONE and free is None:
+                free = offset
+            slot = (slot + 1) % self.slots
+        return free, False
+
+    async def seed(self, user_id: int, period_id: Optional[int], usage: int) -> None:
+        key = _mmap_key(user_id, period_id)
+        self._lock()
+        try:
+            offset, found = self._find(key)
+            if found:
+                return
+            if offset is None:
+                raise QuotaStoreError(f"Quota table {self.path} is full ({self.slots} slots)")
+            _MMAP_SLOT.pack_into(self._map, offset, key, usage)
+        finally:
+            self._unlock()
+
+    async def _consume(self, user_id: int, period_id: Optional[int], units: int, limit: int) -> Optional[bool]:
+        key = _mmap_key(user_id, period_id)
+        self._lock()
+        try:
+            offset, found = self._find(key)
+            if not found:
+                return None
+            _, usage = _MMAP_SLOT.unpack_from(self._map, offset)
+            if limit and usage + units > limit:
+                return False
+            _MMAP_SLOT.pack_into(self._map, offset, key, usage + units)
+            return True
+        finally:
+            self._unlock()
+
+    async def get(self, user_id: int, period_id: Optional[int]) -> Optional[int]:
+        self._lock()
+        try:
+            offset, found = self._find(_mmap_key(user_id, period_id))
+            return _MMAP_SLOT.unpack_from(self._map, offset)[1] if found else None
+        finally:
+            self._unlock()
+
+    async def forget(self, user_id: int, period_id: Optional[int]) -> None:
+        self._lock()
+        try:
+            offset, found = self._find(_mmap_key(user_id, period_id))
+            if found:
+                _MMAP_SLOT.pack_into(self._map, offset, _TOMBSTONE, 0)
+        finally:
+            self._unlock()
+
+    async def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+    def stats(self) -> dict:
+        return {**super().stats(), "path": self.path, "slots": self.slots}
+
+
+# ----Redis Store----!!
+# Speaks RESP2 directly over one connection per worker (no client library needed).
+# Consume is a Lua script, which Redis runs atomically. Anything that implements GET,
+# SET NX, DEL, EVALSHA/EVAL of these scripts works, e.g. redis_standin.py for local runs.
+
+REDIS_CONSUME_SCRIPT = """
+local usage = redis.call('GET', KEYS[1])
+if not usage then return -2 end
+usage = tonumber(usage)
+local units = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+if limit > 0 and usage + units > limit then return -1 end
+return redis.call('INCRBY', KEYS[1], units)
+"""
+REDIS_CONSUME_SHA = hashlib.sha1(REDIS_CONSUME_SCRIPT.encode()).hexdigest()
+
+
+class RedisError(QuotaStoreError):
+    pass
+
+
+class RedisConnection:
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # One request/reply in flight at a time on the connection
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._roundtrip("AUTH", self.password)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RedisError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(body)
+            return None if count < 0 else [await self._read_reply() for _ in range(count)]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    async def _roundtrip(self, *args):
+        payload = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            payload.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self._writer.write(b"".join(payload))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def execute(self, *args):
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+            try:
+                return await self._roundtrip(*args)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Drop the broken connection; the next command reconnects
+                await self.close()
+                raise
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+
+class RedisQuotaStore(QuotaStore):
+    name = "redis"
+    shared = True
+
+    def __init__(self, url: str = QUOTA_REDIS_URL, prefix: str = QUOTA_REDIS_PREFIX):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self._redis = RedisConnection(url)
+
+    def _key(self, user_id: int, period_id: Optional[int]) -> str:
+        return f"{self.prefix}{user_id}" if period_id is None else f"{self.prefix}{user_id}:{period_id}"
+
+    async def seed(self, user_id: int, period_id: Optional[int], usage: int) -> None:
+        await self._redis.execute("SET", self._key(user_id, period_id), usage, "NX")
+
+    async def _consume(self, user_id: int, period_id: Optional[int], units: int, limit: int) -> Optional[bool]:
+        key = self._key(user_id, period_id)
+        try:
+            usage = await self._redis.execute("EVALSHA", REDIS_CONSUME_SHA, 1, key, units, limit)
+        except RedisError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            # First use on this server: send the script body, which also caches it
+            usage = await self._redis.execute("EVAL", REDIS_CONSUME_SCRIPT, 1, key, units, limit)
+        if usage == -2:
+            return None
+        return usage != -1
+
+    async def get(self, user_id: int, period_id: Optional[int]) -> Optional[int]:
+        usage = await self._redis.execute("GET", self._key(user_id, period_id))
+        return None if usage is None else int(usage)
+
+    async def forget(self, user_id: int, period_id: Optional[int]) -> None:
+        await self._redis.execute("DEL", self._key(user_id, period_id))
+
+    async def close(self) -> None:
+        await self._redis.close()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "host": self._redis.host, "port": self._redis.port, "db": self._redis.db}
+
+
+# ----SQL Store----!!
+# The subscription row is the counter: consume is one conditional UPDATE, the same
+# statement direct accounting uses (rolling a row still in a closed billing period over
+# first), so it is shared by every worker and pod. Each call runs in its own session from
+# session_factory. The row is already the record of usage, so the write-behind buffer
+# does not run on this store.
+
+class SqlQuotaStore(QuotaStore):
+    name = "sql"
+    shared = True
+    is_row = True
+
+    def __init__(self, session_factory):
+        super().__init__()
+        self._session_factory = session_factory
+
+    # The row exists for as long as the subscription does
+    async def seed(self, user_id: int, period_id: Optional[int], usage: int) -> None:
+        pass
+
+    async def _consume(self, user_id: int, period_id: Optional[int], units: int, limit: int) -> Optional[bool]:
+        if period_id is None:
+            statement, usage = update(Subscription).values(usage=Subscription.usage + units), Subscription.usage
+        else:
+            statement, usage = update(Subscription).ordered_values(*debit_values(period_id, units)), usage_expression(period_id)
+        conditions = [Subscription.user_id == user_id]
+        if limit:
+            conditions.append(usage + units <= limit)
+        async with self._session_factory() as db:
+            result = await db.execute(statement.where(*conditions).execution_options(synchronize_session=False))
+            await db.commit()
+            if result.rowcount:
+                return True
+            exists = await db.scalar(select(Subscription.user_id).filter(Subscription.user_id == user_id))
+            return False if exists is not None else None
+
+    async def get(self, user_id: int, period_id: Optional[int]) -> Optional[int]:
+        async with self._session_factory() as db:
+            row = (await db.execute(
+                select(Subscription.usage, Subscription.period_id).filter(Subscription.user_id == user_id)
+            )).first()
+        if row is None:
+            return None
+        return 0 if period_id is not None and row.period_id < period_id else row.usage
+
+    async def forget(self, user_id: int, period_id: Optional[int]) -> None:
+        pass
+
+
+def create_quota_store(backend: str, session_factory=None) -> QuotaStore:
+    if backend == "memory":
+        return MemoryQuotaStore()
+    if backend == "mmap":
+        return MmapQuotaStore()
+    if backend == "redis":
+        return RedisQuotaStore()
+    if backend == "sql":
+        return SqlQuotaStore(session_factory)
+    raise ValueError(f"Unknown quota store {backend!r}; expected memory, mmap, redis or sql")
@@ -0,0 +1,138 @@
+import math
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models import Subscription
+from plan_cache import plan_cache, PLAN_CACHE_TTL_SECONDS
+
+# ----Rate Limiting----!!
+# Per-plan requests/second and requests/minute windows (optionally per endpoint), checked
+# in memory before any quota query. Each window is a GCRA token bucket: the state per
+# (user, window) is a single float, the "theoretical arrival time", refilled lazily on
+# the next request. Once a user's plan is known, throttled requests never touch MySQL.
+
+# Bucket states kept before expired ones are swept
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class RateDecision:
+    __slots__ = ("allowed", "limit", "remaining", "reset", "retry_after", "policy")
+
+    def __init__(self, allowed: bool, limit: int, remaining: int, reset: float, retry_after: float, policy: str):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.retry_after = retry_after
+        self.policy = policy
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(math.ceil(self.reset)),
+            "RateLimit-Policy": self.policy,
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimiter:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS, user_plan_ttl: float = PLAN_CACHE_TTL_SECONDS):
+        self.max_keys = max_keys
+        self.user_plan_ttl = user_plan_ttl
+        self.allowed = 0
+        self.throttled = 0
+        # (user_id, rule key) -> theoretical arrival time
+        self._tat: Dict[Tuple[int, Tuple[int, int]], float] = {}
+        # user_id -> (plan_id, expires_at)
+        self._user_plans: Dict[int, Tuple[int, float]] = {}
+
+    # Plan of the user, cached for the plan TTL
+    async def plan_of(self, user_id: int, db: AsyncSession) -> Optional[int]:
+        cached = self._user_plans.get(user_id)
+        now = time.monotonic()
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        plan_id = await db.scalar(select(Subscription.plan_id).filter(Subscription.user_id == user_id))
+        if plan_id is None:
+            return None
+        if len(self._user_plans) >= self.max_keys:
+            self._user_plans.clear()
+        self._user_plans[user_id] = (plan_id, now + self.user_plan_ttl)
+        return plan_id
+
+    # Forget a user's plan, e.g. after the subscription moved to another plan
+    def forget_user(self, user_id: int) -> None:
+        self._user_plans.pop(user_id, None)
+
+    # Take one request from every window that applies to any of the endpoints (a batch counts
+    # as one request per window). None when the plan has no rate limits. plan_id, when the
+    # caller already knows the user's plan, saves the lookup.
+    async def check(self, user_id: int, api_endpoints: Sequence[str], db: AsyncSession,
+                    plan_id: Optional[int] = None) -> Optional[RateDecision]:
+        if plan_id is None:
+            plan_id = await self.plan_of(user_id, db)
+        if plan_id is None:
+            return None
+        plan = await plan_cache.get(plan_id, db)
+        if not plan or not plan.rate_rules:
+            return None
+        rules = [rule for rule in plan.rate_rules
+                 if rule.matcher is None or any(rule.matcher.match(api_endpoint) for api_endpoint in api_endpoints)]
+        if not rules:
+            return None
+
+        now = time.monotonic()
+        policy = ", ".join(f"{rule.limit};w={rule.period}" for rule in rules)
+        updates: List[Tuple[Tuple[int, Tuple[int, int]], float]] = []
+        tightest = None
+        for rule in rules:
+            interval = rule.period / rule.limit
+            tolerance = rule.period - interval
+            key = (user_id, rule.key)
+            tat = max(self._tat.get(key, now), now)
+            if tat - now > tolerance:
+                self.throttled += 1
+                return RateDecision(False, rule.limit, 0, tat - now, tat - now - tolerance, policy)
+            new_tat = tat + interval
+            remaining = max(0, math.floor((tolerance - (new_tat - now)) / interval) + 1)
+            updates.append((key, new_tat))
+            if tightest is None or remaining < tightest[1]:
+                tightest = (rule.limit, remaining, new_tat - now)
+
+        # Only debit the buckets once every window has admitted the request
+        if len(self._tat) + len(updates) > self.max_keys:
+            self._sweep(now)
+        for key, new_tat in updates:
+            self._tat[key] = new_tat
+        self.allowed += 1
+        limit, remaining, reset = tightest
+        return RateDecision(True, limit, remaining, reset, 0.0, policy)
+
+    # Drop buckets that have fully refilled; they are equivalent to no state at all
+    def _sweep(self, now: float) -> None:
+        self._tat = {key: tat for key, tat in self._tat.items() if tat > now}
+        if len(self._tat) >= self.max_keys:
+            self._tat.clear()
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+            "buckets": len(self._tat),
+            "tracked_users": len(self._user_plans),
+        }
+
+
+rate_limiter = RateLimiter()
+
+
+# Raise 429 with Retry-After / RateLimit-* headers when the request is throttled
+def raise_if_throttled(decision: Optional[RateDecision]) -> None:
+    if decision is not None and not decision.allowed:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded. Retry later.", headers=decision.headers())
@@ -0,0 +1,239 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import List, Optional
+from fastapi import Request
+from sqlalchemy import event, insert, update
+from sqlalchemy.future import select
+from database import AsyncSessionLocal, ReplicaSessionLocal, REPLICA_ENABLED
+from models import ReplicaHeartbeat
+from plan_cache import plan_cache
+
+logger = logging.getLogger(__name__)
+
+# ----Read Replica Routing----!!
+# Read-only routes take their session from get_read_db, which hands out a replica
+# session (database.ReplicaSessionLocal) unless one of these sends the read to the primary:
+#
+#   - read-your-writes: the client committed a write within REPLICA_STICKY_SECONDS. The
+#     worker that took the write remembers the client (by Authorization header, else
+#     address) and also sets a cookie, so the other workers honour it too.
+#   - a catalogue change in this worker within REPLICA_STICKY_SECONDS, since plan cache
+#     entries reloaded from a lagging replica would be kept for their whole TTL.
+#   - lag: every worker writes the time into replica_heartbeat on the primary every
+#     REPLICA_HEARTBEAT_SECONDS and reads it back from the replica; past
+#     REPLICA_MAX_LAG_SECONDS (or when the replica cannot be read) reads stay on the primary.
+#
+# Writes are detected by commits on the primary engine during the request.
+# With ASYNC_REPLICA_DATABASE_URL unset, everything uses the primary and none of this runs.
+#
+# Locally, two SQLite files work: point ASYNC_REPLICA_DATABASE_URL at the second one and run
+#   python read_routing.py replicate --source ./stratosphere.db --target ./replica.db
+
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "2"))
+REPLICA_HEARTBEAT_SECONDS = float(os.getenv("REPLICA_HEARTBEAT_SECONDS", "1"))
+# Recent writers remembered per worker
+REPLICA_STICKY_CLIENTS = int(os.getenv("REPLICA_STICKY_CLIENTS", "10000"))
+STICKY_COOKIE = "read_primary_until"
+
+# [wrote] for the current request; set by the middleware, flipped by primary commits
+_request_writes: ContextVar[Optional[List[bool]]] = ContextVar("request_writes", default=None)
+
+
+def _client_key(scope) -> str:
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            return hashlib.sha1(value).hexdigest()
+    client = scope.get("client")
+    return client[0] if client else ""
+
+
+class ReadRouter:
+    def __init__(self, sticky_seconds: float = REPLICA_STICKY_SECONDS, max_lag: float = REPLICA_MAX_LAG_SECONDS,
+                 heartbeat_interval: float = REPLICA_HEARTBEAT_SECONDS, max_clients: int = REPLICA_STICKY_CLIENTS):
+        self.enabled = False
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.heartbeat_interval = heartbeat_interval
+        self.max_clients = max_clients
+        # Seconds the replica is behind, None until measured or when it cannot be read
+        self.lag: Optional[float] = None
+        self._sticky: "OrderedDict[str, float]" = OrderedDict()
+        self._catalog_version = plan_cache.version
+        self._catalog_until = 0.0
+        self.replica_reads = 0
+        self.sticky_reads = 0
+        self.lagging_reads = 0
+        self.heartbeat_errors = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if not REPLICA_ENABLED:
+            return
+        self.enabled = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.enabled = False
+
+    async def _run(self) -> None:
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    # Write a heartbeat to the primary and measure how far behind the replica's copy is
+    async def probe(self) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                now_ms = int(time.time() * 1000)
+                result = await db.execute(update(ReplicaHeartbeat).where(ReplicaHeartbeat.id == 1).values(written_at=now_ms))
+                if not result.rowcount:
+                    await db.execute(insert(ReplicaHeartbeat).values(id=1, written_at=now_ms))
+                await db.commit()
+        except Exception:
+            self.heartbeat_errors += 1
+            logger.exception("Could not write the replica heartbeat")
+        try:
+            async with ReplicaSessionLocal() as db:
+                written_at = await db.scalar(select(ReplicaHeartbeat.written_at).where(ReplicaHeartbeat.id == 1))
+            self.lag = None if written_at is None else max(0.0, time.time() - written_at / 1000)
+        except Exception:
+            self.lag = None
+            self.heartbeat_errors += 1
+            logger.warning("Could not read the replica heartbeat", exc_info=True)
+
+    # Until when the client's reads go to the primary
+    def note_write(self, key: str) -> float:
+        until = time.time() + self.sticky_seconds
+        self._sticky[key] = until
+        self._sticky.move_to_end(key)
+        while len(self._sticky) > self.max_clients:
+            self._sticky.popitem(last=False)
+        return until
+
+    def use_replica(self, key: str, cookie_until: float = 0.0) -> bool:
+        if not self.enabled:
+            return False
+        now = time.time()
+        if plan_cache.version != self._catalog_version:
+            self._catalog_version = plan_cache.version
+            self._catalog_until = now + self.sticky_seconds
+        if now < self._catalog_until or now < cookie_until or now < self._sticky.get(key, 0.0):
+            self.sticky_reads += 1
+            return False
+        if self.lag is None or self.lag > self.max_lag:
+            self.lagging_reads += 1
+            return False
+        self.replica_reads += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "lag_seconds": self.lag,
+            "max_lag_seconds": self.max_lag,
+            "sticky_seconds": self.sticky_seconds,
+            "sticky_clients": len(self._sticky),
+            "replica_reads": self.replica_reads,
+            "primary_reads_sticky": self.sticky_reads,
+            "primary_reads_lagging": self.lagging_reads,
+            "heartbeat_errors": self.heartbeat_errors,
+        }
+
+
+read_router = ReadRouter()
+
+
+# Session factory for a read-only request
+def read_session_factory(request: Request):
+    try:
+        cookie_until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        cookie_until = 0.0
+    return ReplicaSessionLocal if read_router.use_replica(_client_key(request.scope), cookie_until) else AsyncSessionLocal
+
+
+# Dependency for the read-only routes, in place of get_async_db
+async def get_read_db(request: Request):
+    async with read_session_factory(request)() as session:
+        yield session
+
+
+# Mark the current request as a writer whenever the primary commits
+def track_writes(sync_engine) -> None:
+    @event.listens_for(sync_engine, "commit")
+    def _on_commit(conn):
+        writes = _request_writes.get()
+        if writes is not None:
+            writes[0] = True
+
+
+# Pure ASGI middleware: after a request that wrote, pin the client to the primary for
+# REPLICA_STICKY_SECONDS, in this worker and through the cookie in the others
+class ReadRoutingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not read_router.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        writes = [False]
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and writes[0]:
+                until = read_router.note_write(_client_key(scope))
+                cookie = f"{STICKY_COOKIE}={until:.3f}; Max-Age={int(read_router.sticky_seconds) + 1}; Path=/; HttpOnly; SameSite=Lax"
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode())]
+            await send(message)
+
+        token = _request_writes.set(writes)
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            _request_writes.reset(token)
+
+
+# ----Local Replication----!!
+# Stand-in replication for two SQLite files: copy the primary into the replica with the
+# backup API every few seconds. Lag is then up to one interval, as the heartbeat shows.
+
+def replicate_sqlite(source: str, target: str, every: float) -> None:
+    while True:
+        with sqlite3.connect(source) as primary, sqlite3.connect(target) as replica:
+            primary.backup(replica)
+        time.sleep(every)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Read replica helpers")
+    parser.add_argument("command", choices=["replicate"])
+    parser.add_argument("--source", default="./stratosphere.db", help="primary SQLite file")
+    parser.add_argument("--target", default="./replica.db", help="replica SQLite file")
+    parser.add_argument("--every", type=float, default=1.0, help="seconds between copies")
+    args = parser.parse_args(argv)
+    try:
+        replicate_sqlite(args.source, args.target, args.every)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
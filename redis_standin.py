@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import hashlib
+from typing import Callable, Dict, List, Optional
+from quota_store import REDIS_CONSUME_SHA
+
+# ----Redis Stand-in----!!
+# A small single-process server speaking the Redis protocol, for running and
+# benchmarking QUOTA_STORE=redis without a Redis install. It implements only what the
+# quota store uses: PING, AUTH, SELECT, GET, SET [NX], DEL, INCRBY, FLUSHDB and
+# EVAL/EVALSHA of the quota store's own Lua scripts, which it runs as the Python
+# equivalents below. Commands run one at a time on the event loop, so each script is
+# atomic just as it is in Redis. Data lives in memory and is gone when it stops.
+#
+#   python redis_standin.py --port 6379
+#   QUOTA_STORE=redis QUOTA_REDIS_URL=redis://localhost:6379/0 uvicorn app:app --workers 4
+
+
+class CommandError(Exception):
+    pass
+
+
+def _consume(data: Dict[bytes, bytes], keys: List[bytes], args: List[bytes]) -> int:
+    usage = data.get(keys[0])
+    if usage is None:
+        return -2
+    usage, units, limit = int(usage), int(args[0]), int(args[1])
+    if limit > 0 and usage + units > limit:
+        return -1
+    data[keys[0]] = str(usage + units).encode()
+    return usage + units
+
+
+# Lua scripts the stand-in can run, by SHA1
+SCRIPTS: Dict[str, Callable[[Dict[bytes, bytes], List[bytes], List[bytes]], int]] = {
+    REDIS_CONSUME_SHA: _consume,
+}
+
+
+def _encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, CommandError):
+        return b"-%s\r\n" % str(reply).encode()
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode()
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    return b"*%d\r\n" % len(reply) + b"".join(_encode(item) for item in reply)
+
+
+class RedisStandin:
+    def __init__(self):
+        self.databases: Dict[int, Dict[bytes, bytes]] = {}
+        self.commands = 0
+
+    def _run_script(self, data: Dict[bytes, bytes], sha: str, args: List[bytes]):
+        script = SCRIPTS.get(sha)
+        if script is None:
+            raise CommandError("NOSCRIPT No matching script. Please use EVAL.")
+        numkeys = int(args[0])
+        return script(data, args[1:1 + numkeys], args[1 + numkeys:])
+
+    def execute(self, db: int, command: List[bytes]):
+        name, args = command[0].upper(), command[1:]
+        data = self.databases.setdefault(db, {})
+        self.commands += 1
+        if name == b"PING":
+            return "PONG"
+        if name == b"AUTH":
+            return "OK"
+        if name == b"GET":
+            return data.get(args[0])
+        if name == b"SET":
+            if b"NX" in (arg.upper() for arg in args[2:]) and args[0] in data:
+                return None
+            data[args[0]] = args[1]
+            return "OK"
+        if name == b"DEL":
+            return sum(1 for key in args if data.pop(key, None) is not None)
+        if name == b"INCRBY":
+            value = int(data.get(args[0], b"0")) + int(args[1])
+            data[args[0]] = str(value).encode()
+            return value
+        if name == b"FLUSHDB":
+            data.clear()
+            return "OK"
+        if name == b"EVALSHA":
+            return self._run_script(data, args[0].decode().lower(), args[1:])
+        if name == b"EVAL":
+            return self._run_script(data, hashlib.sha1(args[0]).hexdigest(), args[1:])
+        raise CommandError(f"ERR unknown command '{name.decode()}'")
+
+    async def _read_command(self, reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, as typed into telnet / redis-cli --no-raw
+            return line.split()
+        command = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            command.append((await reader.readexactly(length + 2))[:-2])
+        return command
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        db = 0
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                if not command:
+                    continue
+                try:
+                    if command[0].upper() == b"SELECT":
+                        db = int(command[1])
+                        reply = "OK"
+                    else:
+                        reply = self.execute(db, command)
+                except CommandError as e:
+                    reply = e
+                except (IndexError, ValueError):
+                    reply = CommandError("ERR wrong number or type of arguments")
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int) -> None:
+    standin = RedisStandin()
+    server = await asyncio.start_server(standin.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Redis-protocol stand-in for the quota store")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
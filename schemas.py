@@ -1,5 +1,9 @@
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field, model_validator
+from datetime import datetime
+from typing import List, Optional
+
+# Plan.billing_period values; "none" clears it
+BILLING_PERIOD_PATTERN = "^(none|day|week|month)$"
 
 #pydantic models used to validate request and send response data 
 class PlanResponse(BaseModel):
@@ -7,6 +11,7 @@ class PlanResponse(BaseModel):
     name: str
     description: str
     usage_limit: int
+    billing_period: Optional[str] = Field(None, pattern=BILLING_PERIOD_PATTERN)
     
     class Config:
         from_attributes  = True
@@ -17,6 +22,7 @@ class PlanDetails(BaseModel):
     description: str
     endpoints: list
     usage_limit: int
+    billing_period: Optional[str] = None
         
 
 class UserCreate(BaseModel):
@@ -34,6 +40,14 @@ class UserResponse(BaseModel):
 
     class Config:
         from_attributes = True
+
+class UserRes(BaseModel):
+    id: int
+    username: str
+    role: str
+
+    class Config:
+        from_attributes = True
         
 class PlanUpdateResponse(BaseModel):
     message: str
@@ -83,6 +97,84 @@ class AccessControlResponse(BaseModel):
     access_status: str
     plan_name: str
     plan_description: str
-    accessible_endpoints: List[Endpoint]        
+    accessible_endpoints: List[Endpoint]
 
-        
+
+# Bulk admin payload items and results
+class PlanCreate(BaseModel):
+    name: str
+    description: str
+    usage_limit: int
+    billing_period: Optional[str] = Field(None, pattern=BILLING_PERIOD_PATTERN)
+
+class PermissionCreate(BaseModel):
+    name: str
+    api_endpoint: str
+    description: str
+
+class PlanPermissionCreate(BaseModel):
+    plan_id: int
+    permission_id: int
+
+class BulkError(BaseModel):
+    index: int
+    detail: str
+
+class BulkResult(BaseModel):
+    created: int
+    errors: List[BulkError]
+
+
+class RateLimitCreate(BaseModel):
+    plan_id: int
+    permission_id: Optional[int] = None
+    requests_per_second: Optional[int] = Field(None, ge=1)
+    requests_per_minute: Optional[int] = Field(None, ge=1)
+
+    # A rule without either limit would limit nothing
+    @model_validator(mode="after")
+    def check_limits(self):
+        if self.requests_per_second is None and self.requests_per_minute is None:
+            raise ValueError("Set requests_per_second or requests_per_minute")
+        return self
+
+class RateLimitRes(BaseModel):
+    id: int
+    plan_id: int
+    api_id: Optional[int]
+    requests_per_second: Optional[int]
+    requests_per_minute: Optional[int]
+
+    class Config:
+        from_attributes = True
+
+
+class UsageHistoryEntry(BaseModel):
+    bucket_start: datetime
+    endpoint: Optional[str]
+    count: int
+
+class UsageHistoryResponse(BaseModel):
+    user_id: int
+    granularity: str
+    usage: List[UsageHistoryEntry]
+
+
+class BatchOperation(BaseModel):
+    # Metered service path, e.g. "/create-vm"
+    operation: str
+
+class BatchRequest(BaseModel):
+    user_id: int
+    operations: List[BatchOperation] = Field(min_length=1)
+
+class BatchOperationResult(BaseModel):
+    index: int
+    operation: str
+    status: int
+    message: str
+
+class BatchResponse(BaseModel):
+    user_id: int
+    units: int
+    results: List[BatchOperationResult]
@@ -3,11 +3,12 @@ create table plan(
   name varchar(50),
   description varchar(255),
   usage_limit int,
+  billing_period varchar(10) NULL,
   PRIMARY KEY (id)
 );
 
 
-insert into plan values(1, 'Basic', 'Allows a user to access the first layer endpoints only for a limited usage', 50),
+insert into plan (id, name, description, usage_limit) values(1, 'Basic', 'Allows a user to access the first layer endpoints only for a limited usage', 50),
                        (2, 'Intermediate', 'Allows a user to access the first and second layer endpoints only for a limited usage', 100),
                        (3, 'Advanced', 'Allows a user to access 3 layers of endpoints for a limited usage', 200),
                        (4, 'Prime', 'Allows a user to access all the endpoints for a unimited usage', 0);
@@ -31,12 +32,27 @@ insert into endpoints values(1, 'Storage Bucket', '/create-bucket', 'Creates a n
 														(8, 'Logs', '/get-logs', 'View the log file'),
                             (9, 'Logs', '/delete-logs', 'Delete a log file');
                             
+create table users(
+	id int PRIMARY KEY AUTO_INCREMENT,
+  username varchar(50),
+  password varchar(255),
+  role varchar(50),
+  UNIQUE KEY ux_users_username (username)
+);
+
 create table subscription(
 	id int AUTO_INCREMENT,
   user_id int,
   plan_id int,
-  api_usage int,
-  PRIMARY KEY (id)
+  `usage` int,
+  period_id int NOT NULL DEFAULT 0,
+  previous_period_id int NULL,
+  previous_usage int NULL,
+  PRIMARY KEY (id),
+  UNIQUE KEY ux_subscription_user_id (user_id),
+  KEY ix_subscription_plan_id (plan_id),
+  CONSTRAINT fk_subscription_user_id FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+  CONSTRAINT fk_subscription_plan_id FOREIGN KEY (plan_id) REFERENCES plan(id)
 );
 
 create table plan_endpoints(
@@ -44,8 +60,10 @@ create table plan_endpoints(
   plan_id int,
   api_id int,
   PRIMARY KEY(id),
-  FOREIGN KEY (plan_id) REFERENCES plan(id),
-  FOREIGN KEY (api_id) REFERENCES endpoints(id)
+  UNIQUE KEY ux_plan_endpoints_plan_api (plan_id, api_id),
+  KEY ix_plan_endpoints_api_id (api_id),
+  CONSTRAINT fk_plan_endpoints_plan_id FOREIGN KEY (plan_id) REFERENCES plan(id) ON DELETE CASCADE,
+  CONSTRAINT fk_plan_endpoints_api_id FOREIGN KEY (api_id) REFERENCES endpoints(id) ON DELETE CASCADE
 );
 
 insert into plan_endpoints values(1,1,1),(2,1,2),(3,1,3),(4,2,1),(5,2,2),(6,2,3),(7,2,4),(8,2,5),(9,2,6),
@@ -53,21 +71,107 @@ insert into plan_endpoints values(1,1,1),(2,1,2),(3,1,3),(4,2,1),(5,2,2),(6,2,3)
                                 (19,4,1),(20,4,2),(21,4,3),(22,4,4),(23,4,5),(24,4,6),(25,4,7),(26,4,8),(27,4,9);
 
 
-create table users(
-	id int PRIMARY KEY AUTO_INCREMENT,
-  username varchar(50),
-  password varchar(255),
-  role varchar(50)
+create table plan_rate_limits(
+  id int AUTO_INCREMENT,
+  plan_id int,
+  api_id int NULL,
+  requests_per_second int NULL,
+  requests_per_minute int NULL,
+  PRIMARY KEY(id),
+  UNIQUE KEY ux_plan_rate_limits_plan_api (plan_id, api_id),
+  KEY ix_plan_rate_limits_api_id (api_id),
+  CONSTRAINT fk_plan_rate_limits_plan_id FOREIGN KEY (plan_id) REFERENCES plan(id) ON DELETE CASCADE,
+  CONSTRAINT fk_plan_rate_limits_api_id FOREIGN KEY (api_id) REFERENCES endpoints(id) ON DELETE CASCADE
 );
 
+create table usage_events(
+  id bigint AUTO_INCREMENT,
+  user_id int,
+  api_id int NULL,
+  created_at datetime,
+  inserted_at datetime NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY(id)
+);
 
+create table usage_rollups(
+  id int AUTO_INCREMENT,
+  user_id int,
+  api_id int NULL,
+  granularity varchar(5),
+  bucket_start datetime,
+  count int,
+  PRIMARY KEY(id),
+  UNIQUE KEY ux_usage_rollups_bucket (user_id, granularity, bucket_start, api_id)
+);
 
+create table usage_rollup_progress(
+  id int,
+  last_event_id bigint,
+  PRIMARY KEY(id)
+);
 
+insert into usage_rollup_progress values(1, 0);
 
+-- Replica lag probe, see read_routing.py
+create table replica_heartbeat(
+  id int,
+  written_at bigint,
+  PRIMARY KEY(id)
+);
 
+insert into replica_heartbeat values(1, 0);
 
+-- Billing period sweep progress per plan, see billing_periods.py
+create table billing_sweep_progress(
+  plan_id int,
+  period_id int,
+  last_subscription_id int,
+  PRIMARY KEY(plan_id)
+);
 
+-- Slot rows of the sharded usage counters, see usage_counters.py
+create table usage_counter_slots(
+  id int AUTO_INCREMENT,
+  user_id int,
+  period_id int,
+  slot int,
+  count int,
+  PRIMARY KEY(id),
+  UNIQUE KEY ux_usage_counter_slots_slot (user_id, period_id, slot)
+);
 
+-- First responses of metered calls per Idempotency-Key, see idempotency.py
+create table idempotency_keys(
+  id int AUTO_INCREMENT,
+  user_id int,
+  key_hash varchar(40),
+  fingerprint varchar(40),
+  status_code smallint NULL,
+  body text NULL,
+  claimed_at bigint,
+  expires_at bigint,
+  PRIMARY KEY(id),
+  UNIQUE KEY ux_idempotency_keys_user_key (user_id, key_hash),
+  KEY ix_idempotency_keys_expires_at (expires_at)
+);
 
+-- Schema version of this file, see migrations.py (python migrations.py upgrade)
+create table schema_migrations(
+  version int,
+  description varchar(255),
+  applied_at datetime,
+  PRIMARY KEY(version)
+);
 
-
+insert into schema_migrations values(1, 'Rename subscription.api_usage to usage', now()),
+                                    (2, 'Create plan_rate_limits and the usage event tables', now()),
+                                    (3, 'Unique index on users.username', now()),
+                                    (4, 'Unique index on subscription.user_id, index on plan_id, foreign keys', now()),
+                                    (5, 'Unique (plan_id, api_id) and api_id index on plan_endpoints, cascading foreign keys', now()),
+                                    (6, 'Unique (plan_id, api_id) on plan_rate_limits, cascading foreign keys', now()),
+                                    (7, 'Unique bucket index on usage_rollups', now()),
+                                    (8, 'Create replica_heartbeat', now()),
+                                    (9, 'Billing periods: plan.billing_period, subscription period columns, billing_sweep_progress', now()),
+                                    (10, 'Create usage_counter_slots', now()),
+                                    (11, 'Create idempotency_keys', now()),
+                                    (12, 'usage_events.inserted_at', now());
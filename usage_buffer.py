@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import case, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models import Subscription
+from plan_cache import PlanEntry, plan_cache
+from quota import QuotaResult
+from quota_store import QuotaStore
+from billing_periods import debit_values, plan_period
+
+logger = logging.getLogger(__name__)
+
+# ----Write-behind Usage Accounting----!!
+# Optional accounting mode for high-volume tenants: usage is counted per user_id in a
+# quota store (quota_store.py), limits are enforced there with its atomic consume, and
+# each worker writes the increments it admitted back with one UPDATE per flush instead
+# of one per request. With a shared store (mmap, redis) every worker enforces against
+# the same counter; with the in-process store each worker only sees the others' usage
+# after their flushes, which USAGE_OVERSHOOT bounds. Counters are kept per user and
+# billing period (billing_periods.py), so a new period simply starts a new counter.
+
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "1.0"))
+USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", "1000"))
+# Extra calls a user may make past Plan.usage_limit within one flush window. Other
+# workers' increments are only seen after a flush, so this bounds the cross-worker drift.
+USAGE_OVERSHOOT = int(os.getenv("USAGE_OVERSHOOT", "0"))
+# Users written per UPDATE statement
+USAGE_FLUSH_BATCH_SIZE = 500
+
+
+class _UserUsage:
+    __slots__ = ("plan_id", "period_id", "pending")
+
+    def __init__(self, plan_id: int, period_id: Optional[int]):
+        self.plan_id = plan_id
+        # Billing period the counter and the pending increments belong to
+        self.period_id = period_id
+        # Increments this worker admitted and has not flushed yet
+        self.pending = 0
+
+
+class UsageBuffer:
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL_SECONDS,
+                 max_pending: int = USAGE_FLUSH_MAX_PENDING, overshoot: int = USAGE_OVERSHOOT):
+        self.enabled = False
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.overshoot = overshoot
+        self.pending_total = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self._users: Dict[int, _UserUsage] = {}
+        # Users' states from a closed billing period that still have increments to flush
+        self._retired: List[Tuple[int, _UserUsage]] = []
+        self.store: Optional[QuotaStore] = None
+        self._session_factory = None
+        self._task: Optional[asyncio.Task] = None
+        self._early_flush: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def start(self, session_factory, store: QuotaStore) -> None:
+        if store.is_row:
+            raise ValueError(f"The {store.name} quota store is the subscription row itself; buffer with memory, mmap or redis")
+        self.enabled = True
+        self._session_factory = session_factory
+        self.store = store
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Flush on shutdown so buffered usage is not lost
+        await self.flush()
+        self.enabled = False
+        await self.store.close()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _row(self, user_id: int, db: AsyncSession):
+        result = await db.execute(
+            select(Subscription.plan_id, Subscription.usage, Subscription.period_id).filter(Subscription.user_id == user_id)
+        )
+        return result.first()
+
+    # Usage a subscription row counts in the given period
+    @staticmethod
+    def _usage_in(row, period_id: Optional[int]) -> int:
+        if not row or (period_id is not None and row.period_id < period_id):
+            return 0
+        return row.usage or 0
+
+    # Plan of the user, seeding the store's counter from the row the first time the worker sees them
+    async def _user(self, user_id: int, db: AsyncSession) -> Optional[_UserUsage]:
+        state = self._users.get(user_id)
+        if state is None:
+            row = await self._row(user_id, db)
+            if not row:
+                return None
+            plan = await plan_cache.get(row.plan_id, db)
+            period_id = plan_period(plan) if plan else None
+            await self.store.seed(user_id, period_id, self._usage_in(row, period_id))
+            state = self._users.setdefault(user_id, _UserUsage(row.plan_id, period_id))
+        return state
+
+    # The user's state for their plan's current billing period, and the plan
+    async def _current(self, user_id: int, db: AsyncSession) -> Tuple[Optional[_UserUsage], Optional[PlanEntry]]:
+        state = await self._user(user_id, db)
+        if state is None:
+            return None, None
+        plan = await plan_cache.get(state.plan_id, db)
+        if plan is not None and plan_period(plan) != state.period_id:
+            # The period turned since the counter was seeded: retire the old counter and start the new one
+            if self._users.get(user_id) is state:
+                del self._users[user_id]
+            if state.pending:
+                self._retire(user_id, state)
+            await self.store.forget(user_id, state.period_id)
+            state = await self._user(user_id, db)
+            if state is None:
+                return None, None
+        return state, plan
+
+    # Keep a state that is no longer the user's current one until its increments are flushed
+    def _retire(self, user_id: int, state: _UserUsage) -> None:
+        if not any(other is state for _, other in self._retired):
+            self._retired.append((user_id, state))
+
+    async def _consume(self, user_id: int, state: _UserUsage, units: int, limit: int, db: AsyncSession) -> bool:
+        period_id = state.period_id
+        consumed = await self.store.consume(user_id, period_id, units, limit)
+        if consumed is None:
+            # The counter went away (forgotten, or the store restarted): seed it again from the row
+            await self.store.seed(user_id, period_id, self._usage_in(await self._row(user_id, db), period_id) + state.pending)
+            consumed = await self.store.consume(user_id, period_id, units, limit)
+        return bool(consumed)
+
+    def _admitted(self, state: _UserUsage, units: int) -> None:
+        state.pending += units
+        self.pending_total += units
+        if self.pending_total >= self.max_pending and not self._flush_lock.locked():
+            # Size threshold reached, flush without waiting for the interval
+            self._early_flush = asyncio.create_task(self.flush())
+
+    # Debit one unit per endpoint, all or nothing
+    async def reserve(self, user_id: int, api_endpoints: Sequence[str], db: AsyncSession) -> QuotaResult:
+        units = len(api_endpoints)
+        state, plan = await self._current(user_id, db)
+        if state is None:
+            return QuotaResult.NOT_FOUND
+        if not plan:
+            return QuotaResult.NOT_FOUND
+        if not all(plan.matcher.match(api_endpoint) for api_endpoint in api_endpoints):
+            return QuotaResult.DENIED
+        limit = plan.usage_limit + self.overshoot if plan.usage_limit != 0 else 0
+        if not await self._consume(user_id, state, units, limit, db):
+            return QuotaResult.OVER_LIMIT
+
+        self._admitted(state, units)
+        return QuotaResult.ALLOWED
+
+    # Usage in the given billing period as the store counts it, None if the store has no counter for it
+    async def usage(self, user_id: int, period_id: Optional[int]) -> Optional[int]:
+        return await self.store.get(user_id, period_id)
+
+    # Forget a user's cached plan, keeping any unflushed increments
+    def refresh(self, user_id: int) -> None:
+        state = self._users.get(user_id)
+        if state is not None and not state.pending:
+            del self._users[user_id]
+
+    # Write the aggregated deltas back to the subscription table
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            retired, self._retired = self._retired, []
+            batch = [(user_id, state, state.pending) for user_id, state in retired + list(self._users.items()) if state.pending]
+            if not batch:
+                return
+            for _, state, delta in batch:
+                state.pending -= delta
+            flushed = sum(delta for _, _, delta in batch)
+            self.pending_total -= flushed
+
+            # One UPDATE per billing period and batch of users; a row still in an older period
+            # is rolled over first, as the metered debit does
+            by_period: Dict[Optional[int], List[Tuple[int, int]]] = {}
+            for user_id, state, delta in batch:
+                by_period.setdefault(state.period_id, []).append((user_id, delta))
+            started = time.perf_counter()
+            try:
+                async with self._session_factory() as session:
+                    for period_id, deltas in by_period.items():
+                        for i in range(0, len(deltas), USAGE_FLUSH_BATCH_SIZE):
+                            chunk = dict(deltas[i:i + USAGE_FLUSH_BATCH_SIZE])
+                            units = case(chunk, value=Subscription.user_id, else_=0)
+                            statement = update(Subscription).where(Subscription.user_id.in_(chunk))
+                            if period_id is None:
+                                statement = statement.values(usage=Subscription.usage + units)
+                            else:
+                                statement = statement.ordered_values(*debit_values(period_id, units))
+                            await session.execute(statement.execution_options(synchronize_session=False))
+                    await session.commit()
+            except Exception:
+                # Put the deltas back so the next flush retries them
+                for user_id, state, delta in batch:
+                    state.pending += delta
+                    if self._users.setdefault(user_id, state) is not state:
+                        self._retire(user_id, state)
+                self.pending_total += flushed
+                self.flush_errors += 1
+                logger.exception("Usage flush failed for %d users", len(batch))
+                return
+
+            elapsed = time.perf_counter() - started
+            self.flush_count += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            # Drop idle users so their plan is re-read next window. A worker-local counter is
+            # dropped too and re-seeded from the row, which now includes the other workers' flushes.
+            for user_id, state, _ in batch:
+                if self._users.get(user_id) is state and not state.pending:
+                    del self._users[user_id]
+                    if not self.store.shared:
+                        await self.store.forget(user_id, state.period_id)
+                elif self._users.get(user_id) is not state and state.pending:
+                    # Replaced while this flush ran, with increments admitted since
+                    self._retire(user_id, state)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "pending_delta": self.pending_total,
+            "pending_users": sum(1 for state in self._users.values() if state.pending),
+            "tracked_users": len(self._users),
+            "retired_states": len(self._retired),
+            "flush_count": self.flush_count,
+            "flush_errors": self.flush_errors,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "flush_interval_seconds": self.flush_interval,
+            "overshoot": self.overshoot,
+            "store": self.store.stats() if self.store else None,
+        }
+
+
+usage_buffer = UsageBuffer()
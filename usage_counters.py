@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+from sqlalchemy import and_, bindparam, case, delete, exists, func, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models import Subscription, UsageCounterSlot
+from plan_cache import plan_cache
+from quota import QuotaResult
+from rate_limit import rate_limiter
+from billing_periods import current_usage, plan_period
+
+logger = logging.getLogger(__name__)
+
+# ----Sharded Usage Counters----!!
+# With USAGE_COUNTER_SLOTS=N (N > 1), metered calls of subscribers on unlimited plans
+# (usage_limit 0) no longer update their subscription row: each call adds to one of N
+# slot rows in usage_counter_slots, picked at random, so the concurrent calls of a busy
+# tenant take different row locks. The slot UPDATE only matches while the subscription
+# is still on that plan, so a plan change applies at once. Capped plans keep debiting
+# the subscription row with the exact conditional UPDATE.
+#
+# Slots are kept per billing period (period 0 for plans without one). Usage reads add
+# the user's slots for the current period to the row. Every
+# USAGE_COUNTER_FOLD_INTERVAL_SECONDS each worker folds the slots it wrote into the
+# subscription rows, which keeps the rows (and the billing period rollover) current and
+# drops the emptied slots of closed periods. Only direct accounting uses slots: buffered
+# accounting (QUOTA_STORE) already keeps the row off the request path.
+
+USAGE_COUNTER_SLOTS = int(os.getenv("USAGE_COUNTER_SLOTS", "0"))
+USAGE_COUNTER_FOLD_INTERVAL_SECONDS = float(os.getenv("USAGE_COUNTER_FOLD_INTERVAL_SECONDS", "10"))
+# Users folded per transaction
+USAGE_COUNTER_FOLD_BATCH_SIZE = 500
+
+
+# SET clauses folding units counted in a billing period into subscription rows (for
+# Update.ordered_values, as billing_periods.debit_values). A row behind the period rolls
+# into it; a row already past it adds them to its closed period when that is the one, or
+# when the row skipped it (no calls, then the sweep) keeps them as its last closed period.
+def _fold_values(period_id: int, units) -> List[tuple]:
+    behind = Subscription.period_id < period_id
+    past = Subscription.period_id > period_id
+    same_previous = Subscription.previous_period_id == period_id
+    older_previous = or_(Subscription.previous_period_id.is_(None), Subscription.previous_period_id < period_id)
+    return [
+        (Subscription.previous_usage, case((behind, Subscription.usage),
+                                           (and_(past, same_previous), Subscription.previous_usage + units),
+                                           (and_(past, older_previous), units),
+                                           else_=Subscription.previous_usage)),
+        (Subscription.previous_period_id, case((behind, Subscription.period_id),
+                                               (and_(past, older_previous), period_id),
+                                               else_=Subscription.previous_period_id)),
+        (Subscription.usage, case((behind, units), (past, Subscription.usage), else_=Subscription.usage + units)),
+        (Subscription.period_id, case((behind, period_id), else_=Subscription.period_id)),
+    ]
+
+
+class UsageCounters:
+    def __init__(self, slots: int = USAGE_COUNTER_SLOTS, fold_interval: float = USAGE_COUNTER_FOLD_INTERVAL_SECONDS):
+        self.enabled = False
+        self.slots = slots
+        self.fold_interval = fold_interval
+        self.slot_calls = 0
+        self.row_calls = 0
+        self.slot_rows_created = 0
+        self.folds = 0
+        self.folded_units = 0
+        self.fold_errors = 0
+        self.last_fold_seconds = 0.0
+        # (user_id, period_id) this worker added to since its last fold
+        self._touched: Set[Tuple[int, int]] = set()
+        self._session_factory = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, session_factory) -> None:
+        self.enabled = True
+        self._session_factory = session_factory
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Fold on shutdown so the rows are current without this worker
+        await self.fold()
+        self.enabled = False
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.fold_interval)
+            await self.fold()
+
+    # Count the units in a random slot when the user's plan is an unlimited one among
+    # allowed_plans. None leaves the call to the subscription row.
+    async def reserve(self, user_id: int, units: int, allowed_plans: FrozenSet[int], db: AsyncSession) -> Optional[QuotaResult]:
+        plan_id = await rate_limiter.plan_of(user_id, db)
+        if plan_id is None or plan_id not in allowed_plans:
+            return None
+        plan = await plan_cache.get(plan_id, db)
+        if plan is None or plan.usage_limit != 0:
+            self.row_calls += 1
+            return None
+        period_id = plan_period(plan) or 0
+        slot = random.randrange(self.slots)
+        if not await self._add(user_id, plan_id, period_id, slot, units, db):
+            # No slots for the period yet, or the subscription moved to another plan
+            if not await self._create_slots(user_id, plan_id, period_id, db) \
+                    or not await self._add(user_id, plan_id, period_id, slot, units, db):
+                await db.rollback()
+                rate_limiter.forget_user(user_id)
+                self.row_calls += 1
+                return None
+        await db.commit()
+        self._touched.add((user_id, period_id))
+        self.slot_calls += 1
+        return QuotaResult.ALLOWED
+
+    async def _add(self, user_id: int, plan_id: int, period_id: int, slot: int, units: int, db: AsyncSession) -> bool:
+        result = await db.execute(
+            update(UsageCounterSlot)
+            .where(UsageCounterSlot.user_id == user_id, UsageCounterSlot.period_id == period_id, UsageCounterSlot.slot == slot,
+                   exists().where(Subscription.user_id == user_id, Subscription.plan_id == plan_id))
+            .values(count=UsageCounterSlot.count + units)
+            .execution_options(synchronize_session=False)
+        )
+        return bool(result.rowcount)
+
+    # Create the user's missing slots for the period, if they are still on the plan
+    async def _create_slots(self, user_id: int, plan_id: int, period_id: int, db: AsyncSession) -> bool:
+        if await db.scalar(select(Subscription.plan_id).filter(Subscription.user_id == user_id)) != plan_id:
+            return False
+        existing = set((await db.scalars(
+            select(UsageCounterSlot.slot).where(UsageCounterSlot.user_id == user_id, UsageCounterSlot.period_id == period_id)
+        )).all())
+        rows = [{"user_id": user_id, "period_id": period_id, "slot": slot, "count": 0}
+                for slot in range(self.slots) if slot not in existing]
+        if rows:
+            try:
+                await db.execute(insert(UsageCounterSlot), rows)
+                await db.commit()
+                self.slot_rows_created += len(rows)
+            except IntegrityError:
+                # Another request created them first
+                await db.rollback()
+        return True
+
+    # Usage of the subscription in its plan's current billing period, slots included
+    async def usage(self, subscription: Subscription, plan, db: AsyncSession) -> int:
+        usage = current_usage(subscription, plan)
+        if self.enabled and plan is not None:
+            usage += await db.scalar(
+                select(func.coalesce(func.sum(UsageCounterSlot.count), 0))
+                .where(UsageCounterSlot.user_id == subscription.user_id, UsageCounterSlot.period_id == (plan_period(plan) or 0))
+            )
+        return usage
+
+    # Move the counts of the slots this worker wrote into the subscription rows
+    async def fold(self) -> None:
+        touched, self._touched = self._touched, set()
+        if not touched:
+            return
+        started = time.perf_counter()
+        # Newest period written per user: emptied slots of older periods are dropped
+        newest: Dict[int, int] = {}
+        for user_id, period_id in touched:
+            newest[user_id] = max(period_id, newest.get(user_id, period_id))
+        users = sorted(newest)
+        for i in range(0, len(users), USAGE_COUNTER_FOLD_BATCH_SIZE):
+            batch = {user_id: newest[user_id] for user_id in users[i:i + USAGE_COUNTER_FOLD_BATCH_SIZE]}
+            try:
+                await self._fold_batch(batch)
+            except Exception:
+                # Try these users again at the next fold; their usage reads stay correct meanwhile
+                self._touched.update((user_id, period_id) for user_id, period_id in batch.items())
+                self.fold_errors += 1
+                logger.exception("Usage counter fold failed for %d users", len(batch))
+        self.folds += 1
+        self.last_fold_seconds = time.perf_counter() - started
+
+    # Fold one user's slots now, e.g. before a capped plan checks its limit against the row
+    async def fold_user(self, user_id: int) -> None:
+        if self.enabled:
+            await self._fold_batch({user_id: 0})
+
+    async def _fold_batch(self, newest: Dict[int, int]) -> None:
+        async with self._session_factory() as session:
+            # Lock the slots, so a concurrent fold in another worker waits and then sees them emptied
+            slots = (await session.execute(
+                select(UsageCounterSlot.id, UsageCounterSlot.user_id, UsageCounterSlot.period_id, UsageCounterSlot.count)
+                .where(UsageCounterSlot.user_id.in_(newest), UsageCounterSlot.count != 0)
+                .with_for_update()
+            )).all()
+            if slots:
+                table = UsageCounterSlot.__table__
+                await session.execute(
+                    table.update().where(table.c.id == bindparam("slot_id")).values(count=table.c.count - bindparam("folded")),
+                    [{"slot_id": slot.id, "folded": slot.count} for slot in slots],
+                )
+                # One UPDATE per billing period the slots counted
+                by_period: Dict[int, Dict[int, int]] = {}
+                for slot in slots:
+                    totals = by_period.setdefault(slot.period_id, {})
+                    totals[slot.user_id] = totals.get(slot.user_id, 0) + slot.count
+                for period_id, totals in by_period.items():
+                    units = case(totals, value=Subscription.user_id, else_=0)
+                    statement = update(Subscription).where(Subscription.user_id.in_(totals))
+                    if period_id == 0:
+                        statement = statement.values(usage=Subscription.usage + units)
+                    else:
+                        statement = statement.ordered_values(*_fold_values(period_id, units))
+                    await session.execute(statement.execution_options(synchronize_session=False))
+            by_newest: Dict[int, List[int]] = {}
+            for user_id, period_id in newest.items():
+                by_newest.setdefault(period_id, []).append(user_id)
+            for period_id, user_ids in by_newest.items():
+                await session.execute(
+                    delete(UsageCounterSlot)
+                    .where(UsageCounterSlot.user_id.in_(user_ids), UsageCounterSlot.period_id < period_id,
+                           UsageCounterSlot.count == 0)
+                    .execution_options(synchronize_session=False)
+                )
+            await session.commit()
+        self.folded_units += sum(slot.count for slot in slots)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "slots": self.slots,
+            "slot_calls": self.slot_calls,
+            "row_calls": self.row_calls,
+            "slot_rows_created": self.slot_rows_created,
+            "pending_users": len({user_id for user_id, _ in self._touched}),
+            "folds": self.folds,
+            "folded_units": self.folded_units,
+            "fold_errors": self.fold_errors,
+            "last_fold_seconds": self.last_fold_seconds,
+            "fold_interval_seconds": self.fold_interval,
+        }
+
+
+usage_counters = UsageCounters()
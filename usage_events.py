@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+from sqlalchemy import insert, update, bindparam, func
+from sqlalchemy.future import select
+from models import Permission, UsageEvent, UsageRollup, UsageRollupProgress
+
+logger = logging.getLogger(__name__)
+
+# ----Usage Event Log----!!
+# Every allowed metered call is queued in memory as (user_id, endpoint, timestamp) and
+# written off the request path with multi-row INSERTs. A background roll-up folds new
+# events into hourly and daily usage_rollups, so history queries never scan raw events.
+#
+# The roll-up advances an event id watermark. Workers insert concurrently, so their
+# auto-increment ids commit out of order: an event with a lower id can still be in
+# another worker's open flush when a higher one is visible. The watermark therefore only
+# moves over events inserted more than USAGE_ROLLUP_LAG_SECONDS ago by the database
+# clock (inserted_at), and stops at the first younger one. The lag has to cover the time
+# from a flush's INSERT to its COMMIT, not the time an event waited in the queue.
+
+USAGE_EVENTS_ENABLED = os.getenv("USAGE_EVENTS_ENABLED", "false").lower() == "true"
+USAGE_EVENTS_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_EVENTS_FLUSH_INTERVAL_SECONDS", "1.0"))
+USAGE_ROLLUP_INTERVAL_SECONDS = float(os.getenv("USAGE_ROLLUP_INTERVAL_SECONDS", "60"))
+# Events younger than this are left for a later roll-up, see above
+USAGE_ROLLUP_LAG_SECONDS = float(os.getenv("USAGE_ROLLUP_LAG_SECONDS", "30"))
+# Events kept in memory before new ones are dropped (counted in stats)
+USAGE_EVENTS_MAX_PENDING = int(os.getenv("USAGE_EVENTS_MAX_PENDING", "100000"))
+# Rows per INSERT and events per roll-up transaction
+USAGE_EVENTS_BATCH_SIZE = 1000
+USAGE_ROLLUP_CHUNK_SIZE = 5000
+
+GRANULARITIES = ("hour", "day")
+
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class UsageEventLog:
+    def __init__(self):
+        self.enabled = False
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.rolled_up = 0
+        self.rollup_errors = 0
+        self.last_rollup_seconds = 0.0
+        self._pending: List[Tuple[int, str, datetime]] = []
+        self._endpoint_ids: Dict[str, int] = {}
+        self._session_factory = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, session_factory) -> None:
+        self.enabled = True
+        self._session_factory = session_factory
+        self._tasks = [
+            asyncio.create_task(self._every(USAGE_EVENTS_FLUSH_INTERVAL_SECONDS, self.flush)),
+            asyncio.create_task(self._every(USAGE_ROLLUP_INTERVAL_SECONDS, self.rollup)),
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+        self.enabled = False
+
+    async def _every(self, interval: float, job) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await job()
+
+    # Queue one metered call; never touches the database
+    def record(self, user_id: int, api_endpoint: str) -> None:
+        if not self.enabled:
+            return
+        if len(self._pending) >= USAGE_EVENTS_MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append((user_id, api_endpoint, datetime.utcnow()))
+
+    async def _resolve_endpoints(self, session, api_endpoints) -> None:
+        missing = {api_endpoint for api_endpoint in api_endpoints if api_endpoint not in self._endpoint_ids}
+        if missing:
+            rows = await session.execute(select(Permission.id, Permission.api_endpoint).where(Permission.api_endpoint.in_(missing)))
+            for endpoint_id, api_endpoint in rows:
+                self._endpoint_ids[api_endpoint] = endpoint_id
+
+    # Write the queued events with multi-row INSERTs
+    async def flush(self) -> None:
+        events, self._pending = self._pending, []
+        if not events:
+            return
+        try:
+            async with self._session_factory() as session:
+                await self._resolve_endpoints(session, {api_endpoint for _, api_endpoint, _ in events})
+                rows = [
+                    {"user_id": user_id, "api_id": self._endpoint_ids.get(api_endpoint), "created_at": created_at}
+                    for user_id, api_endpoint, created_at in events
+                ]
+                for i in range(0, len(rows), USAGE_EVENTS_BATCH_SIZE):
+                    await session.execute(insert(UsageEvent).values(inserted_at=func.now()), rows[i:i + USAGE_EVENTS_BATCH_SIZE])
+                await session.commit()
+            self.written += len(events)
+        except Exception:
+            self.write_errors += 1
+            # Keep the events for the next flush, within the pending bound
+            room = max(0, USAGE_EVENTS_MAX_PENDING - len(self._pending))
+            self.dropped += max(0, len(events) - room)
+            self._pending[:0] = events[:room]
+            logger.exception("Usage event flush failed for %d events", len(events))
+
+    # Fold events past the watermark into the hourly and daily rollups, one chunk per transaction
+    async def rollup(self) -> None:
+        started = time.perf_counter()
+        try:
+            while await self._rollup_chunk():
+                pass
+        except Exception:
+            self.rollup_errors += 1
+            logger.exception("Usage roll-up failed")
+        self.last_rollup_seconds = time.perf_counter() - started
+
+    async def _rollup_chunk(self) -> bool:
+        async with self._session_factory() as session:
+            last_event_id = await session.scalar(select(UsageRollupProgress.last_event_id).where(UsageRollupProgress.id == 1))
+            if last_event_id is None:
+                session.add(UsageRollupProgress(id=1, last_event_id=0))
+                await session.commit()
+                last_event_id = 0
+            events = (await session.execute(
+                select(UsageEvent.id, UsageEvent.user_id, UsageEvent.api_id, UsageEvent.created_at, UsageEvent.inserted_at)
+                .where(UsageEvent.id > last_event_id).order_by(UsageEvent.id).limit(USAGE_ROLLUP_CHUNK_SIZE)
+            )).all()
+            # Only the events before the first one inside the lag: ids below a younger event may still commit.
+            # Rows written before inserted_at existed fall back to their queue time
+            cutoff = await session.scalar(select(func.now())) - timedelta(seconds=USAGE_ROLLUP_LAG_SECONDS)
+            ready = next((i for i, event in enumerate(events) if (event.inserted_at or event.created_at) >= cutoff), len(events))
+            more = ready == USAGE_ROLLUP_CHUNK_SIZE
+            events = events[:ready]
+            if not events:
+                return False
+
+            # Claim the chunk first: the conditional UPDATE locks the progress row, and another
+            # worker that already rolled it up leaves nothing to match
+            claimed = await session.execute(
+                update(UsageRollupProgress)
+                .where(UsageRollupProgress.id == 1, UsageRollupProgress.last_event_id == last_event_id)
+                .values(last_event_id=events[-1].id)
+            )
+            if not claimed.rowcount:
+                await session.rollback()
+                return False
+
+            counts = Counter(
+                (event.user_id, event.api_id, granularity, bucket_start(event.created_at, granularity))
+                for event in events for granularity in GRANULARITIES
+            )
+            existing = {}
+            for granularity in GRANULARITIES:
+                buckets = {key[3] for key in counts if key[2] == granularity}
+                rows = await session.execute(
+                    select(UsageRollup.id, UsageRollup.user_id, UsageRollup.api_id, UsageRollup.bucket_start)
+                    .where(UsageRollup.granularity == granularity, UsageRollup.bucket_start.in_(buckets),
+                           UsageRollup.user_id.in_({key[0] for key in counts}))
+                )
+                for row in rows:
+                    existing[(row.user_id, row.api_id, granularity, row.bucket_start)] = row.id
+
+            updates = [{"rollup_id": existing[key], "delta": count} for key, count in counts.items() if key in existing]
+            inserts = [
+                {"user_id": key[0], "api_id": key[1], "granularity": key[2], "bucket_start": key[3], "count": count}
+                for key, count in counts.items() if key not in existing
+            ]
+            if updates:
+                table = UsageRollup.__table__
+                await session.execute(
+                    table.update().where(table.c.id == bindparam("rollup_id")).values(count=table.c.count + bindparam("delta")),
+                    updates,
+                )
+            if inserts:
+                await session.execute(insert(UsageRollup), inserts)
+            await session.commit()
+            self.rolled_up += len(events)
+            return more
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "written": self.written,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "rolled_up": self.rolled_up,
+            "rollup_errors": self.rollup_errors,
+            "last_rollup_seconds": self.last_rollup_seconds,
+            "rollup_lag_seconds": USAGE_ROLLUP_LAG_SECONDS,
+        }
+
+
+usage_events = UsageEventLog()
@@ -1,51 +1,125 @@
-from fastapi import HTTPException
+from typing import Dict, FrozenSet, Iterable, Optional, Sequence, Set
+from fastapi import HTTPException, Response
 from models import Subscription
-from sqlalchemy.orm import Session
-from models import Plan, Permission, PlanPermission
+from sqlalchemy import or_, update
+from models import Plan
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from plan_cache import plan_cache
+from quota import QuotaResult
+from usage_buffer import usage_buffer
+from rate_limit import rate_limiter, raise_if_throttled
+from usage_events import usage_events
+from usage_counters import usage_counters
+from billing_periods import current_periods, current_usage, debit_values, period_expression, usage_expression
 
 
 # ----Access Control---- & Usage Tracking and Limit Enforcement!!
 
-# Function to check access and usage
-def check_access_and_usage(user_id: int, api_endpoint: str, db: Session):
-    # Retrieve subscription and plan
-    subscription = db.query(Subscription).filter(Subscription.user_id == user_id).first()
-    if not subscription:
-        raise HTTPException(status_code=404, detail="Subscription not found")
-    
-    plan = db.query(Plan).filter(Plan.id == subscription.plan_id).first()
-    if not plan:
-        raise HTTPException(status_code=404, detail="Plan not found")
-    
-    # Check usage limit
-    if plan.usage_limit != 0 and subscription.usage >= plan.usage_limit:
-        raise HTTPException(
-            status_code=403, 
-            detail="Usage limit exceeded. Upgrade your plan to continue accessing this API."
+# Function to check access and debit units of usage in a single conditional UPDATE: one unit
+# per endpoint, debited only if the plan grants every endpoint and all the units fit under
+# the limit, otherwise nothing is debited. The plans granting the endpoints come from the
+# plan cache's compiled matchers, so concurrent requests can neither lose increments nor
+# overshoot Plan.usage_limit. A row still in a closed billing period is rolled into the
+# current one by the same UPDATE.
+# allowed_plans skips the plan cache when the caller already knows which plans qualify.
+async def reserve_usage(user_id: int, api_endpoints: Sequence[str], db: AsyncSession,
+                        allowed_plans: Optional[FrozenSet[int]] = None) -> QuotaResult:
+    units = len(api_endpoints)
+    if allowed_plans is None:
+        for api_endpoint in set(api_endpoints):
+            allowing = await plan_cache.plans_allowing(api_endpoint, db)
+            allowed_plans = allowing if allowed_plans is None else allowed_plans & allowing
+    if allowed_plans and usage_counters.enabled:
+        # Unlimited plans count in a slot row instead of the subscription row
+        result = await usage_counters.reserve(user_id, units, allowed_plans, db)
+        if result is not None:
+            return result
+    if allowed_plans:
+        usage_limit = select(Plan.usage_limit).where(Plan.id == Subscription.plan_id).scalar_subquery()
+        statement, usage = _debit(await current_periods(allowed_plans, db), allowed_plans, units)
+        result = await db.execute(
+            statement
+            .where(Subscription.user_id == user_id, Subscription.plan_id.in_(allowed_plans),
+                   or_(usage_limit == 0, usage + units <= usage_limit))
+            .execution_options(synchronize_session=False)
         )
-    
-    # Check if the user has access to the requested API
-    allowed_endpoints = db.query(Permission.api_endpoint).join(
-        PlanPermission, Permission.id == PlanPermission.api_id
-    ).filter(PlanPermission.plan_id == subscription.plan_id).all()
-    
-    allowed_endpoints = [endpoint.api_endpoint for endpoint in allowed_endpoints]
-    if api_endpoint not in allowed_endpoints:
-        raise HTTPException(
-            status_code=403, 
-            detail="You do not have access to this endpoint with your current plan."
-        )
-    
-    return
-
-# Function to track usage (User request tracking)
-async def increment_usage(user_id: int, db: AsyncSession):
-    result = await db.execute(select(Subscription).filter(Subscription.user_id == user_id))
-    subscription = result.scalars().first()
-    if subscription:
-        subscription.usage += 1
         await db.commit()
+        if result.rowcount:
+            return QuotaResult.ALLOWED
+    # Nothing was debited, work out why off the hot path
+    return await _diagnose_rejection(user_id, api_endpoints, db)
+
+# UPDATE adding units to a subscription row on one of plan_ids, and the row's usage to check
+# the limit against; plain unless one of the plans has a billing period
+def _debit(periods: Dict[int, int], plan_ids: Iterable[int], units: int):
+    if not periods:
+        return update(Subscription).values(usage=Subscription.usage + units), Subscription.usage
+    current = period_expression(periods, plan_ids)
+    return update(Subscription).ordered_values(*debit_values(current, units)), usage_expression(current)
+
+async def _diagnose_rejection(user_id: int, api_endpoints: Sequence[str], db: AsyncSession) -> QuotaResult:
+    units = len(api_endpoints)
+    subscription = await db.scalar(select(Subscription).filter(Subscription.user_id == user_id))
+    if not subscription:
+        return QuotaResult.NOT_FOUND
+    plan = await plan_cache.get(subscription.plan_id, db)
+    if plan and (plan.usage_limit == 0 or current_usage(subscription, plan) + units <= plan.usage_limit) \
+            and all(plan.matcher.match(api_endpoint) for api_endpoint in api_endpoints):
+        # The cached entry disagrees with the database, reload it before answering
+        plan_cache.invalidate(subscription.plan_id)
+        plan = await plan_cache.get(subscription.plan_id, db)
+    if not plan:
+        return QuotaResult.NOT_FOUND
+    if plan.usage_limit != 0 and current_usage(subscription, plan) + units > plan.usage_limit:
+        return QuotaResult.OVER_LIMIT
+    return QuotaResult.DENIED
+
+# Endpoints the user's current plan does not grant (for reporting a rejected batch)
+async def denied_endpoints(user_id: int, api_endpoints: Sequence[str], db: AsyncSession) -> Set[str]:
+    plan_id = await db.scalar(select(Subscription.plan_id).filter(Subscription.user_id == user_id))
+    plan = await plan_cache.get(plan_id, db) if plan_id is not None else None
+    if not plan:
+        return set(api_endpoints)
+    return {api_endpoint for api_endpoint in api_endpoints if not plan.matcher.match(api_endpoint)}
+
+# HTTP status and message for each rejected quota outcome
+QUOTA_ERRORS = {
+    QuotaResult.NOT_FOUND: (404, "Subscription not found"),
+    QuotaResult.OVER_LIMIT: (403, "Usage limit exceeded. Upgrade your plan to continue accessing this API."),
+    QuotaResult.DENIED: (403, "You do not have access to this endpoint with your current plan."),
+}
+
+# Function to rate-limit and debit one unit per call, all or nothing, recording the usage events
+# when allowed. Rate limits are checked first, so a throttled request never reaches the quota queries.
+# This is where the quota store plugs in: buffered accounting debits through usage_buffer and its
+# store, direct accounting through reserve_usage. plan_id is the user's plan when token claims
+# already showed it grants every endpoint.
+async def meter_calls(user_id: int, api_endpoints: Sequence[str], db: AsyncSession, response: Optional[Response] = None,
+                      plan_id: Optional[int] = None) -> QuotaResult:
+    decision = await rate_limiter.check(user_id, api_endpoints, db, plan_id)
+    raise_if_throttled(decision)
+    if decision is not None and response is not None:
+        response.headers.update(decision.headers())
+
+    if usage_buffer.enabled:
+        result = await usage_buffer.reserve(user_id, api_endpoints, db)
+    elif plan_id is not None:
+        result = await reserve_usage(user_id, api_endpoints, db, frozenset((plan_id,)))
+        if result == QuotaResult.DENIED:
+            # The claims disagree with the database (the subscription moved in another worker): decide from the database
+            result = await reserve_usage(user_id, api_endpoints, db)
     else:
-        raise HTTPException(status_code=404, detail="Subscription not found")
+        result = await reserve_usage(user_id, api_endpoints, db)
+    if result == QuotaResult.ALLOWED:
+        for api_endpoint in api_endpoints:
+            usage_events.record(user_id, api_endpoint)
+    return result
+
+# Function to consume usage for a metered route, raising the matching HTTP error when rejected
+async def enforce_usage(user_id: int, api_endpoint: str, db: AsyncSession, response: Optional[Response] = None,
+                        plan_id: Optional[int] = None) -> None:
+    result = await meter_calls(user_id, (api_endpoint,), db, response, plan_id)
+    if result != QuotaResult.ALLOWED:
+        status_code, detail = QUOTA_ERRORS[result]
+        raise HTTPException(status_code=status_code, detail=detail)